@@ -0,0 +1,83 @@
+import os
+import errno
+import logging
+
+from gi.repository import GLib
+
+from carquinyol import layoutmanager
+
+logger = logging.getLogger('blobstore')
+
+
+class BlobStore(object):
+    """Store data files once under the digest of their content.
+
+    Entries reference a blob by hard linking their data file to it, so the
+    link count of a blob is the number of references plus one. Blobs left
+    without references are removed.
+    """
+
+    def __init__(self):
+        self._blobs_dir = layoutmanager.get_instance().get_blobs_dir()
+        if not os.path.exists(self._blobs_dir):
+            os.makedirs(self._blobs_dir)
+
+        GLib.idle_add(self._collect_cb, priority=GLib.PRIORITY_LOW)
+
+    def add(self, path, digest):
+        """Move the file at path into the store, unless an identical blob is
+           already there. Return the path of the blob.
+
+        """
+        blob_path = layoutmanager.get_instance().get_blob_path(digest)
+        if os.path.exists(blob_path):
+            logger.debug('blob %s already stored', digest)
+            os.unlink(path)
+            return blob_path
+
+        blob_dir = os.path.dirname(blob_path)
+        if not os.path.exists(blob_dir):
+            os.makedirs(blob_dir)
+
+        logger.debug('storing blob %s', digest)
+        os.chmod(path, 0o444)
+        os.rename(path, blob_path)
+        return blob_path
+
+    def link(self, digest, destination_path):
+        """Atomically replace destination_path with a link to a blob.
+
+        """
+        blob_path = layoutmanager.get_instance().get_blob_path(digest)
+        temp_path = destination_path + '.link'
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        os.link(blob_path, temp_path)
+        os.rename(temp_path, destination_path)
+
+    def release(self, digest):
+        """Remove a blob if nothing references it anymore.
+
+        """
+        if not digest:
+            return
+
+        blob_path = layoutmanager.get_instance().get_blob_path(digest)
+        try:
+            if os.stat(blob_path).st_nlink == 1:
+                logger.debug('removing unreferenced blob %s', digest)
+                os.unlink(blob_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _collect_cb(self):
+        """Remove unreferenced blobs, e.g. the ones kept alive by exports
+           of deleted entries.
+
+        """
+        for bucket in os.listdir(self._blobs_dir):
+            bucket_path = os.path.join(self._blobs_dir, bucket)
+            for digest in os.listdir(bucket_path):
+                self.release(digest)
+        return False
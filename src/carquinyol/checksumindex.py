@@ -0,0 +1,102 @@
+import os
+import logging
+import shutil
+import sqlite3
+
+logger = logging.getLogger('checksumindex')
+
+
+class ChecksumIndex(object):
+    """Map entries to the checksum of their data and back.
+
+    The mappings are kept in memory for lookups and persisted in a single
+    sqlite table, replacing the one directory per checksum and empty file
+    per entry used by earlier versions.
+    """
+
+    def __init__(self, checksums_dir):
+        self._checksums_dir = checksums_dir
+        # uid -> checksum
+        self._by_uid = {}
+        # checksum -> set of uids
+        self._by_checksum = {}
+
+        self._db = sqlite3.connect(os.path.join(checksums_dir, 'index.db'))
+        self._db.execute('CREATE TABLE IF NOT EXISTS checksums '
+                         '(uid TEXT PRIMARY KEY, checksum TEXT)')
+        self._db.commit()
+
+        for uid, checksum in self._db.execute('SELECT uid, checksum '
+                                              'FROM checksums'):
+            self._add(uid, checksum)
+
+        self._migrate_dirs()
+
+    def _migrate_dirs(self):
+        """Import the checksum directories of earlier versions.
+
+        """
+        # 'queue' held the optimizer queue of earlier versions
+        checksum_dirs = [checksum for checksum in os.listdir(
+            self._checksums_dir) if checksum != 'queue' and os.path.isdir(
+            os.path.join(self._checksums_dir, checksum))]
+        if not checksum_dirs:
+            return
+
+        migrated = []
+        for checksum in checksum_dirs:
+            for uid in os.listdir(os.path.join(self._checksums_dir,
+                                               checksum)):
+                self._add(uid, checksum)
+                migrated.append((uid, checksum))
+
+        logger.info('migrating %d entries from checksum directories',
+                    len(migrated))
+        self._db.executemany('INSERT OR REPLACE INTO checksums '
+                             'VALUES (?, ?)', migrated)
+        self._db.commit()
+
+        for checksum in checksum_dirs:
+            shutil.rmtree(os.path.join(self._checksums_dir, checksum))
+
+    def _add(self, uid, checksum):
+        self._discard(uid)
+        self._by_uid[uid] = checksum
+        self._by_checksum.setdefault(checksum, set()).add(uid)
+
+    def _discard(self, uid):
+        checksum = self._by_uid.pop(uid, None)
+        if checksum is None:
+            return None
+        uids = self._by_checksum[checksum]
+        uids.discard(uid)
+        if not uids:
+            del self._by_checksum[checksum]
+        return checksum
+
+    def add(self, uid, checksum):
+        if self._by_uid.get(uid) == checksum:
+            return
+        self._add(uid, checksum)
+        self._db.execute('INSERT OR REPLACE INTO checksums VALUES (?, ?)',
+                         (uid, checksum))
+        self._db.commit()
+
+    def remove(self, uid):
+        """Forget an entry, returning the checksum it had if any.
+
+        """
+        checksum = self._discard(uid)
+        if checksum is not None:
+            self._db.execute('DELETE FROM checksums WHERE uid = ?', (uid,))
+            self._db.commit()
+        return checksum
+
+    def get_checksum(self, uid):
+        return self._by_uid.get(uid)
+
+    def get_uids(self, checksum):
+        return self._by_checksum.get(checksum, set())
+
+    def get_all_uids(self):
+        return list(self._by_uid)
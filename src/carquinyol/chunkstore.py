@@ -0,0 +1,350 @@
+import os
+import errno
+import hashlib
+import json
+import logging
+import random
+import shutil
+import sqlite3
+import threading
+
+from gi.repository import GLib
+
+from carquinyol import layoutmanager
+
+# Chunk boundaries are picked by a gear rolling hash, chunks are between
+# _MIN_CHUNK and _MAX_CHUNK bytes long and _AVERAGE_CHUNK bytes on average.
+_MIN_CHUNK = 2 * 1024
+_AVERAGE_CHUNK = 8 * 1024
+_MAX_CHUNK = 64 * 1024
+_HASH_MASK = 2 ** 64 - 1
+# use the top bits, the low ones only depend on the last few bytes
+_CUT_MASK = (_AVERAGE_CHUNK - 1) << (64 - (_AVERAGE_CHUNK - 1).bit_length())
+_GEAR = [random.Random(0x5eed + i).getrandbits(64) for i in range(256)]
+
+_READ_SIZE = 1024 * 1024
+
+# Files larger than _n_ bytes are not worth chunking in Python
+MAX_CHUNKED_FILE_SIZE = 32 * 1024 * 1024
+
+logger = logging.getLogger('chunkstore')
+
+
+class ChunkIngestCancelledError(Exception):
+    pass
+
+
+def find_boundary(data, length):
+    """Return the length of the first chunk of data[:length]."""
+    if length <= _MIN_CHUNK:
+        return length
+
+    limit = min(length, _MAX_CHUNK)
+    gear = _GEAR
+    h = 0
+    for i in range(_MIN_CHUNK, limit):
+        h = ((h << 1) + gear[data[i]]) & _HASH_MASK
+        if not h & _CUT_MASK:
+            return i + 1
+    return limit
+
+
+def _get_digest(data):
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+def assemble(chunk_paths, destination_path):
+    """Write the data of the given chunk files to destination_path.
+
+    """
+    with open(destination_path, 'wb') as f:
+        for chunk_path in chunk_paths:
+            with open(chunk_path, 'rb') as chunk:
+                shutil.copyfileobj(chunk, f)
+
+
+class ChunkStore(object):
+    """Store entry data as content-defined chunks shared between entries.
+
+    Each entry has a manifest listing its chunks. Chunks are stored once
+    under their digest with a reference count in a small sqlite database,
+    so saving a new version of a document only costs the chunks that
+    changed. Entries are reassembled on demand.
+
+    The chunks an ingest stored are recorded without references once it is
+    done, so those of failed or cancelled ingests are collected like the
+    ones entries stopped referencing. Chunks left behind by a crash are
+    not recorded at all and are swept once after starting.
+    """
+
+    def __init__(self):
+        self._chunks_dir = layoutmanager.get_instance().get_chunks_dir()
+        if not os.path.exists(self._chunks_dir):
+            os.makedirs(self._chunks_dir)
+
+        self._db = sqlite3.connect(os.path.join(self._chunks_dir, 'index.db'))
+        self._db.execute('CREATE TABLE IF NOT EXISTS chunks '
+                         '(digest TEXT PRIMARY KEY, size INTEGER, '
+                         'refs INTEGER)')
+        self._db.commit()
+        self._ingests = 0
+        self._swept = False
+
+        GLib.idle_add(self._collect_cb, priority=GLib.PRIORITY_LOW)
+
+    def _get_manifest_path(self, uid):
+        return layoutmanager.get_instance().get_data_path(uid) + '.chunks'
+
+    def _get_cache_path(self, uid):
+        return layoutmanager.get_instance().get_data_path(uid) + '.cache'
+
+    def _read_manifest(self, uid):
+        manifest_path = self._get_manifest_path(uid)
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+
+    def has_entry(self, uid):
+        return os.path.exists(self._get_manifest_path(uid))
+
+    def get_size(self, uid):
+        manifest = self._read_manifest(uid)
+        if manifest is None:
+            return 0
+        return manifest['size']
+
+    def create_ingest(self, src, completion, unlink_src=False, src_fd=None):
+        """Return a job splitting a file into chunks in a worker thread.
+
+        """
+        self._ingests += 1
+
+        def completion_cb(*args):
+            self._ingests -= 1
+            self._change_refs(ingest.new_chunks, 0)
+            completion(*args)
+            GLib.idle_add(self._collect_cb, priority=GLib.PRIORITY_LOW)
+
+        ingest = ChunkIngest(src, completion_cb, unlink_src, src_fd)
+        return ingest
+
+    def commit(self, uid, ingest):
+        """Make the chunks of a finished ingest the data of an entry.
+
+        """
+        manifest_path = self._get_manifest_path(uid)
+        old_manifest = self._read_manifest(uid)
+
+        self._change_refs(ingest.chunks, 1)
+        temp_path = manifest_path + '.tmp'
+        f = open(temp_path, 'w')
+        try:
+            json.dump({'size': ingest.written, 'chunks': ingest.chunks}, f)
+        finally:
+            f.close()
+        os.rename(temp_path, manifest_path)
+
+        if old_manifest is not None:
+            self._change_refs(old_manifest['chunks'], -1)
+        self._remove_cache(uid)
+
+        shared = sum(size for digest_, size in ingest.chunks) - ingest.stored
+        logger.debug('committed %r: %d chunks, %d bytes shared, %d stored',
+                     uid, len(ingest.chunks), shared, ingest.stored)
+
+    def delete(self, uid):
+        manifest = self._read_manifest(uid)
+        if manifest is None:
+            return
+        os.remove(self._get_manifest_path(uid))
+        self._change_refs(manifest['chunks'], -1)
+        self._remove_cache(uid)
+
+    def materialize(self, uid):
+        """Return the path of a file with the data of an entry, assembling
+           it from its chunks if needed.
+
+        """
+        manifest_path = self._get_manifest_path(uid)
+        cache_path = self._get_cache_path(uid)
+        if os.path.exists(cache_path) and \
+                os.stat(cache_path).st_mtime >= \
+                os.stat(manifest_path).st_mtime:
+            return cache_path
+
+        chunk_paths = self.get_chunk_paths(uid)
+        logger.debug('materializing %r from %d chunks', uid,
+                     len(chunk_paths))
+        temp_path = cache_path + '.tmp'
+        assemble(chunk_paths, temp_path)
+        os.chmod(temp_path, 0o444)
+        os.rename(temp_path, cache_path)
+        return cache_path
+
+    def get_chunk_paths(self, uid):
+        """Return the paths of the chunks of an entry, in order.
+
+        """
+        layout_manager = layoutmanager.get_instance()
+        return [layout_manager.get_chunk_path(digest)
+                for digest, size_ in self._read_manifest(uid)['chunks']]
+
+    def _remove_cache(self, uid):
+        cache_path = self._get_cache_path(uid)
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+
+    def _change_refs(self, chunks, delta):
+        for digest, size in chunks:
+            self._db.execute('INSERT OR IGNORE INTO chunks VALUES (?, ?, 0)',
+                             (digest, size))
+            self._db.execute('UPDATE chunks SET refs = refs + ? '
+                             'WHERE digest = ?', (delta, digest))
+        self._db.commit()
+
+        if delta < 0:
+            GLib.idle_add(self._collect_cb, priority=GLib.PRIORITY_LOW)
+
+    def _collect_cb(self):
+        """Remove chunks nothing references anymore.
+
+        """
+        if self._ingests:
+            # an ingest in flight may be counting on them
+            return False
+
+        if not self._swept:
+            self._sweep()
+            self._swept = True
+
+        unreferenced = [row[0] for row in self._db.execute(
+            'SELECT digest FROM chunks WHERE refs <= 0')]
+        for digest in unreferenced:
+            try:
+                os.remove(layoutmanager.get_instance().get_chunk_path(digest))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            self._db.execute('DELETE FROM chunks WHERE digest = ?', (digest,))
+        self._db.commit()
+        if unreferenced:
+            logger.debug('removed %d unreferenced chunks', len(unreferenced))
+        return False
+
+    def _sweep(self):
+        """Remove the chunk files that are not recorded, written by ingests
+           that were interrupted by a crash.
+
+        """
+        known = set(row[0] for row in self._db.execute(
+            'SELECT digest FROM chunks'))
+        removed = 0
+        for bucket in os.listdir(self._chunks_dir):
+            bucket_path = os.path.join(self._chunks_dir, bucket)
+            if not os.path.isdir(bucket_path):
+                continue
+            for file_name in os.listdir(bucket_path):
+                # temporary files start with a dot
+                if file_name not in known:
+                    os.remove(os.path.join(bucket_path, file_name))
+                    removed += 1
+        if removed:
+            logger.info('removed %d chunks left by interrupted ingests',
+                        removed)
+
+
+class ChunkIngest(object):
+    """Split a file into chunks in a worker thread, storing the new ones.
+
+    Has the same interface as filestore.AsyncCopy so that it can be
+    tracked as a transfer.
+    """
+
+    def __init__(self, src, completion, unlink_src=False, src_fd=None):
+        self.src = src if src is not None else '<fd %d>' % src_fd
+        self.completion = completion
+        self._unlink_src = unlink_src
+        self.src_fp = -1 if src_fd is None else src_fd
+        self.written = 0
+        self.size = 0
+        # [(digest, size)] in file order
+        self.chunks = []
+        # [(digest, size)] of the chunks that were not stored yet
+        self.new_chunks = []
+        # bytes of chunks that were not stored yet
+        self.stored = 0
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def _store_chunk(self, data):
+        digest = _get_digest(data)
+        self.chunks.append((digest, len(data)))
+        self.written += len(data)
+
+        chunk_path = layoutmanager.get_instance().get_chunk_path(digest)
+        if os.path.exists(chunk_path):
+            return
+
+        chunk_dir = os.path.dirname(chunk_path)
+        if not os.path.exists(chunk_dir):
+            os.makedirs(chunk_dir)
+        temp_path = os.path.join(chunk_dir, '.' + digest)
+        f = open(temp_path, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(temp_path, chunk_path)
+        self.new_chunks.append((digest, len(data)))
+        self.stored += len(data)
+
+    def _split(self):
+        buf = bytearray()
+        eof = False
+        while True:
+            if self._cancelled.is_set():
+                raise ChunkIngestCancelledError(
+                    'Ingest of %s cancelled' % self.src)
+
+            if not eof and len(buf) < _MAX_CHUNK:
+                data = os.read(self.src_fp, _READ_SIZE)
+                if data:
+                    buf += data
+                    continue
+                eof = True
+
+            if not buf:
+                return
+
+            cut = find_boundary(buf, len(buf))
+            self._store_chunk(bytes(buf[:cut]))
+            del buf[:cut]
+
+    def _run(self):
+        try:
+            self._split()
+        except Exception as err:
+            logger.error('CI: Error ingesting %s: %r', self.src, err)
+            GLib.idle_add(self._complete, err)
+            return
+
+        GLib.idle_add(self._complete, None)
+
+    def _complete(self, *args):
+        os.close(self.src_fp)
+        if self._unlink_src:
+            os.unlink(self.src)
+        self.completion(*args)
+        return False
+
+    def start(self):
+        if self.src_fp == -1:
+            self.src_fp = os.open(self.src, os.O_RDONLY)
+        self.size = os.fstat(self.src_fp).st_size
+
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
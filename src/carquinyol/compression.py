@@ -0,0 +1,161 @@
+import os
+import lzma
+import logging
+import struct
+import threading
+import zlib
+
+from gi.repository import GLib
+
+# Compressed data files start with a header naming the codec and the
+# logical (uncompressed) size of the data
+_MAGIC = b'SDZ1'
+_HEADER = struct.Struct('>4scQ')
+_CODECS = {
+    'zlib': b'z',
+    'lzma': b'x',
+}
+
+_READ_SIZE = 1024 * 1024
+
+# Keep the compressed copy only if it saves at least _n_ of the space
+_MIN_SAVINGS = 0.1
+
+COMPRESSIBLE_MIME_TYPES = [
+    'application/json',
+    'application/javascript',
+    'application/x-python',
+    'application/xml',
+    'application/vnd.olpc-sugar',
+    'image/svg+xml',
+]
+
+logger = logging.getLogger('compression')
+
+
+class CompressionCancelledError(Exception):
+    pass
+
+
+def is_compressible(mime_type):
+    if not mime_type:
+        return False
+    return mime_type.startswith('text/') or \
+        mime_type in COMPRESSIBLE_MIME_TYPES
+
+
+def _new_compressor(codec):
+    if codec == 'lzma':
+        return lzma.LZMACompressor()
+    return zlib.compressobj(6)
+
+
+def _new_decompressor(codec_id):
+    if codec_id == _CODECS['lzma']:
+        return lzma.LZMADecompressor()
+    return zlib.decompressobj()
+
+
+def get_size(path):
+    """Return the logical size of a compressed data file."""
+    f = open(path, 'rb')
+    try:
+        magic_, codec_id_, size = _HEADER.unpack(f.read(_HEADER.size))
+    finally:
+        f.close()
+    return size
+
+
+def decompress(path, destination_path):
+    """Write the data of a compressed data file to destination_path."""
+    src = open(path, 'rb')
+    dest = open(destination_path, 'wb')
+    try:
+        magic, codec_id, size_ = _HEADER.unpack(src.read(_HEADER.size))
+        if magic != _MAGIC:
+            raise ValueError('%r is not a compressed data file' % path)
+
+        decompressor = _new_decompressor(codec_id)
+        while True:
+            data = src.read(_READ_SIZE)
+            if not data:
+                break
+            dest.write(decompressor.decompress(data))
+        if hasattr(decompressor, 'flush'):
+            dest.write(decompressor.flush())
+    finally:
+        src.close()
+        dest.close()
+
+
+class CompressIngest(object):
+    """Compress a file in a worker thread.
+
+    Has the same interface as filestore.AsyncCopy so that it can be
+    tracked as a transfer. The source is left alone; worth_keeping tells
+    whether the compressed copy saves enough space once done.
+    """
+
+    def __init__(self, src, dest, codec, completion):
+        self.src = src
+        self.dest = dest
+        self.completion = completion
+        self.written = 0
+        self.size = 0
+        self.compressed_size = 0
+        self._codec = codec
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def get_worth_keeping(self):
+        return self.compressed_size <= self.size * (1 - _MIN_SAVINGS)
+
+    worth_keeping = property(get_worth_keeping)
+
+    def _compress(self):
+        compressor = _new_compressor(self._codec)
+        src = open(self.src, 'rb')
+        dest = open(self.dest, 'wb')
+        try:
+            dest.write(_HEADER.pack(_MAGIC, _CODECS[self._codec], self.size))
+            while True:
+                if self._cancelled.is_set():
+                    raise CompressionCancelledError(
+                        'Compression of %s cancelled' % self.src)
+                data = src.read(_READ_SIZE)
+                if not data:
+                    break
+                dest.write(compressor.compress(data))
+                self.written += len(data)
+            dest.write(compressor.flush())
+            self.compressed_size = dest.tell()
+        finally:
+            src.close()
+            dest.close()
+
+    def _run(self):
+        try:
+            self._compress()
+        except Exception as err:
+            logger.error('CI: Error compressing %s: %r', self.src, err)
+            GLib.idle_add(self._complete, err)
+            return
+
+        logger.debug('CI: compressed %s from %d to %d bytes with %s',
+                     self.src, self.size, self.compressed_size, self._codec)
+        GLib.idle_add(self._complete, None)
+
+    def _complete(self, *args):
+        if args and args[0] is not None and os.path.exists(self.dest):
+            os.unlink(self.dest)
+        self.completion(*args)
+        return False
+
+    def start(self):
+        self.size = os.stat(self.src).st_size
+
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
@@ -0,0 +1,250 @@
+import os
+import logging
+import tempfile
+import time
+
+from gi.repository import GLib
+
+from carquinyol import chunkstore
+from carquinyol import compression
+from carquinyol import extractors
+from carquinyol import hashing
+from carquinyol import layoutmanager
+from carquinyol import workerpool
+from carquinyol.persistentqueue import PersistentQueue
+
+# Don't extract the text of files larger than _n_ bytes
+_MAX_FILE_SIZE = 64 * 1024 * 1024
+# Keep at most _n_ characters of text per entry
+_MAX_TEXT_CHARS = 256 * 1024
+# Log the throughput every _n_ extracted entries
+_STATS_INTERVAL = 100
+# Skip up to _n_ entries without text per main loop iteration
+_SKIP_BATCH = 20
+
+_STATS_KEYS = ['extracted', 'unchanged', 'unsupported', 'failed',
+               'bytes', 'chars']
+
+logger = logging.getLogger('contentextractor')
+
+
+def _extract(source, mime_type, checksum):
+    """Return the checksum of entry data and its text, None in place of the
+       text if the data still has the given checksum.
+
+    Data stored compressed or in chunks, as told by a source returned by
+    FileStore.get_data_source(), is written out to a temporary file first.
+    """
+    start = time.monotonic()
+    kind, path = source
+    temp_path = None
+    if kind != 'file':
+        fd, temp_path = tempfile.mkstemp(prefix='sugar-datastore-extract-')
+        os.close(fd)
+    try:
+        if kind == 'compressed':
+            compression.decompress(path, temp_path)
+        elif kind == 'chunks':
+            chunkstore.assemble(path, temp_path)
+        file_path = temp_path or path
+
+        new_checksum = hashing.hash_file(file_path)
+        text = None
+        if new_checksum != checksum:
+            text = extractors.extract_text(file_path, mime_type,
+                                           _MAX_TEXT_CHARS)
+            if text is None:
+                text = ''
+    finally:
+        if temp_path is not None:
+            os.unlink(temp_path)
+    return new_checksum, text, time.monotonic() - start
+
+
+def read_extracted(path):
+    """Return the checksum of the data an extracted text file was made of
+       and the text, (None, None) if there is none.
+
+    """
+    if not os.path.exists(path):
+        return None, None
+    f = open(path, 'r', encoding='utf-8', errors='replace')
+    try:
+        checksum = f.readline().rstrip('\n')
+        return checksum, f.read()
+    finally:
+        f.close()
+
+
+class ContentExtractor(object):
+    """Extract the text of entry data so the index can search it.
+
+    Entries are queued when their data is saved and processed one at a
+    time by a worker process, with the extractor of their MIME type. The
+    text is kept in the entry directory, along with the checksum of the
+    data it was extracted from, so unchanged data is not extracted again
+    and the index can be rebuilt without extracting anything.
+    """
+
+    def __init__(self, file_store, metadata_store, index_store):
+        self._file_store = file_store
+        self._metadata_store = metadata_store
+        self._index_store = index_store
+        self._process_id = None
+        self._pool = None
+        self._busy_uid = None
+        self._busy_changed = False
+        self.stats = dict((key, 0) for key in _STATS_KEYS)
+        self.stats['seconds'] = 0.0
+
+        layout_manager = layoutmanager.get_instance()
+        queue_path = layout_manager.get_extraction_queue_path()
+        seed = not os.path.exists(queue_path)
+        self._queue = PersistentQueue(queue_path)
+        if seed:
+            # entries saved by earlier versions
+            for uid in layout_manager.find_all():
+                self._queue.append(uid)
+        self._schedule()
+
+    def extract(self, uid):
+        """Queue an entry whose data changed.
+
+        """
+        if uid == self._busy_uid:
+            self._busy_changed = True
+        self._queue.append(uid)
+        self._schedule()
+
+    def remove(self, uid):
+        self._queue.remove(uid)
+
+    def _schedule(self):
+        if self._process_id is None and self._busy_uid is None and \
+                self._queue:
+            self._process_id = GLib.idle_add(self._process_cb,
+                                             priority=GLib.PRIORITY_LOW)
+
+    def _process_cb(self):
+        skipped = 0
+        for uid in self._queue:
+            if self._file_store.is_busy(uid):
+                # queued again once the data is saved
+                continue
+            if self._submit(uid):
+                break
+            self._queue.remove(uid)
+            skipped += 1
+            if skipped == _SKIP_BATCH:
+                return True
+
+        self._process_id = None
+        return False
+
+    def _submit(self, uid):
+        entry_path = layoutmanager.get_instance().get_entry_path(uid)
+        if not os.path.exists(entry_path):
+            return False
+
+        mime_type = self._metadata_store.get_property(uid, 'mime_type')
+        if extractors.get_extractor(mime_type) is None or \
+                self._file_store.get_file_size(uid) > _MAX_FILE_SIZE:
+            self.stats['unsupported'] += 1
+            self._set_text(uid, None, None)
+            return False
+
+        source = self._file_store.get_data_source(uid)
+        if source is None:
+            self._set_text(uid, None, None)
+            return False
+
+        checksum, text_ = read_extracted(
+            layoutmanager.get_instance().get_extracted_path(uid))
+        if self._pool is None:
+            self._pool = workerpool.new_pool()
+        future = self._pool.submit(_extract, source, mime_type, checksum)
+        future.add_done_callback(
+            lambda future: GLib.idle_add(self._extracted_cb, uid, future))
+        self._busy_uid = uid
+        self._busy_changed = False
+        return True
+
+    def _extracted_cb(self, uid, future):
+        self._busy_uid = None
+
+        if self._busy_changed:
+            # extract the new data instead
+            self._queue.remove(uid)
+            self._queue.append(uid)
+            self._schedule()
+            return False
+
+        try:
+            checksum, text, seconds = future.result()
+        except Exception:
+            logger.exception('Error extracting the text of %r', uid)
+            self.stats['failed'] += 1
+        else:
+            self.stats['seconds'] += seconds
+            if text is None:
+                self.stats['unchanged'] += 1
+            else:
+                self.stats['extracted'] += 1
+                self.stats['bytes'] += self._file_store.get_file_size(uid)
+                self.stats['chars'] += len(text)
+                self._set_text(uid, checksum, text)
+                if self.stats['extracted'] % _STATS_INTERVAL == 0:
+                    self._log_stats()
+
+        self._queue.remove(uid)
+        if self._queue:
+            self._schedule()
+        else:
+            self._log_stats()
+        return False
+
+    def _set_text(self, uid, checksum, text):
+        """Save the text of an entry, or remove it if text is None, and
+           index the entry again.
+
+        """
+        extracted_path = layoutmanager.get_instance().get_extracted_path(uid)
+        if not os.path.exists(os.path.dirname(extracted_path)):
+            # deleted meanwhile
+            return
+        if text is None:
+            if not os.path.exists(extracted_path):
+                return
+            os.remove(extracted_path)
+        else:
+            temp_path = extracted_path + '.tmp'
+            f = open(temp_path, 'w', encoding='utf-8', errors='replace')
+            try:
+                f.write('%s\n%s' % (checksum, text))
+            finally:
+                f.close()
+            os.rename(temp_path, extracted_path)
+
+        try:
+            self._index_store.store(uid, self._metadata_store.retrieve(uid))
+        except Exception:
+            logger.exception('Error indexing the text of %r', uid)
+
+    def _log_stats(self):
+        stats = self.stats
+        rate = 0
+        if stats['seconds']:
+            rate = stats['bytes'] / stats['seconds'] / 1024
+        logger.info('text of %d entries extracted (%d unchanged, %d '
+                    'unsupported, %d failed), %d characters from %d bytes '
+                    'at %.1f KiB/s', stats['extracted'], stats['unchanged'],
+                    stats['unsupported'], stats['failed'], stats['chars'],
+                    stats['bytes'], rate)
+
+    def stop(self):
+        if self._process_id is not None:
+            GLib.source_remove(self._process_id)
+            self._process_id = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -18,6 +18,8 @@
 # pylint fails on @debian's arguments
 # pylint: disable=C0322
 
+import heapq
+import itertools
 import logging
 import uuid
 import time
@@ -25,6 +27,9 @@ import os
 import shutil
 import subprocess
 import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from stat import S_ISREG
 
 import dbus
 import dbus.service
@@ -39,6 +44,12 @@ from carquinyol.metadatastore import MetadataStore
 from carquinyol.indexstore import IndexStore
 from carquinyol.filestore import FileStore
 from carquinyol.optimizer import Optimizer
+from carquinyol.dedupscan import DedupScan
+from carquinyol.mountedstore import MountedStore
+from carquinyol import querypool
+from carquinyol.querypool import QueryPool
+from carquinyol.indexcompactor import IndexCompactor
+from carquinyol.contentextractor import ContentExtractor
 
 # the name used by the logger
 DS_SERVICE = "org.laptop.sugar.DataStore"
@@ -46,6 +57,12 @@ DS_DBUS_INTERFACE = "org.laptop.sugar.DataStore"
 DS_OBJECT_PATH = "/org/laptop/sugar/DataStore"
 MIN_INDEX_FREE_BYTES = 1024 * 1024 * 5
 
+# Search up to _n_ data stores at the same time
+_FIND_WORKERS = 4
+
+# Index entries again for new sort properties _n_ at a time
+_REINDEX_BATCH = 20
+
 logger = logging.getLogger('datastore')
 
 
@@ -63,13 +80,32 @@ class DataStore(dbus.service.Object):
         migrated, initiated = self._open_layout()
 
         self._metadata_store = MetadataStore()
-        self._file_store = FileStore()
+        self._file_store = FileStore(self._metadata_store,
+                                     progress_cb=self.Progress,
+                                     caller_alive_cb=self._is_connected)
         self._optimizer = Optimizer(self._file_store, self._metadata_store)
+        self._dedup_scan = None
+        self._fanout_migration = None
+        self._start_fanout_migration()
+        # mount id -> MountedStore
+        self._mounts = OrderedDict()
+        self._next_mount_id = 2
+        self._find_executor = None
         self._index_store = IndexStore()
         self._index_updating = False
+        self._query_pool = None
+        workers = querypool.get_worker_count(
+            layoutmanager.get_instance().get_option('query_workers'))
+        if workers > 1:
+            self._query_pool = QueryPool(self._index_store, workers)
 
         root_path = layoutmanager.get_instance().get_root_path()
         self._cleanflag = os.path.join(root_path, 'ds_clean')
+        # creates, updates and deletes under way
+        self._writes = 0
+        self._index_compactor = IndexCompactor(self._index_store, root_path)
+        self._content_extractor = ContentExtractor(
+            self._file_store, self._metadata_store, self._index_store)
 
         if initiated:
             logger.debug('Initiate datastore')
@@ -108,11 +144,27 @@ class DataStore(dbus.service.Object):
                 logger.exception('Failed to open index')
                 # try...
                 self._rebuild_index()
+            else:
+                if self._index_store.damaged_shards:
+                    logger.warn('Reindexing entries of damaged index shards'
+                                ' %r', self._index_store.damaged_shards)
+                    self._update_index()
+                self._start_schema_reindex()
 
         self._mark_clean()
         return
 
     def _mark_clean(self):
+        # metadata writes are coalesced, only flag the datastore clean once
+        # they have hit the disk and no other write is under way
+        self._finish_write()
+        if not self._writes:
+            self._metadata_store.call_when_flushed(self._write_clean_flag)
+
+    def _finish_write(self):
+        self._writes = max(self._writes - 1, 0)
+
+    def _write_clean_flag(self):
         try:
             f = open(self._cleanflag, 'w')
             os.fsync(f.fileno())
@@ -121,6 +173,8 @@ class DataStore(dbus.service.Object):
             logger.exception("Could not mark the datastore clean")
 
     def _mark_dirty(self):
+        self._writes += 1
+        self._metadata_store.cancel_when_flushed(self._write_clean_flag)
         try:
             os.remove(self._cleanflag)
         except BaseException:
@@ -137,6 +191,8 @@ class DataStore(dbus.service.Object):
         layout_manager = layoutmanager.get_instance()
 
         if layout_manager.is_empty():
+            layout_manager.set_fanout(*layout_manager.get_configured_fanout())
+            layout_manager.save_fanout()
             layout_manager.set_version(layoutmanager.CURRENT_LAYOUT_VERSION)
             return False, True
 
@@ -144,16 +200,90 @@ class DataStore(dbus.service.Object):
         if old_version == layoutmanager.CURRENT_LAYOUT_VERSION:
             return False, False
 
+        if old_version == 6:
+            migration.migrate_from_6()
+            layout_manager.set_version(layoutmanager.CURRENT_LAYOUT_VERSION)
+            return False, False
+
         if old_version == 0:
             migration.migrate_from_0()
 
+        layout_manager.save_fanout()
         layout_manager.set_version(layoutmanager.CURRENT_LAYOUT_VERSION)
         return True, False
 
+    def _start_fanout_migration(self):
+        """Move the entries to the fan-out set in the options, if it changed.
+
+        """
+        layout_manager = layoutmanager.get_instance()
+        if layout_manager.get_previous_fanout() is None:
+            fanout = layout_manager.get_configured_fanout()
+            if fanout == layout_manager.get_fanout():
+                return
+            logger.info('Changing fan-out from %r to %r',
+                        layout_manager.get_fanout(), fanout)
+            layout_manager.set_fanout(*fanout)
+            if layout_manager.get_previous_fanout() is None:
+                # no entries to move
+                return
+
+        self._fanout_migration = migration.FanoutMigration(
+            self._file_store.is_busy)
+        GLib.idle_add(self._migrate_fanout_cb, priority=GLib.PRIORITY_LOW)
+
+    def _migrate_fanout_cb(self):
+        if self._fanout_migration.step():
+            return True
+        delay = self._fanout_migration.retry_delay
+        if delay is None:
+            self._fanout_migration = None
+        else:
+            GLib.timeout_add_seconds(delay, self._retry_fanout_migration_cb)
+        return False
+
+    def _retry_fanout_migration_cb(self):
+        GLib.idle_add(self._migrate_fanout_cb, priority=GLib.PRIORITY_LOW)
+        return False
+
+    def _start_schema_reindex(self):
+        """Index again the entries with properties that were given a value
+           slot since they were indexed.
+
+        """
+        names = self._index_store.schema.pending
+        if not names:
+            return
+        logger.info('Indexing new sort properties %r', names)
+        uids = layoutmanager.get_instance().find_all()
+        GLib.idle_add(self._schema_reindex_cb, uids, names,
+                      priority=GLib.PRIORITY_LOW)
+
+    def _schema_reindex_cb(self, uids, names):
+        if self._index_updating:
+            # the rebuild indexes every property
+            return False
+
+        for uid in uids[-_REINDEX_BATCH:]:
+            try:
+                props = self._metadata_store.retrieve(uid)
+                if [name for name in names if name in props]:
+                    self._index_store.store(uid, props)
+            except Exception:
+                logger.exception('Error indexing %r again', uid)
+        del uids[-_REINDEX_BATCH:]
+
+        if uids:
+            return True
+        self._index_store.schema.set_indexed()
+        logger.info('Indexed new sort properties %r', names)
+        return False
+
     def _rebuild_index(self):
         """Remove and recreate index."""
         self._index_store.close_index()
         self._index_store.remove_index()
+        self._index_store.schema.set_indexed()
 
         # rebuild the index in tmpfs to better handle ENOSPC
         temp_index_path = tempfile.mkdtemp(prefix='sugar-datastore-index-')
@@ -214,9 +344,9 @@ class DataStore(dbus.service.Object):
                     update_metadata = False
                     props = self._metadata_store.retrieve(uid)
                     if 'filesize' not in props:
-                        path = self._file_store.get_file_path(uid)
-                        if os.path.exists(path):
-                            props['filesize'] = os.stat(path).st_size
+                        if self._file_store.has_data(uid):
+                            props['filesize'] = \
+                                self._file_store.get_file_size(uid)
                             update_metadata = True
                     if 'timestamp' not in props:
                         props['timestamp'] = str(int(time.time()))
@@ -246,6 +376,8 @@ class DataStore(dbus.service.Object):
                         entry_path = \
                             layoutmanager.get_instance().get_entry_path(uid)
                         shutil.rmtree(entry_path)
+                        layoutmanager.get_instance().remove_entry(
+                            uid, entry_path)
                     except Exception:
                         logger.exception('Error deleting corrupt entry %r',
                                           uid)
@@ -258,15 +390,57 @@ class DataStore(dbus.service.Object):
         else:
             return True
 
+    def _set_time_props(self, props):
+        if not props.get('timestamp', ''):
+            props['timestamp'] = int(time.time())
+
+        # FIXME: Support for the deprecated ctime property. Remove in 0.92.
+        if 'ctime' in props:
+            try:
+                props['creation_time'] = time.mktime(time.strptime(
+                    migration.DATE_FORMAT, props['ctime']))
+            except (TypeError, ValueError):
+                pass
+
+        if 'creation_time' not in props:
+            props['creation_time'] = props['timestamp']
+
+    def _get_fd_size(self, fd):
+        stat = os.fstat(fd)
+        if S_ISREG(stat.st_mode):
+            return stat.st_size
+        # streamed data, the size is only known once it has been stored
+        return 0
+
+    def _fd_stored_cb(self, completion_cb, uid, exc=None):
+        """Record the real size of data read from a file descriptor."""
+        if exc is None:
+            try:
+                filesize = self._file_store.get_file_size(uid)
+                if self._metadata_store.get_property(uid, 'filesize') != \
+                        str(filesize):
+                    self._metadata_store.set_property(uid, 'filesize',
+                                                      filesize)
+                    self._index_store.store(
+                        uid, self._metadata_store.retrieve(uid))
+            except Exception as e:
+                logger.exception('Error updating filesize of %r', uid)
+                exc = e
+
+        completion_cb(uid, exc)
+
     def _create_completion_cb(self, async_cb, async_err_cb, uid, exc=None):
         logger.debug('_create_completion_cb(%r, %r, %r, %r)', async_cb,
                      async_err_cb, uid, exc)
         if exc is not None:
+            # left dirty
+            self._finish_write()
             async_err_cb(exc)
             return
 
         self.Created(uid)
         self._optimizer.optimize(uid)
+        self._content_extractor.extract(uid)
         logger.debug('created %s', uid)
         self._mark_clean()
         async_cb(uid)
@@ -282,34 +456,65 @@ class DataStore(dbus.service.Object):
         logger.debug('datastore.create %r', uid)
 
         self._mark_dirty()
+        try:
+            layoutmanager.get_instance().add_entry(uid)
 
-        if not props.get('timestamp', ''):
-            props['timestamp'] = int(time.time())
+            self._set_time_props(props)
 
-        # FIXME: Support for the deprecated ctime property. Remove in 0.92.
-        if 'ctime' in props:
-            try:
-                props['creation_time'] = time.mktime(time.strptime(
-                    migration.DATE_FORMAT, props['ctime']))
-            except (TypeError, ValueError):
-                pass
+            if os.path.exists(file_path):
+                stat = os.stat(file_path)
+                props['filesize'] = stat.st_size
+            else:
+                props['filesize'] = 0
 
-        if 'creation_time' not in props:
-            props['creation_time'] = props['timestamp']
+            self._metadata_store.store(uid, props)
+            # on disk before the entry is indexed and the call returns
+            self._metadata_store.flush_entry(uid)
+            self._index_store.store(uid, props)
+            self._file_store.store(
+                uid, file_path, transfer_ownership,
+                lambda * args: self._create_completion_cb(async_cb,
+                                                          async_err_cb,
+                                                          uid, * args))
+        except BaseException:
+            self._finish_write()
+            raise
 
-        if os.path.exists(file_path):
-            stat = os.stat(file_path)
-            props['filesize'] = stat.st_size
-        else:
-            props['filesize'] = 0
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='a{sv}h',
+                         out_signature='s',
+                         async_callbacks=('async_cb', 'async_err_cb'),
+                         byte_arrays=True)
+    def create_from_fd(self, props, fd, async_cb, async_err_cb):
+        """Create an entry reading its data from a file descriptor.
+
+        Avoids staging the data in a temporary file: a regular file is
+        cloned or copied in place, a pipe is streamed until end of file.
+        """
+        fd = fd.take()
+        uid = str(uuid.uuid4())
+        logger.debug('datastore.create_from_fd %r', uid)
 
-        self._metadata_store.store(uid, props)
-        self._index_store.store(uid, props)
-        self._file_store.store(
-            uid, file_path, transfer_ownership,
-            lambda * args: self._create_completion_cb(async_cb,
-                                                      async_err_cb,
-                                                      uid, * args))
+        self._mark_dirty()
+        try:
+            layoutmanager.get_instance().add_entry(uid)
+            self._set_time_props(props)
+            props['filesize'] = self._get_fd_size(fd)
+
+            self._metadata_store.store(uid, props)
+            # on disk before the entry is indexed and the call returns
+            self._metadata_store.flush_entry(uid)
+            self._index_store.store(uid, props)
+            self._file_store.store_fd(
+                uid, fd,
+                lambda * args: self._fd_stored_cb(
+                    lambda * args: self._create_completion_cb(async_cb,
+                                                              async_err_cb,
+                                                              * args),
+                    uid, * args))
+        except BaseException:
+            self._finish_write()
+            raise
 
     @dbus.service.signal(DS_DBUS_INTERFACE, signature="s")
     def Created(self, uid):
@@ -319,11 +524,14 @@ class DataStore(dbus.service.Object):
         logger.debug('_update_completion_cb() called with %r / %r, exc %r',
                      async_cb, async_err_cb, exc)
         if exc is not None:
+            # left dirty
+            self._finish_write()
             async_err_cb(exc)
             return
 
         self.Updated(uid)
         self._optimizer.optimize(uid)
+        self._content_extractor.extract(uid)
         logger.debug('updated %s', uid)
         self._mark_clean()
         async_cb()
@@ -338,56 +546,175 @@ class DataStore(dbus.service.Object):
         logger.debug('datastore.update %r', uid)
 
         self._mark_dirty()
+        try:
+            self._set_time_props(props)
+
+            if file_path:
+                # Empty file_path means skipping storage stage, see
+                # filestore.py
+                # TODO would be more useful to update filesize after real
+                # file save
+                if os.path.exists(file_path):
+                    stat = os.stat(file_path)
+                    props['filesize'] = stat.st_size
+                else:
+                    props['filesize'] = 0
+
+            self._metadata_store.store(uid, props)
+            # on disk before the entry is indexed and the call returns
+            self._metadata_store.flush_entry(uid)
+            self._index_store.store(uid, props)
+
+            if os.path.exists(self._file_store.get_file_path(uid)) and \
+                    (not file_path or os.path.exists(file_path)):
+                self._optimizer.remove(uid)
+            self._file_store.store(
+                uid, file_path, transfer_ownership,
+                lambda * args: self._update_completion_cb(async_cb,
+                                                          async_err_cb,
+                                                          uid, * args))
+        except BaseException:
+            self._finish_write()
+            raise
 
-        if not props.get('timestamp', ''):
-            props['timestamp'] = int(time.time())
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='sa{sv}h',
+                         out_signature='',
+                         async_callbacks=('async_cb', 'async_err_cb'),
+                         byte_arrays=True)
+    def update_from_fd(self, uid, props, fd, async_cb, async_err_cb):
+        """Update an entry reading its new data from a file descriptor."""
+        fd = fd.take()
+        logger.debug('datastore.update_from_fd %r', uid)
 
-        # FIXME: Support for the deprecated ctime property. Remove in 0.92.
-        if 'ctime' in props:
-            try:
-                props['creation_time'] = time.mktime(time.strptime(
-                    migration.DATE_FORMAT, props['ctime']))
-            except (TypeError, ValueError):
-                pass
+        self._mark_dirty()
+        try:
+            self._set_time_props(props)
+            props['filesize'] = self._get_fd_size(fd)
+
+            self._metadata_store.store(uid, props)
+            # on disk before the entry is indexed and the call returns
+            self._metadata_store.flush_entry(uid)
+            self._index_store.store(uid, props)
+
+            if os.path.exists(self._file_store.get_file_path(uid)):
+                self._optimizer.remove(uid)
+            self._file_store.store_fd(
+                uid, fd,
+                lambda * args: self._fd_stored_cb(
+                    lambda * args: self._update_completion_cb(async_cb,
+                                                              async_err_cb,
+                                                              * args),
+                    uid, * args))
+        except BaseException:
+            self._finish_write()
+            raise
 
-        if 'creation_time' not in props:
-            props['creation_time'] = props['timestamp']
+    @dbus.service.signal(DS_DBUS_INTERFACE, signature="s")
+    def Updated(self, uid):
+        pass
 
-        if file_path:
-            # Empty file_path means skipping storage stage, see filestore.py
-            # TODO would be more useful to update filesize after real file save
-            if os.path.exists(file_path):
-                stat = os.stat(file_path)
-                props['filesize'] = stat.st_size
-            else:
-                props['filesize'] = 0
+    @dbus.service.signal(DS_DBUS_INTERFACE, signature="stt")
+    def Progress(self, uid, written, total):
+        pass
 
-        self._metadata_store.store(uid, props)
-        self._index_store.store(uid, props)
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='s',
+                         out_signature='')
+    def cancel(self, uid):
+        """Cancel the pending writes of data to an entry.
 
-        if os.path.exists(self._file_store.get_file_path(uid)) and \
-                (not file_path or os.path.exists(file_path)):
-            self._optimizer.remove(uid)
-        self._file_store.store(
-            uid, file_path, transfer_ownership,
-            lambda * args: self._update_completion_cb(async_cb,
-                                                      async_err_cb,
-                                                      uid, * args))
+        The calls that started them fail with a cancellation error.
+        """
+        logger.debug('datastore.cancel %r', uid)
+        self._file_store.cancel(uid)
 
-    @dbus.service.signal(DS_DBUS_INTERFACE, signature="s")
-    def Updated(self, uid):
-        pass
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='a{sv}',
+                         out_signature='a{sv}',
+                         async_callbacks=('async_cb', 'async_err_cb'))
+    def optimize_store(self, options, async_cb, async_err_cb):
+        """Look for duplicates among all entries and share their storage.
+
+        Options are max_rate, the bytes per second to read at most, workers,
+        the number of hashing processes, and rehash, to hash again the
+        entries with a known checksum. Replies with a report of the scan
+        once it is done; calls made while a scan runs join it.
+        """
+        def completion_cb(report):
+            async_cb(dict((key, dbus.UInt64(value))
+                          for key, value in report.items()))
+
+        if self._dedup_scan is None:
+            logger.debug('datastore.optimize_store %r', options)
+            self._dedup_scan = DedupScan(
+                self._metadata_store, self._file_store, self._optimizer,
+                max_rate=int(options.get('max_rate', 0)) or None,
+                workers=int(options.get('workers', 0)) or None,
+                rehash=bool(options.get('rehash', False)))
+            self._dedup_scan.add_completion_cb(self._dedup_scan_done_cb)
+            self._dedup_scan.start()
+        self._dedup_scan.add_completion_cb(completion_cb)
+
+    def _dedup_scan_done_cb(self, report):
+        self._dedup_scan = None
+
+    def _query_index(self, query, callback):
+        """Run a query on the query workers if there are some, calling
+           callback with the result once done, or with None for the query
+           to be run on the main process.
+
+        """
+        if self._query_pool is None or self._index_updating:
+            callback(None)
+            return
+
+        def found_cb(result, exc):
+            if exc is not None:
+                logger.error('Query worker failed: %s, querying again', exc)
+            callback(result)
+
+        self._query_pool.find(query, found_cb)
 
     @dbus.service.method(DS_DBUS_INTERFACE,
                          in_signature='a{sv}as',
-                         out_signature='aa{sv}u')
-    def find(self, query, properties):
+                         out_signature='aa{sv}u',
+                         async_callbacks=('async_cb', 'async_err_cb'))
+    def find(self, query, properties, async_cb, async_err_cb):
         logger.debug('datastore.find %r', query)
+
+        # mounted data stores are left out until indexed
+        mounts = [store for store in self._mounts.values() if store.ready]
+        if mounts and not self._index_updating:
+            try:
+                async_cb(*self._find_mounted(query, properties, mounts))
+            except Exception as e:
+                async_err_cb(e)
+            return
+
+        def found_cb(result):
+            try:
+                entries, count = self._find(query, properties, result)
+            except Exception as e:
+                async_err_cb(e)
+                return
+            async_cb(entries, count)
+
+        self._query_index(query, found_cb)
+
+    def _find(self, query, properties, result=None):
+        """Return the entries matching a query, given the result of
+           querying the index if it was done by the query workers.
+
+        """
         t = time.time()
+        pooled = result is not None
 
         if not self._index_updating:
             try:
-                uids, count = self._index_store.find(query)
+                if result is None:
+                    result = self._index_store.find(query)
+                uids, count = result
                 uids = [uid.decode() for uid in uids]
             except Exception:
                 logger.exception('Failed to query index, will rebuild')
@@ -401,6 +728,10 @@ class DataStore(dbus.service.Object):
         for uid in uids:
             entry_path = layoutmanager.get_instance().get_entry_path(uid)
             if not os.path.exists(entry_path):
+                if pooled:
+                    # deleted since the query was handed to the workers
+                    logger.debug('%r deleted meanwhile, querying again', uid)
+                    return self._find(query, properties)
                 logger.warning(
                     'Inconsistency detected, returning all entries')
                 self._rebuild_index()
@@ -414,6 +745,75 @@ class DataStore(dbus.service.Object):
 
         return entries, count
 
+    def _find_mounted(self, query, properties, mounts):
+        """Search the main and the given mounted data stores in parallel and
+           merge the results in sort order.
+
+        """
+        offset = query.get('offset', 0)
+        limit = query.get('limit', MAX_QUERY_LIMIT)
+        order_by = query.get('order_by', [])
+        order_by = order_by[0] if order_by else '+timestamp'
+
+        # each store returns its first offset + limit results
+        store_query = dict(query)
+        store_query['offset'] = 0
+        store_query['limit'] = offset + limit
+
+        stores = [None] + mounts
+        if self._find_executor is None:
+            self._find_executor = ThreadPoolExecutor(
+                max_workers=_FIND_WORKERS)
+        futures = []
+        for store in stores:
+            find = self._index_store.find if store is None else store.find
+            futures.append(self._find_executor.submit(
+                find, dict(store_query), True))
+
+        results = []
+        count = 0
+        for store, future in zip(stores, futures):
+            try:
+                hits, store_count = future.result()
+            except Exception:
+                if store is None:
+                    raise
+                logger.exception('Failed to query %s', store.root_path)
+                continue
+            count += store_count
+            results.append([(value, store, uid.decode())
+                            for uid, value in hits])
+
+        # '+' means newest or largest first, as in IndexStore.find()
+        merged = heapq.merge(*results, key=lambda hit: hit[0],
+                             reverse=order_by.startswith('+'))
+
+        entries = []
+        for value_, store, uid in itertools.islice(merged, offset,
+                                                   offset + limit):
+            if store is None:
+                metadata = self._metadata_store.retrieve(uid, properties)
+                self._fill_internal_props(metadata, uid, properties)
+            else:
+                metadata = store.retrieve(uid, properties)
+            entries.append(metadata)
+
+        return entries, count
+
+    def _get_mounted_store(self, uid):
+        """Return the mounted data store holding an entry that is not in the
+           main one, if any.
+
+        """
+        if not self._mounts or \
+                os.path.exists(
+                    layoutmanager.get_instance().get_entry_path(uid)):
+            return None
+        for store in self._mounts.values():
+            if store.has_entry(uid):
+                return store
+        return None
+
     def _find_all(self, query, properties):
         uids = layoutmanager.get_instance().find_all()
         count = len(uids)
@@ -440,20 +840,57 @@ class DataStore(dbus.service.Object):
             metadata['uid'] = uid
 
         if not names or 'filesize' in names:
-            file_path = self._file_store.get_file_path(uid)
-            if os.path.exists(file_path):
-                stat = os.stat(file_path)
-                metadata['filesize'] = str(stat.st_size)
-            else:
-                metadata['filesize'] = '0'
+            metadata['filesize'] = str(self._file_store.get_file_size(uid))
 
     @dbus.service.method(DS_DBUS_INTERFACE,
                          in_signature='a{sv}',
+                         out_signature='as',
+                         async_callbacks=('async_cb', 'async_err_cb'))
+    def find_ids(self, query, async_cb, async_err_cb):
+        def found_cb(result):
+            async_cb(self._find_ids(query, result))
+
+        self._query_index(query, found_cb)
+
+    def _find_ids(self, query, result=None):
+        if not self._index_updating:
+            try:
+                if result is None:
+                    result = self._index_store.find(query)
+                return result[0]
+            except Exception:
+                logger.error('Failed to query index, will rebuild')
+                self._rebuild_index()
+        return []
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='sas',
+                         out_signature='aa{sv}')
+    def get_versions(self, tree_id, properties):
+        """Return the entries saved with a given tree_id, the most recent
+           first. An entry saved without tree_id starts a tree whose id is
+           its uid.
+
+        """
+        if self._index_updating:
+            logger.warning('Index updating, returning no versions')
+            return []
+        query = {'tree_id': tree_id, 'order_by': ['+timestamp']}
+        entries, count_ = self._find(query, properties)
+        return entries
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='su',
                          out_signature='as')
-    def find_ids(self, query):
+    def suggest(self, prefix, limit):
+        """Return the uids of the most recent entries with words in their
+           title, tags or description starting with the words typed so far.
+
+        """
         if not self._index_updating:
             try:
-                return self._index_store.find(query)[0]
+                return [uid.decode()
+                        for uid in self._index_store.suggest(prefix, limit)]
             except Exception:
                 logger.error('Failed to query index, will rebuild')
                 self._rebuild_index()
@@ -466,11 +903,24 @@ class DataStore(dbus.service.Object):
     def get_filename(self, uid, sender=None):
         logger.debug('datastore.get_filename %r', uid)
         user_id = dbus.Bus().get_unix_user(sender)
-        extension = self._get_extension(uid)
-        return self._file_store.retrieve(uid, user_id, extension)
-
-    def _get_extension(self, uid):
+        mounted_store = self._get_mounted_store(uid)
+        if mounted_store is not None:
+            # the caller deletes what it gets, never hand out the real file
+            file_path = mounted_store.get_file_path(uid)
+            if not file_path:
+                return ''
+            metadata = mounted_store.retrieve(uid, ['mime_type'])
+            extension = self._get_extension(metadata.get('mime_type'))
+            return self._file_store.export(uid, file_path, user_id,
+                                           extension, sender, copy=True)
         mime_type = self._metadata_store.get_property(uid, 'mime_type')
+        extension = self._get_extension(mime_type)
+        return self._file_store.retrieve(uid, user_id, extension, sender)
+
+    def _is_connected(self, name):
+        return dbus.Bus().name_has_owner(name)
+
+    def _get_extension(self, mime_type):
         if mime_type is None or not mime_type:
             return ''
         return mime.get_primary_extension(mime_type)
@@ -480,10 +930,34 @@ class DataStore(dbus.service.Object):
                          out_signature='a{sv}')
     def get_properties(self, uid):
         logger.debug('datastore.get_properties %r', uid)
+        mounted_store = self._get_mounted_store(uid)
+        if mounted_store is not None:
+            return mounted_store.retrieve(uid)
         metadata = self._metadata_store.retrieve(uid)
         self._fill_internal_props(metadata, uid)
         return metadata
 
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='a{sv}a{sv}',
+                         out_signature='aa{sv}')
+    def aggregate(self, query, spec):
+        """Count the entries matching a query, and optionally sum one of
+           their properties, per value of a property or per interval of a
+           date, e.g. {'group_by': 'timestamp', 'interval': 'month'} or
+           {'group_by': 'activity', 'sum': 'filesize'}.
+
+        """
+        if self._index_updating:
+            logger.warning('Index updating, returning no aggregates')
+            return []
+        groups = []
+        for key, count, total in self._index_store.aggregate(query, spec):
+            group = {'key': key, 'count': dbus.UInt64(count)}
+            if spec.get('sum'):
+                group['sum'] = dbus.Double(total)
+            groups.append(group)
+        return groups
+
     @dbus.service.method(DS_DBUS_INTERFACE,
                          in_signature='sa{sv}',
                          out_signature='as')
@@ -506,6 +980,7 @@ class DataStore(dbus.service.Object):
         try:
             entry_path = layoutmanager.get_instance().get_entry_path(uid)
             self._optimizer.remove(uid)
+            self._content_extractor.remove(uid)
             self._index_store.delete(uid)
             self._file_store.delete(uid)
             self._metadata_store.delete(uid)
@@ -516,8 +991,10 @@ class DataStore(dbus.service.Object):
                 os.removedirs(os.path.dirname(entry_path))
             except BaseException:
                 pass
+            layoutmanager.get_instance().remove_entry(uid, entry_path)
         except BaseException:
             logger.exception('Exception deleting entry')
+            self._finish_write()
             raise
 
         self.Deleted(uid)
@@ -530,6 +1007,15 @@ class DataStore(dbus.service.Object):
 
     def stop(self):
         """shutdown the service"""
+        if self._dedup_scan is not None:
+            self._dedup_scan.stop()
+        for mount_id in list(self._mounts):
+            self._mounts.pop(mount_id).close()
+        if self._query_pool is not None:
+            self._query_pool.close()
+        self._index_compactor.stop()
+        self._content_extractor.stop()
+        self._metadata_store.flush()
         self._index_store.close_index()
         self.Stopped()
 
@@ -541,19 +1027,43 @@ class DataStore(dbus.service.Object):
                          in_signature="sa{sv}",
                          out_signature='s')
     def mount(self, uri, options=None):
-        return ''
+        """Search the data store at uri, a path or file:// URI, along with
+           this one. Returns the id of the mount point.
+
+        """
+        if uri.startswith('file://'):
+            uri = uri[len('file://'):]
+        root_path = os.path.abspath(uri)
+
+        for store in self._mounts.values():
+            if store.root_path == root_path:
+                return store.mount_id
+
+        mount_id = str(self._next_mount_id)
+        store = MountedStore(mount_id, root_path)
+        self._next_mount_id += 1
+        self._mounts[mount_id] = store
+        logger.debug('datastore.mount %r as %r', root_path, mount_id)
+        self.Mounted(store.get_descriptor())
+        return mount_id
 
     @dbus.service.method(DS_DBUS_INTERFACE,
                          in_signature="",
                          out_signature="aa{sv}")
     def mounts(self):
-        return [{'id': 1}]
+        return [{'id': 1}] + [store.get_descriptor()
+                              for store in self._mounts.values()]
 
     @dbus.service.method(DS_DBUS_INTERFACE,
                          in_signature="s",
                          out_signature="")
     def unmount(self, mountpoint_id):
-        pass
+        store = self._mounts.pop(mountpoint_id, None)
+        if store is None:
+            raise ValueError('Unknown mount point %r' % mountpoint_id)
+        store.close()
+        logger.debug('datastore.unmount %r', mountpoint_id)
+        self.Unmounted(store.get_descriptor())
 
     @dbus.service.signal(DS_DBUS_INTERFACE, signature="a{sv}")
     def Mounted(self, descriptior):
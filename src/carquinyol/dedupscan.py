@@ -0,0 +1,252 @@
+import os
+import json
+import logging
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+from gi.repository import GLib
+
+from carquinyol import hashing
+from carquinyol import layoutmanager
+from carquinyol import workerpool
+
+# Stat up to _n_ entries per main loop iteration
+_STAT_BATCH = 200
+# Save the progress of the scan every _n_ hashed entries
+_SAVE_INTERVAL = 50
+
+_REPORT_KEYS = ['entries', 'candidates', 'hashed', 'hashed_bytes',
+                'duplicates', 'reclaimed_bytes']
+
+logger = logging.getLogger('dedupscan')
+
+
+class DedupScan(object):
+    """Look for duplicates among all the entries of the data store.
+
+    Only entries sharing their size with another entry are hashed, on a
+    pool of worker processes that read at most max_rate bytes per second
+    in total. Duplicates are hard linked through the optimizer, or moved to
+    the blob store when the data store is content addressed.
+
+    Checksums are recorded as they are calculated, so a scan that is
+    interrupted does not hash the same entries again when started anew;
+    the report of the interrupted scan is kept in checksums/scan.
+    """
+
+    def __init__(self, metadata_store, file_store, optimizer, max_rate=None,
+                 workers=None, rehash=False):
+        self._metadata_store = metadata_store
+        self._file_store = file_store
+        self._optimizer = optimizer
+        self._workers = workers or os.cpu_count() or 1
+        self._max_rate = max_rate
+        self._rehash = rehash
+        self._completion_cbs = []
+        self._state_path = os.path.join(
+            layoutmanager.get_instance().get_checksums_dir(), 'scan')
+        self._report = dict((key, 0) for key in _REPORT_KEYS)
+        self._elapsed = 0
+        self._start_time = None
+        self._pool = None
+        self._pending_uids = []
+        # size -> uids
+        self._sizes = {}
+        self._to_hash = []
+        self._in_flight = 0
+        self._unsaved = 0
+        self._stopped = False
+
+        if os.path.exists(self._state_path):
+            try:
+                state = json.load(open(self._state_path, 'r'))
+                self._report.update(state['report'])
+                self._elapsed = state['elapsed']
+                logger.info('resuming interrupted scan')
+            except (IOError, ValueError, KeyError):
+                logger.exception('Can not read scan state, starting afresh')
+
+    def add_completion_cb(self, completion_cb):
+        self._completion_cbs.append(completion_cb)
+
+    def start(self):
+        self._start_time = time.monotonic()
+        self._pending_uids = layoutmanager.get_instance().find_all()
+        # finished scans count the entries anew
+        self._report['entries'] = 0
+        self._report['candidates'] = 0
+        GLib.idle_add(self._stat_cb, priority=GLib.PRIORITY_LOW)
+
+    def stop(self):
+        """Stop the scan, leaving it to be resumed later.
+
+        """
+        if self._stopped:
+            return
+        self._stopped = True
+        self._save()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _get_file_stat(self, uid):
+        file_path = self._file_store.get_file_path(uid)
+        try:
+            return os.stat(file_path)
+        except OSError:
+            # no data or stored in another form
+            return None
+
+    def _stat_cb(self):
+        if self._stopped:
+            return False
+
+        batch = self._pending_uids[:_STAT_BATCH]
+        del self._pending_uids[:_STAT_BATCH]
+        for uid in batch:
+            stat = self._get_file_stat(uid)
+            if stat is None or not stat.st_size:
+                continue
+            self._report['entries'] += 1
+            self._sizes.setdefault(stat.st_size, []).append(uid)
+
+        if self._pending_uids:
+            return True
+
+        for size, uids in sorted(self._sizes.items()):
+            if len(uids) < 2:
+                continue
+            self._report['candidates'] += len(uids)
+            for uid in uids:
+                checksum = None if self._rehash else \
+                    self._get_known_checksum(uid)
+                if checksum is None:
+                    self._to_hash.append(uid)
+        self._sizes = {}
+
+        logger.debug('%d entries to hash', len(self._to_hash))
+        if self._to_hash:
+            self._pool = workerpool.new_pool(self._workers)
+        self._submit()
+        return False
+
+    def _get_known_checksum(self, uid):
+        if not self._file_store.content_addressed:
+            return self._optimizer.get_checksum(uid)
+
+        checksum = self._metadata_store.get_property(uid, 'checksum')
+        if checksum is None:
+            return None
+        blob_path = layoutmanager.get_instance().get_blob_path(checksum)
+        file_path = self._file_store.get_file_path(uid)
+        if os.path.exists(blob_path) and \
+                os.path.samefile(blob_path, file_path):
+            return checksum
+        return None
+
+    def _submit(self):
+        worker_rate = None
+        if self._max_rate:
+            worker_rate = self._max_rate / float(self._workers)
+
+        while self._to_hash and self._in_flight < self._workers * 2:
+            uid = self._to_hash.pop(0)
+            stat = self._get_file_stat(uid)
+            if stat is None or self._file_store.is_busy(uid):
+                continue
+            try:
+                future = self._pool.submit(
+                    hashing.hash_file, self._file_store.get_file_path(uid),
+                    max_rate=worker_rate)
+            except Exception:
+                logger.exception('Can not hash %r, ending the scan', uid)
+                self._to_hash = []
+                break
+            future.add_done_callback(
+                lambda future, uid=uid, stat=stat:
+                GLib.idle_add(self._hashed_cb, uid, stat, future))
+            self._in_flight += 1
+
+        if not self._in_flight:
+            self._finish()
+
+    def _hashed_cb(self, uid, stat, future):
+        self._in_flight -= 1
+        if self._stopped:
+            return False
+
+        try:
+            checksum = future.result()
+        except BrokenProcessPool:
+            logger.error('Hashing worker died, ending the scan')
+            self._to_hash = []
+            checksum = None
+        except Exception:
+            logger.exception('Error calculating checksum of %r', uid)
+            checksum = None
+
+        current = self._get_file_stat(uid)
+        if checksum is None or current is None or \
+                self._file_store.is_busy(uid) or \
+                (current.st_ino, current.st_size, current.st_mtime_ns) != \
+                (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+            logger.debug('%r changed while being hashed', uid)
+        else:
+            self._report['hashed'] += 1
+            self._report['hashed_bytes'] += stat.st_size
+            self._share(uid, checksum, stat)
+
+        self._unsaved += 1
+        if self._unsaved >= _SAVE_INTERVAL:
+            self._save()
+
+        self._submit()
+        return False
+
+    def _share(self, uid, checksum, stat):
+        """Make an entry share the storage of identical entries.
+
+        """
+        try:
+            if self._file_store.content_addressed:
+                self._file_store.link_to_blob(uid, checksum)
+            else:
+                self._optimizer.add_checksum(uid, checksum, stat.st_size)
+        except Exception:
+            logger.exception('Error sharing the data of %r', uid)
+            return
+
+        current = self._get_file_stat(uid)
+        if current is not None and current.st_ino != stat.st_ino:
+            self._report['duplicates'] += 1
+            if stat.st_nlink == 1:
+                self._report['reclaimed_bytes'] += stat.st_size
+
+    def _get_elapsed(self):
+        return self._elapsed + time.monotonic() - self._start_time
+
+    def _save(self):
+        self._unsaved = 0
+        temp_path = self._state_path + '.tmp'
+        try:
+            f = open(temp_path, 'w')
+            try:
+                json.dump({'report': self._report,
+                           'elapsed': self._get_elapsed()}, f)
+            finally:
+                f.close()
+            os.rename(temp_path, self._state_path)
+        except Exception:
+            logger.exception('Can not save scan state')
+
+    def _finish(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+        if os.path.exists(self._state_path):
+            os.remove(self._state_path)
+
+        report = dict(self._report)
+        report['elapsed'] = int(self._get_elapsed())
+        logger.info('scan finished: %r', report)
+        for completion_cb in self._completion_cbs:
+            completion_cb(report)
@@ -0,0 +1,224 @@
+import os
+import errno
+import json
+import logging
+import time
+
+from gi.repository import GLib
+
+from carquinyol import layoutmanager
+
+# Keep an exported file around for _n_ seconds after it was last handed out
+_EXPORT_LEASE = 60 * 60
+
+# Look for expired exports every _n_ seconds
+_GC_INTERVAL = 10 * 60
+
+logger = logging.getLogger('exportcache')
+
+
+def _get_identity(path):
+    stat = os.stat(path)
+    return [stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+
+class ExportCache(object):
+    """Keep track of the files handed out by get_filename.
+
+    Exports are per caller, so a caller deleting its export when done
+    never pulls it from under another one. A caller opening the same entry
+    again gets its export back as long as it still holds the current data
+    of the entry, which costs a lookup instead of a new link.
+
+    Each export holds a lease that is renewed whenever it is handed out.
+    Expired exports are removed in the background, unless
+    caller_alive_cb(caller) tells that their caller is still around.
+    removed_cb(uid) is called once the last export of an entry is gone.
+    """
+
+    def __init__(self, removed_cb=None, caller_alive_cb=None):
+        self._removed_cb = removed_cb
+        self._caller_alive_cb = caller_alive_cb
+        self._path = layoutmanager.get_instance().get_exports_path()
+        # export path -> record
+        self._exports = {}
+        # (uid, user_id, extension, caller) -> export path
+        self._by_key = {}
+        self._save_id = None
+
+        self._load()
+        GLib.idle_add(self._collect_idle_cb, priority=GLib.PRIORITY_LOW)
+        GLib.timeout_add_seconds(_GC_INTERVAL, self._collect_timeout_cb)
+
+    def _load(self):
+        if not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path, 'r') as f:
+                records = json.load(f)
+        except (IOError, ValueError):
+            logger.exception('Can not read exports, starting afresh')
+            return
+
+        for record in records:
+            self._add_record(record)
+
+    def _save_cb(self):
+        self._save_id = None
+        temp_path = self._path + '.tmp'
+        try:
+            f = open(temp_path, 'w')
+            try:
+                json.dump(list(self._exports.values()), f)
+            finally:
+                f.close()
+            os.rename(temp_path, self._path)
+        except (IOError, OSError):
+            logger.exception('Can not write exports')
+        return False
+
+    def _schedule_save(self):
+        if self._save_id is None:
+            self._save_id = GLib.idle_add(self._save_cb,
+                                          priority=GLib.PRIORITY_LOW)
+
+    def _get_key(self, record):
+        return (record['uid'], record['user_id'], record['extension'],
+                record.get('caller'))
+
+    def _add_record(self, record):
+        self._exports[record['path']] = record
+        self._by_key[self._get_key(record)] = record['path']
+
+    def _remove_record(self, path):
+        record = self._exports.pop(path)
+        key = self._get_key(record)
+        if self._by_key.get(key) == path:
+            del self._by_key[key]
+
+        if self._removed_cb is not None and \
+                not any(other['uid'] == record['uid']
+                        for other in self._exports.values()):
+            self._removed_cb(record['uid'])
+
+    def lookup(self, uid, user_id, extension, caller, source_path):
+        """Return the export of source_path handed out to caller before,
+           renewing its lease, or None if there is no valid one.
+
+        """
+        key = (uid, user_id, extension, caller)
+        path = self._by_key.get(key)
+        if path is None:
+            return None
+
+        record = self._exports[path]
+        try:
+            identity = _get_identity(source_path)
+            stat = os.lstat(path)
+            valid = record['source'] == source_path and \
+                record['identity'] == identity and \
+                stat.st_ino == record.get('inode', identity[1])
+            if valid and not os.path.islink(path):
+                valid = stat.st_size == identity[2]
+        except OSError:
+            valid = False
+
+        if not valid:
+            # deleted by the caller or outdated, leave it to the garbage
+            # collector as the caller may still be reading the old data
+            del self._by_key[key]
+            return None
+
+        record['expires'] = time.time() + _EXPORT_LEASE
+        self._schedule_save()
+        return path
+
+    def add(self, uid, user_id, extension, caller, source_path, path):
+        """Record a new export of source_path at path for caller.
+
+        """
+        self._add_record({
+            'path': path,
+            'uid': uid,
+            'user_id': user_id,
+            'extension': extension,
+            'caller': caller,
+            'source': source_path,
+            'identity': _get_identity(source_path),
+            # differs from the source when the export is a copy
+            'inode': os.lstat(path).st_ino,
+            'expires': time.time() + _EXPORT_LEASE,
+        })
+        self._schedule_save()
+
+    def remove_entry(self, uid):
+        """Remove all exports of a given entry.
+
+        """
+        for path, record in list(self._exports.items()):
+            if record['uid'] == uid:
+                self._remove_export(path)
+        self._schedule_save()
+
+    def _remove_export(self, path):
+        record = self._exports[path]
+        try:
+            if os.path.islink(path):
+                ours = os.readlink(path) == record['source']
+            else:
+                inode = record.get('inode', record['identity'][1])
+                ours = os.lstat(path).st_ino == inode
+            if ours:
+                logger.debug('removing export %r', path)
+                os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                logger.exception('Can not remove export %r', path)
+                return
+
+        self._remove_record(path)
+
+    def _collect_idle_cb(self):
+        self.collect()
+        return False
+
+    def _collect_timeout_cb(self):
+        self.collect()
+        return True
+
+    def _is_caller_alive(self, caller):
+        if caller is None or self._caller_alive_cb is None:
+            return False
+        try:
+            return self._caller_alive_cb(caller)
+        except Exception:
+            logger.exception('Can not tell whether %r is still around',
+                             caller)
+            return True
+
+    def collect(self):
+        """Remove the exports whose lease has expired. Those of callers
+           still around get their lease renewed instead, they may be
+           reading them.
+
+        """
+        now = time.time()
+        expired = []
+        alive = {}
+        for path, record in self._exports.items():
+            if record['expires'] >= now:
+                continue
+            caller = record.get('caller')
+            if caller not in alive:
+                alive[caller] = self._is_caller_alive(caller)
+            if alive[caller]:
+                record['expires'] = now + _EXPORT_LEASE
+            else:
+                expired.append(path)
+
+        if expired:
+            logger.debug('collecting %d expired exports', len(expired))
+            for path in expired:
+                self._remove_export(path)
+        if alive:
+            self._schedule_save()
@@ -0,0 +1,154 @@
+"""Extract the text of entry data for full-text search.
+
+Extractors are looked up by MIME type, falling back to the major type
+('text/*'). Each is called with the path of the data and the maximum
+number of characters to return, and returns the text or None if it can
+not read the file. More can be added with register().
+"""
+
+import os
+import fnmatch
+import logging
+import shutil
+import subprocess
+import zipfile
+from html.parser import HTMLParser
+from xml.etree import ElementTree
+
+# Give up on external tools after _n_ seconds
+_TOOL_TIMEOUT = 60
+
+logger = logging.getLogger('extractors')
+
+# MIME type or 'major/*' -> extractor
+_extractors = {}
+
+
+def register(mime_types, extractor):
+    for mime_type in mime_types:
+        _extractors[mime_type] = extractor
+
+
+def get_extractor(mime_type):
+    if not mime_type:
+        return None
+    extractor = _extractors.get(mime_type)
+    if extractor is None:
+        extractor = _extractors.get(mime_type.split('/', 1)[0] + '/*')
+    return extractor
+
+
+def _extract_plain(path, max_chars):
+    # UTF-8 takes up to 4 bytes per character
+    f = open(path, 'rb')
+    try:
+        data = f.read(max_chars * 4)
+    finally:
+        f.close()
+    return data.decode('utf-8', 'replace')[:max_chars]
+
+
+class _TextParser(HTMLParser):
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.parts = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ['script', 'style']:
+            self._skip += 1
+
+    def handle_endtag(self, tag):
+        if tag in ['script', 'style'] and self._skip:
+            self._skip -= 1
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+
+
+def _get_html_text(data):
+    if isinstance(data, bytes):
+        data = data.decode('utf-8', 'replace')
+    parser = _TextParser()
+    parser.feed(data)
+    parser.close()
+    return ' '.join(' '.join(parser.parts).split())
+
+
+def _extract_html(path, max_chars):
+    return _get_html_text(_extract_plain(path, max_chars * 4))[:max_chars]
+
+
+def _get_xml_text(data):
+    return ' '.join(' '.join(ElementTree.fromstring(data).itertext()).split())
+
+
+def _zip_extractor(patterns, get_text=_get_xml_text):
+    """Return an extractor for zip-based documents keeping their text in
+       the members matching patterns, read with get_text.
+
+    """
+    def extract(path, max_chars):
+        parts = []
+        length = 0
+        with zipfile.ZipFile(path) as archive:
+            for name in sorted(archive.namelist()):
+                if not [pattern for pattern in patterns
+                        if fnmatch.fnmatch(name, pattern)]:
+                    continue
+                text = get_text(archive.read(name))
+                parts.append(text)
+                length += len(text) + 1
+                if length >= max_chars:
+                    break
+        return ' '.join(parts)[:max_chars]
+
+    return extract
+
+
+def _extract_pdf(path, max_chars):
+    tool = shutil.which('pdftotext')
+    if tool is None:
+        logger.debug('pdftotext is not available')
+        return None
+    output = subprocess.run([tool, '-q', '-enc', 'UTF-8', path, '-'],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            timeout=_TOOL_TIMEOUT, check=True).stdout
+    return output[:max_chars * 4].decode('utf-8', 'replace')[:max_chars]
+
+
+def extract_text(path, mime_type, max_chars):
+    """Return the text of a file, None if it has none that can be told.
+
+    """
+    extractor = get_extractor(mime_type)
+    if extractor is None or not os.path.exists(path):
+        return None
+    try:
+        return extractor(path, max_chars)
+    except (IOError, OSError, ValueError, zipfile.BadZipFile,
+            ElementTree.ParseError, subprocess.SubprocessError):
+        logger.exception('Can not extract the text of %s', path)
+        return None
+
+
+register(['text/*'], _extract_plain)
+register(['text/html', 'application/xhtml+xml'], _extract_html)
+register(['application/vnd.oasis.opendocument.text',
+          'application/vnd.oasis.opendocument.spreadsheet',
+          'application/vnd.oasis.opendocument.presentation'],
+         _zip_extractor(['content.xml']))
+register(['application/vnd.openxmlformats-officedocument.'
+          'wordprocessingml.document'],
+         _zip_extractor(['word/document.xml']))
+register(['application/vnd.openxmlformats-officedocument.'
+          'presentationml.presentation'],
+         _zip_extractor(['ppt/slides/slide*.xml']))
+register(['application/vnd.openxmlformats-officedocument.'
+          'spreadsheetml.sheet'],
+         _zip_extractor(['xl/sharedStrings.xml']))
+register(['application/epub+zip'],
+         _zip_extractor(['*.xhtml', '*.html'], _get_html_text))
+register(['application/pdf'], _extract_pdf)
@@ -16,34 +16,96 @@
 
 import os
 import errno
+import fcntl
 import logging
+import shutil
 import tempfile
+import threading
+from stat import S_ISREG
 
 from gi.repository import GLib
 
 from sugar3 import env
 
+from carquinyol import compression
+from carquinyol import hashing
 from carquinyol import layoutmanager
+from carquinyol.blobstore import BlobStore
+from carquinyol.chunkstore import ChunkStore, MAX_CHUNKED_FILE_SIZE
+from carquinyol.exportcache import ExportCache
+
+# Don't bother compressing files smaller than _n_ bytes
+_COMPRESSION_MIN_SIZE = 4096
+
+# Report progress of transfers at most every _n_ milliseconds
+_PROGRESS_INTERVAL = 500
 
 logger = logging.getLogger('filestore')
 
 
+class TransferCancelledError(Exception):
+    pass
+
+
 class FileStore(object):
     """Handle the storage of one file per entry.
     """
 
-    # TODO: add protection against store and retrieve operations on entries
-    # that are being processed async.
+    # TODO: add protection against retrieve operations on entries that are
+    # being processed async.
+
+    def __init__(self, metadata_store, progress_cb=None,
+                 caller_alive_cb=None):
+        self._metadata_store = metadata_store
+        self._transfers = TransferManager(progress_cb)
+        self._exports = ExportCache(removed_cb=self._exports_removed_cb,
+                                    caller_alive_cb=caller_alive_cb)
+
+        layout_manager = layoutmanager.get_instance()
+        if layout_manager.get_option('content_addressed', False):
+            self._blob_store = BlobStore()
+        else:
+            self._blob_store = None
+
+        # entries stored in chunks stay readable after turning it off
+        self._chunked = layout_manager.get_option('chunked', False)
+        if self._chunked or os.path.exists(layout_manager.get_chunks_dir()):
+            self._chunk_store = ChunkStore()
+        else:
+            self._chunk_store = None
+
+        self._compression = layout_manager.get_option('compression', None)
+        if self._compression is True:
+            self._compression = 'zlib'
+        self._compression_min_size = layout_manager.get_option(
+            'compression_min_size', _COMPRESSION_MIN_SIZE)
+
+    def get_content_addressed(self):
+        return self._blob_store is not None
+
+    content_addressed = property(get_content_addressed)
 
     def store(self, uid, file_path, transfer_ownership, completion_cb):
         """Store a file for a given entry.
 
+        Writes to an entry that is still being copied are queued until the
+        copy is done.
         """
+        if self._transfers.is_active(uid):
+            logger.debug('FileStore queueing write to busy entry %r', uid)
+            self._transfers.queue(
+                uid,
+                lambda: self.store(uid, file_path, transfer_ownership,
+                                   completion_cb),
+                lambda exc: self._drop_store(file_path, transfer_ownership,
+                                             completion_cb, exc),
+                bool(file_path))
+            return
+
         dir_path = layoutmanager.get_instance().get_entry_path(uid)
         if not os.path.exists(dir_path):
             os.makedirs(dir_path)
 
-        destination_path = layoutmanager.get_instance().get_data_path(uid)
         if file_path:
             if not os.path.isfile(file_path):
                 raise ValueError('No file at %r' % file_path)
@@ -55,21 +117,17 @@ class FileStore(object):
                 # We should not move original file
                 transfer_ownership = False
 
-            if transfer_ownership:
-                try:
-                    logger.debug('FileStore moving from %r to %r', file_path,
-                                  destination_path)
-                    os.rename(file_path, destination_path)
-                    completion_cb()
-                except OSError as e:
-                    if e.errno == errno.EXDEV:
-                        self._async_copy(file_path, destination_path,
-                                         completion_cb, unlink_src=True)
-                    else:
-                        raise
+            size = os.stat(file_path).st_size
+            codec = self._get_codec(uid, size)
+            if self._chunked and size <= MAX_CHUNKED_FILE_SIZE:
+                self._store_chunks(uid, file_path, transfer_ownership,
+                                   completion_cb)
+            elif codec is not None:
+                self._store_compressed(uid, file_path, transfer_ownership,
+                                       completion_cb, codec)
             else:
-                self._async_copy(file_path, destination_path, completion_cb,
-                                 unlink_src=False)
+                self._store_file(uid, file_path, transfer_ownership,
+                                 completion_cb)
             """
         TODO: How can we support deleting the file of an entry?
         elif not file_path and os.path.exists(destination_path):
@@ -81,7 +139,294 @@ class FileStore(object):
             logger.debug('FileStore: Nothing to do')
             completion_cb()
 
-    def _async_copy(self, file_path, destination_path, completion_cb,
+    def _store_file(self, uid, file_path, transfer_ownership, completion_cb):
+        """Store a file for a given entry as is.
+
+        """
+        completion_cb = self._on_success(uid, 'file', completion_cb)
+        destination_path = layoutmanager.get_instance().get_data_path(uid)
+
+        if self._blob_store is not None:
+            self._store_blob(uid, file_path, transfer_ownership,
+                             completion_cb)
+        elif transfer_ownership:
+            try:
+                logger.debug('FileStore moving from %r to %r', file_path,
+                              destination_path)
+                os.rename(file_path, destination_path)
+                completion_cb()
+            except OSError as e:
+                if e.errno == errno.EXDEV:
+                    self._async_copy(uid, file_path, destination_path,
+                                     completion_cb, unlink_src=True)
+                else:
+                    raise
+        else:
+            self._async_copy(uid, file_path, destination_path,
+                             completion_cb, unlink_src=False)
+
+    def store_fd(self, uid, fd, completion_cb):
+        """Store the data read from a file descriptor for a given entry.
+
+        Regular files are copied (or cloned) from their start, anything else
+        is streamed until end of file. The descriptor is closed when done.
+        """
+        if self._transfers.is_active(uid):
+            logger.debug('FileStore queueing write to busy entry %r', uid)
+            self._transfers.queue(
+                uid,
+                lambda: self.store_fd(uid, fd, completion_cb),
+                lambda exc: self._drop_store_fd(fd, completion_cb, exc),
+                True)
+            return
+
+        try:
+            dir_path = layoutmanager.get_instance().get_entry_path(uid)
+            if not os.path.exists(dir_path):
+                os.makedirs(dir_path)
+
+            stat = os.fstat(fd)
+            if self._chunked and (not S_ISREG(stat.st_mode) or
+                                  stat.st_size <= MAX_CHUNKED_FILE_SIZE):
+                self._store_chunks(uid, None, False, completion_cb, src_fd=fd)
+                return
+
+            completion_cb = self._on_success(uid, 'file', completion_cb)
+            if self._blob_store is not None:
+                self._store_blob(uid, None, False, completion_cb, src_fd=fd)
+                return
+
+            destination_path = layoutmanager.get_instance().get_data_path(uid)
+            logger.debug('FileStore copying from fd %d to %r', fd,
+                          destination_path)
+            async_copy = AsyncCopy(None, destination_path, completion_cb,
+                                   src_fd=fd)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._transfers.start(uid, async_copy)
+
+    def _store_chunks(self, uid, file_path, transfer_ownership, completion_cb,
+                      src_fd=None):
+        """Store the data of an entry as content-defined chunks.
+
+        """
+        completion_cb = self._on_success(uid, 'chunks', completion_cb)
+
+        def ingested_cb(exc=None):
+            if exc is None:
+                try:
+                    self._chunk_store.commit(uid, ingest)
+                except Exception as e:
+                    logger.exception('Error storing chunks for %r', uid)
+                    exc = e
+            completion_cb(exc)
+
+        logger.debug('FileStore chunking %r for %r', file_path or src_fd, uid)
+        ingest = self._chunk_store.create_ingest(
+            file_path, ingested_cb, unlink_src=transfer_ownership,
+            src_fd=src_fd)
+        self._transfers.start(uid, ingest)
+
+    def _get_codec(self, uid, size):
+        """Return the codec to compress the data of an entry with, if any.
+
+        """
+        if not self._compression or size < self._compression_min_size:
+            return None
+        mime_type = self._metadata_store.get_property(uid, 'mime_type')
+        if not compression.is_compressible(mime_type):
+            return None
+        return self._compression
+
+    def _store_compressed(self, uid, file_path, transfer_ownership,
+                          completion_cb, codec):
+        """Store the data of an entry compressed, unless that does not save
+           enough space.
+
+        """
+        compressed_path = self._get_compressed_path(uid)
+
+        def compressed_cb(exc=None):
+            if exc is None and not ingest.worth_keeping:
+                logger.debug('Not worth compressing %r', uid)
+                os.unlink(compressed_path + '.tmp')
+                self._store_file(uid, file_path, transfer_ownership,
+                                 completion_cb)
+                return
+
+            if exc is None:
+                try:
+                    os.rename(compressed_path + '.tmp', compressed_path)
+                    if transfer_ownership:
+                        os.unlink(file_path)
+                    self._data_stored(uid, 'compressed')
+                except Exception as e:
+                    logger.exception('Error storing compressed %r', uid)
+                    exc = e
+            elif transfer_ownership and os.path.exists(file_path):
+                os.unlink(file_path)
+            completion_cb(exc)
+
+        logger.debug('FileStore compressing %r for %r with %s', file_path,
+                      uid, codec)
+        ingest = compression.CompressIngest(
+            file_path, compressed_path + '.tmp', codec, compressed_cb)
+        self._transfers.start(uid, ingest)
+
+    def _on_success(self, uid, kind, completion_cb):
+        def completion(exc=None):
+            if exc is None:
+                self._data_stored(uid, kind)
+            completion_cb(exc)
+        return completion
+
+    def _data_stored(self, uid, kind):
+        """Remove what is left of the data an entry had before, stored in
+           some other way.
+
+        """
+        if kind != 'file':
+            self._remove_data_file(uid)
+        if kind != 'chunks' and self._chunk_store is not None:
+            self._chunk_store.delete(uid)
+        if kind != 'compressed':
+            self._remove_if_exists(self._get_compressed_path(uid))
+        self._remove_if_exists(self._get_cache_path(uid))
+
+    def _remove_if_exists(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _get_compressed_path(self, uid):
+        return layoutmanager.get_instance().get_data_path(uid) + '.z'
+
+    def _get_cache_path(self, uid):
+        return layoutmanager.get_instance().get_data_path(uid) + '.cache'
+
+    def _materialize(self, uid):
+        """Return the path of a plain file with the data of an entry stored
+           in chunks or compressed, or None if it has no data.
+
+        """
+        if self._chunk_store is not None and self._chunk_store.has_entry(uid):
+            return self._chunk_store.materialize(uid)
+
+        compressed_path = self._get_compressed_path(uid)
+        if not os.path.exists(compressed_path):
+            return None
+
+        cache_path = self._get_cache_path(uid)
+        if os.path.exists(cache_path) and \
+                os.stat(cache_path).st_mtime >= \
+                os.stat(compressed_path).st_mtime:
+            return cache_path
+
+        logger.debug('decompressing %r', uid)
+        compression.decompress(compressed_path, cache_path + '.tmp')
+        os.chmod(cache_path + '.tmp', 0o444)
+        os.rename(cache_path + '.tmp', cache_path)
+        return cache_path
+
+    def _store_blob(self, uid, file_path, transfer_ownership, completion_cb,
+                    src_fd=None):
+        """Store the data of an entry in the blob store, hashing it while it
+           is being copied in.
+
+        """
+        ingest_path = layoutmanager.get_instance().get_data_path(uid) + \
+            '.ingest'
+        hash_obj = hashing.new_hash()
+
+        def ingested_cb(*args):
+            self._blob_ingested_cb(uid, ingest_path, hash_obj, completion_cb,
+                                   *args)
+
+        if src_fd is not None:
+            async_copy = AsyncCopy(None, ingest_path, ingested_cb,
+                                   src_fd=src_fd, hash_obj=hash_obj)
+        elif transfer_ownership and self._try_rename(file_path, ingest_path):
+            # already in place, only needs to be read once
+            async_copy = AsyncCopy(ingest_path, None, ingested_cb,
+                                   hash_obj=hash_obj)
+        else:
+            async_copy = AsyncCopy(file_path, ingest_path, ingested_cb,
+                                   unlink_src=transfer_ownership,
+                                   hash_obj=hash_obj)
+        self._transfers.start(uid, async_copy)
+
+    def _try_rename(self, file_path, destination_path):
+        try:
+            logger.debug('FileStore moving from %r to %r', file_path,
+                          destination_path)
+            os.rename(file_path, destination_path)
+        except OSError as e:
+            if e.errno == errno.EXDEV:
+                return False
+            raise
+        return True
+
+    def _blob_ingested_cb(self, uid, ingest_path, hash_obj, completion_cb,
+                          exc=None):
+        if exc is None:
+            try:
+                digest = hashing.format_checksum(hashing.DEFAULT_ALGORITHM,
+                                                 hash_obj.hexdigest())
+                self._blob_store.add(ingest_path, digest)
+                self._link_blob(uid, digest)
+            except Exception as e:
+                logger.exception('Error storing blob for %r', uid)
+                exc = e
+
+        if os.path.exists(ingest_path):
+            os.unlink(ingest_path)
+        completion_cb(exc)
+
+    def _link_blob(self, uid, digest):
+        """Make the data file of an entry a reference to a blob.
+
+        """
+        old_digest = self._metadata_store.get_property(uid, 'checksum')
+        self._blob_store.link(
+            digest, layoutmanager.get_instance().get_data_path(uid))
+        self._metadata_store.set_property(uid, 'checksum', digest)
+        if old_digest != digest:
+            self._blob_store.release(old_digest)
+
+    def link_to_blob(self, uid, digest):
+        """Move the plain data file of an entry to the blob store, or replace
+           it with a link to an identical blob stored already.
+
+        """
+        file_path = layoutmanager.get_instance().get_data_path(uid)
+        blob_path = layoutmanager.get_instance().get_blob_path(digest)
+        if os.path.exists(blob_path) and \
+                os.path.samefile(file_path, blob_path):
+            return
+
+        ingest_path = file_path + '.ingest'
+        if os.path.exists(ingest_path):
+            os.unlink(ingest_path)
+        os.link(file_path, ingest_path)
+        self._blob_store.add(ingest_path, digest)
+        if os.path.samefile(file_path, blob_path):
+            # the data file itself became the blob
+            self._metadata_store.set_property(uid, 'checksum', digest)
+        else:
+            self._link_blob(uid, digest)
+
+    def _drop_store(self, file_path, transfer_ownership, completion_cb, exc):
+        """Complete a queued write that will not be carried out."""
+        if transfer_ownership and not os.path.islink(file_path) and \
+                os.path.exists(file_path):
+            os.unlink(file_path)
+        completion_cb(exc)
+
+    def _drop_store_fd(self, fd, completion_cb, exc):
+        os.close(fd)
+        completion_cb(exc)
+
+    def _async_copy(self, uid, file_path, destination_path, completion_cb,
                     unlink_src):
         """Start copying a file asynchronously.
 
@@ -90,19 +435,43 @@ class FileStore(object):
                       destination_path)
         async_copy = AsyncCopy(file_path, destination_path, completion_cb,
                                unlink_src)
-        async_copy.start()
+        self._transfers.start(uid, async_copy)
+
+    def is_busy(self, uid):
+        """Check if data is being written to a given entry."""
+        return self._transfers.is_active(uid)
 
-    def retrieve(self, uid, user_id, extension):
+    def cancel(self, uid):
+        """Cancel the transfers to a given entry, queued or in flight."""
+        self._transfers.cancel(uid)
+
+    def retrieve(self, uid, user_id, extension, caller=None):
         """Place the file associated to a given entry into a directory
-           where the user can read it. The caller is reponsible for
-           deleting this file.
+           where the user can read it. The caller should delete this
+           file when done, otherwise it is removed once its lease expires.
+           The same caller may get the same file again.
 
         """
         file_path = layoutmanager.get_instance().get_data_path(uid)
         if not os.path.exists(file_path):
-            logger.debug('Entry %r doesnt have any file', uid)
-            return ''
+            file_path = self._materialize(uid)
+            if file_path is None:
+                logger.debug('Entry %r doesnt have any file', uid)
+                return ''
+
+        return self.export(uid, file_path, user_id, extension, caller)
 
+    def export(self, uid, file_path, user_id, extension, caller=None,
+               copy=False):
+        """Place file_path, the data of a given entry, into a directory
+           where the user can read it. The caller should delete this file
+           when done, otherwise it is removed once its lease expires.
+           The same caller may get the same file again.
+
+           A file on another file system is linked symbolically, or copied
+           if copy is True.
+
+        """
         use_instance_dir = os.path.exists('/etc/olpc-security') and \
             os.getuid() != user_id
         if use_instance_dir:
@@ -124,6 +493,12 @@ class FileStore(object):
         elif extension:
             extension = '.' + extension
 
+        destination_path = self._exports.lookup(uid, user_id, extension,
+                                                caller, file_path)
+        if destination_path is not None:
+            logger.debug('Reusing export %r', destination_path)
+            return destination_path
+
         fd, destination_path = tempfile.mkstemp(
             prefix=uid + '_', suffix=extension, dir=destination_dir)
         os.close(fd)
@@ -134,23 +509,80 @@ class FileStore(object):
         try:
             os.link(file_path, destination_path)
         except OSError as e:
-            if e.errno == errno.EXDEV:
-                os.symlink(file_path, destination_path)
-            else:
+            if e.errno != errno.EXDEV:
                 raise
+            if copy:
+                shutil.copyfile(file_path, destination_path)
+            else:
+                os.symlink(file_path, destination_path)
 
+        self._exports.add(uid, user_id, extension, caller, file_path,
+                          destination_path)
         return destination_path
 
+    def _exports_removed_cb(self, uid):
+        self._remove_if_exists(self._get_cache_path(uid))
+
     def get_file_path(self, uid):
         return layoutmanager.get_instance().get_data_path(uid)
 
-    def delete(self, uid):
-        """Remove the file associated to a given entry.
+    def get_data_source(self, uid):
+        """Return how to read the data of an entry without writing it out
+           as a plain file: ('file', path), ('compressed', path) or
+           ('chunks', chunk paths), or None if it has no data.
 
         """
+        file_path = self.get_file_path(uid)
+        if os.path.exists(file_path):
+            return 'file', file_path
+        if self._chunk_store is not None and self._chunk_store.has_entry(uid):
+            return 'chunks', self._chunk_store.get_chunk_paths(uid)
+        compressed_path = self._get_compressed_path(uid)
+        if os.path.exists(compressed_path):
+            return 'compressed', compressed_path
+        return None
+
+    def has_data(self, uid):
+        """Check if there is any data stored for a given entry.
+
+        """
+        if os.path.exists(layoutmanager.get_instance().get_data_path(uid)):
+            return True
+        if os.path.exists(self._get_compressed_path(uid)):
+            return True
+        return self._chunk_store is not None and \
+            self._chunk_store.has_entry(uid)
+
+    def get_file_size(self, uid):
+        """Return the size of the data of a given entry, 0 if it has none.
+
+        """
+        file_path = layoutmanager.get_instance().get_data_path(uid)
+        if os.path.exists(file_path):
+            return os.stat(file_path).st_size
+        compressed_path = self._get_compressed_path(uid)
+        if os.path.exists(compressed_path):
+            return compression.get_size(compressed_path)
+        if self._chunk_store is not None:
+            return self._chunk_store.get_size(uid)
+        return 0
+
+    def _remove_data_file(self, uid):
         file_path = layoutmanager.get_instance().get_data_path(uid)
         if os.path.exists(file_path):
             os.remove(file_path)
+            if self._blob_store is not None:
+                self._blob_store.release(
+                    self._metadata_store.get_property(uid, 'checksum'))
+
+    def delete(self, uid):
+        """Remove the file associated to a given entry.
+
+        """
+        self._transfers.cancel(uid)
+        self._exports.remove_entry(uid)
+        self._remove_data_file(uid)
+        self._data_stored(uid, None)
 
     def hard_link_entry(self, new_uid, existing_uid):
         existing_file = layoutmanager.get_instance().get_data_path(
@@ -164,69 +596,303 @@ class FileStore(object):
         os.link(existing_file, new_file)
 
 
+class TransferManager(object):
+    """Keep track of the file transfers in flight.
+
+    Only one transfer per entry runs at a time. Later writes to the same
+    entry are queued behind it, and a queued write of new data is
+    superseded by a newer one. Progress of the active transfers is reported
+    through progress_cb(uid, written, total) at most every
+    _PROGRESS_INTERVAL milliseconds.
+    """
+
+    def __init__(self, progress_cb=None):
+        self._progress_cb = progress_cb
+        # uid -> AsyncCopy
+        self._active = {}
+        # uid -> [(start_cb, drop_cb, writes_data)]
+        self._queued = {}
+        self._reported = {}
+        self._progress_timeout = None
+
+    def is_active(self, uid):
+        return uid in self._active
+
+    def start(self, uid, async_copy):
+        completion = async_copy.completion
+
+        def completion_cb(*args):
+            del self._active[uid]
+            self._reported.pop(uid, None)
+            completion(*args)
+            self._start_queued(uid)
+
+        async_copy.completion = completion_cb
+        async_copy.start()
+        self._active[uid] = async_copy
+
+        if self._progress_timeout is None and self._progress_cb is not None:
+            self._progress_timeout = GLib.timeout_add(
+                _PROGRESS_INTERVAL, self._progress_timeout_cb)
+
+    def queue(self, uid, start_cb, drop_cb, writes_data):
+        queued = self._queued.setdefault(uid, [])
+        if writes_data:
+            for item in [item for item in queued if item[2]]:
+                logger.debug('superseding queued write to %r', uid)
+                queued.remove(item)
+                item[1](None)
+        queued.append((start_cb, drop_cb, writes_data))
+
+    def cancel(self, uid):
+        for start_cb_, drop_cb, writes_data_ in self._queued.pop(uid, []):
+            drop_cb(TransferCancelledError('Write to %s cancelled' % uid))
+
+        if uid in self._active:
+            logger.debug('cancelling transfer to %r', uid)
+            self._active[uid].cancel()
+
+    def _start_queued(self, uid):
+        queued = self._queued.get(uid, [])
+        while queued and uid not in self._active:
+            start_cb, drop_cb, writes_data_ = queued.pop(0)
+            try:
+                start_cb()
+            except Exception as e:
+                logger.exception('Error starting queued write to %r', uid)
+                drop_cb(e)
+
+        if not queued:
+            self._queued.pop(uid, None)
+
+    def _progress_timeout_cb(self):
+        for uid, async_copy in list(self._active.items()):
+            if self._reported.get(uid) != async_copy.written:
+                self._reported[uid] = async_copy.written
+                self._progress_cb(uid, async_copy.written, async_copy.size)
+
+        if not self._active:
+            self._progress_timeout = None
+            return False
+        return True
+
+
+# from linux/fs.h
+_FICLONE = 0x40049409
+
+# errors meaning a copy method is not available for this pair of files
+_UNSUPPORTED_ERRNOS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.ENOTTY,
+                       errno.EOPNOTSUPP, errno.EBADF)
+
+
 class AsyncCopy(object):
-    """Copy a file in chunks in the idle loop.
+    """Copy a file in a worker thread and report completion to the main loop.
+
+    Letting the kernel do the work is tried first: a reflink (FICLONE)
+    shares the blocks on copy-on-write filesystems, then copy_file_range
+    and sendfile copy without bouncing the data through Python. Copying
+    in chunks is only used when none of those are available.
 
+    The data is copied into a temporary file next to the destination, which
+    only replaces the destination once the copy succeeded.
     """
     CHUNK_SIZE = 65536
+    KERNEL_CHUNK_SIZE = 8 * 1024 * 1024
 
-    def __init__(self, src, dest, completion, unlink_src=False):
+    def __init__(self, src, dest, completion, unlink_src=False, src_fd=None,
+                 hash_obj=None):
         self.src = src
         self.dest = dest
         self.completion = completion
+        self._temp_path = None if dest is None else dest + '.tmp'
         self._unlink_src = unlink_src
-        self.src_fp = -1
+        self.src_fp = -1 if src_fd is None else src_fd
         self.dest_fp = -1
         self.written = 0
         self.size = 0
+        self.method = None
+        self._stream = False
+        self._cancelled = threading.Event()
+        self._hash_obj = hash_obj
+
+        if src is None:
+            self.src = '<fd %d>' % src_fd
 
     def _cleanup(self):
         os.close(self.src_fp)
-        os.close(self.dest_fp)
+        if self.dest_fp != -1:
+            os.close(self.dest_fp)
 
-    def _copy_block(self, user_data=None):
-        try:
+    def _check_cancelled(self):
+        if self._cancelled.is_set():
+            raise TransferCancelledError('Copy to %s cancelled' % self.dest)
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def _copy_reflink(self):
+        self._check_cancelled()
+        fcntl.ioctl(self.dest_fp, _FICLONE, self.src_fp)
+        self.written = self.size
+        return True
+
+    def _copy_file_range(self):
+        if not hasattr(os, 'copy_file_range'):
+            return False
+        while self.written < self.size:
+            self._check_cancelled()
+            count = os.copy_file_range(
+                self.src_fp, self.dest_fp,
+                min(AsyncCopy.KERNEL_CHUNK_SIZE, self.size - self.written),
+                self.written, self.written)
+            if count == 0:
+                # some filesystems refuse silently
+                return False
+            self.written += count
+        return True
+
+    def _copy_sendfile(self):
+        os.lseek(self.dest_fp, self.written, os.SEEK_SET)
+        while self.written < self.size:
+            self._check_cancelled()
+            count = os.sendfile(
+                self.dest_fp, self.src_fp, self.written,
+                min(AsyncCopy.KERNEL_CHUNK_SIZE, self.size - self.written))
+            if count == 0:
+                return False
+            self.written += count
+        return True
+
+    def _copy_splice(self):
+        if not hasattr(os, 'splice'):
+            return False
+        while True:
+            self._check_cancelled()
+            count = os.splice(self.src_fp, self.dest_fp,
+                              AsyncCopy.KERNEL_CHUNK_SIZE,
+                              offset_dst=self.written)
+            if count == 0:
+                return True
+            self.written += count
+
+    def _copy_chunks(self):
+        if not self._stream:
+            os.lseek(self.src_fp, self.written, os.SEEK_SET)
+        if self.dest_fp == -1:
+            # only hashing
+            return self._hash_chunks()
+
+        os.lseek(self.dest_fp, self.written, os.SEEK_SET)
+        while True:
+            self._check_cancelled()
             data = os.read(self.src_fp, AsyncCopy.CHUNK_SIZE)
-            count = os.write(self.dest_fp, data)
-            self.written += len(data)
+            if not data:
+                return True
 
+            if self._hash_obj is not None:
+                self._hash_obj.update(data)
+            count = os.write(self.dest_fp, data)
             # error writing data to file?
             if count < len(data):
-                logger.error('AC: Error writing %s -> %s: wrote less than '
-                              'expected', self.src, self.dest)
-                self._complete(RuntimeError(
-                    'Error writing data to destination file'))
-                return False
+                raise RuntimeError('Error writing data to destination file')
+            self.written += count
 
-            # FIXME: emit progress here
+    def _hash_chunks(self):
+        while True:
+            self._check_cancelled()
+            data = os.read(self.src_fp, AsyncCopy.CHUNK_SIZE)
+            if not data:
+                return True
+            self._hash_obj.update(data)
+            self.written += len(data)
 
-            # done?
-            if len(data) < AsyncCopy.CHUNK_SIZE:
-                self._complete(None)
-                return False
+    def _copy(self):
+        if self._hash_obj is not None:
+            # the data has to pass through here to be hashed anyway
+            methods = []
+        elif self._stream:
+            methods = [('splice', self._copy_splice)]
+        else:
+            methods = [('reflink', self._copy_reflink),
+                       ('copy_file_range', self._copy_file_range),
+                       ('sendfile', self._copy_sendfile)]
+        for name, method in methods:
+            try:
+                if method():
+                    self.method = name
+                    return
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED_ERRNOS:
+                    raise
+            logger.debug('AC: %s not available for %s', name, self.dest)
+
+        self.method = 'chunks'
+        self._copy_chunks()
+
+    def _run(self):
+        try:
+            self._copy()
+        except TransferCancelledError as err:
+            logger.debug('AC: %s', err)
+            GLib.idle_add(self._complete, err)
+            return
         except Exception as err:
-            logger.error('AC: Error copying %s -> %s: %r', self.src, self.
-                          dest, err)
-            self._complete(err)
-            return False
+            logger.error('AC: Error copying %s -> %s: %r', self.src,
+                         self.dest, err)
+            GLib.idle_add(self._complete, err)
+            return
 
-        return True
+        logger.debug('AC: copied %d bytes %s -> %s using %s', self.written,
+                     self.src, self.dest, self.method)
+        GLib.idle_add(self._complete, None)
 
     def _complete(self, *args):
         self._cleanup()
-        if self._unlink_src:
-            os.unlink(self.src)
-        self.completion(*args)
+        try:
+            if self._temp_path is not None:
+                if args and args[0] is not None:
+                    # don't leave a partial copy behind
+                    self._remove_temp()
+                else:
+                    try:
+                        os.rename(self._temp_path, self.dest)
+                    except OSError as err:
+                        logger.error('AC: Error renaming %s -> %s: %r',
+                                     self._temp_path, self.dest, err)
+                        self._remove_temp()
+                        args = (err,)
+            if self._unlink_src:
+                os.unlink(self.src)
+        finally:
+            # the transfer manager and the D-Bus caller wait for this
+            self.completion(*args)
+        return False
+
+    def _remove_temp(self):
+        try:
+            os.unlink(self._temp_path)
+        except OSError as e:
+            # gone with the entry directory if the entry was deleted
+            if e.errno != errno.ENOENT:
+                logger.error('AC: Error removing %s: %r', self._temp_path,
+                             e)
 
     def start(self):
-        if os.path.exists(self.dest):
-            os.unlink(self.dest)
+        if self.src_fp == -1:
+            self.src_fp = os.open(self.src, os.O_RDONLY)
 
-        self.src_fp = os.open(self.src, os.O_RDONLY)
-        self.dest_fp = os.open(self.dest, os.O_RDWR | os.O_TRUNC | os.O_CREAT,
-                               0o444)
+        if self._temp_path is not None:
+            if os.path.exists(self._temp_path):
+                # left behind by an interrupted copy
+                os.unlink(self._temp_path)
+            self.dest_fp = os.open(self._temp_path,
+                                   os.O_RDWR | os.O_TRUNC | os.O_CREAT, 0o444)
 
         stat = os.fstat(self.src_fp)
-        self.size = stat[6]
+        self.size = stat.st_size
+        # pipes, sockets and the like are read until end of file
+        self._stream = not S_ISREG(stat.st_mode)
 
-        GLib.idle_add(self._copy_block)
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
@@ -0,0 +1,84 @@
+"""Checksums of entry data.
+
+Checksums are tagged with the algorithm that computed them, as in
+'blake2b:<hex digest>'. Untagged checksums are md5 digests computed by
+earlier versions and stay valid.
+"""
+
+import os
+import time
+import hashlib
+
+DEFAULT_ALGORITHM = 'blake2b'
+LEGACY_ALGORITHM = 'md5'
+
+_READ_SIZE = 1024 * 1024
+
+
+def new_hash(algorithm=DEFAULT_ALGORITHM):
+    return hashlib.new(algorithm)
+
+
+def format_checksum(algorithm, hexdigest):
+    if algorithm == LEGACY_ALGORITHM:
+        return hexdigest
+    return '%s:%s' % (algorithm, hexdigest)
+
+
+def get_algorithm(checksum):
+    if ':' in checksum:
+        return checksum.split(':', 1)[0]
+    return LEGACY_ALGORITHM
+
+
+def get_hexdigest(checksum):
+    return checksum.rsplit(':', 1)[-1]
+
+
+def hash_file(path, algorithm=DEFAULT_ALGORITHM, max_rate=None):
+    """Return the tagged checksum of a file, reading it in blocks.
+
+    Safe to call from worker threads; hashlib releases the GIL while
+    hashing large blocks. If max_rate is given, reading is slowed down to
+    at most that many bytes per second.
+    """
+    hash_obj = new_hash(algorithm)
+    start = time.monotonic()
+    read = 0
+    f = open(path, 'rb')
+    try:
+        while True:
+            data = f.read(_READ_SIZE)
+            if not data:
+                break
+            hash_obj.update(data)
+            read += len(data)
+            if max_rate:
+                delay = start + read / float(max_rate) - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+    finally:
+        f.close()
+    return format_checksum(algorithm, hash_obj.hexdigest())
+
+
+def hash_file_ends(path, block_size=64 * 1024,
+                   algorithm=DEFAULT_ALGORITHM):
+    """Return a tagged checksum of the size and the first and last blocks
+       of a file.
+
+    Files with different partial checksums differ; equal partial
+    checksums only make it worth comparing the whole files.
+    """
+    hash_obj = new_hash(algorithm)
+    f = open(path, 'rb')
+    try:
+        size = os.fstat(f.fileno()).st_size
+        hash_obj.update(str(size).encode())
+        hash_obj.update(f.read(block_size))
+        if size > block_size:
+            f.seek(max(block_size, size - block_size))
+            hash_obj.update(f.read(block_size))
+    finally:
+        f.close()
+    return format_checksum(algorithm, hash_obj.hexdigest())
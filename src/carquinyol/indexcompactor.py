@@ -0,0 +1,176 @@
+import os
+import logging
+import shutil
+import time
+
+from gi.repository import GLib
+import xapian
+
+from carquinyol import workerpool
+
+# Check whether the index needs compacting every _n_ seconds
+_CHECK_INTERVAL = 10 * 60
+# Compact the index at most every _n_ seconds
+_COMPACT_INTERVAL = 7 * 24 * 3600
+# Only compact while the load average is below _n_ per CPU
+_MAX_LOAD = 0.5
+# Leave at least _n_ bytes free after copying the index
+_MIN_FREE_BYTES = 1024 * 1024 * 5
+# Time the same query _n_ times to measure the query latency
+_LATENCY_RUNS = 3
+
+logger = logging.getLogger('indexcompactor')
+
+
+def compact_database(index_path, compact_path):
+    """Write a compacted copy of a database, run by worker processes.
+
+    """
+    if os.path.exists(compact_path):
+        shutil.rmtree(compact_path)
+    xapian.Database(index_path).compact(compact_path)
+
+
+def _get_size(path):
+    size = 0
+    for dir_path, dir_names_, file_names in os.walk(path):
+        for file_name in file_names:
+            size += os.path.getsize(os.path.join(dir_path, file_name))
+    return size
+
+
+class IndexCompactor(object):
+    """Compact the index in the background to undo the fragmentation left
+       by replacing and deleting documents.
+
+    The index is compacted into a sibling directory by a worker process
+    when it has changed since the last compaction, a week ago at least,
+    no entry has been written to it since the previous check and the
+    system is not busy. Entries written in the meantime are then written
+    again to the compacted index before it replaces the current one. The
+    size of the index and the latency of a query before and after are
+    logged and kept in last_report.
+    """
+
+    def __init__(self, index_store, root_path):
+        self._index_store = index_store
+        self._stamp_path = os.path.join(root_path, 'index_compacted')
+        self._generation = None
+        self._pool = None
+        self._report = None
+        self.last_report = None
+        self._check_id = GLib.timeout_add_seconds(_CHECK_INTERVAL,
+                                                  self._check_cb)
+
+    def _get_last_compaction(self):
+        try:
+            return os.stat(self._stamp_path).st_mtime
+        except OSError:
+            return 0
+
+    def _needs_compaction(self):
+        index_path = self._index_store.index_path
+        last_compaction = self._get_last_compaction()
+        if time.time() - last_compaction < _COMPACT_INTERVAL:
+            return False
+        for file_name in os.listdir(index_path):
+            file_path = os.path.join(index_path, file_name)
+            if os.stat(file_path).st_mtime > last_compaction:
+                return True
+        return False
+
+    def _is_idle(self):
+        try:
+            load = os.getloadavg()[0]
+        except OSError:
+            load = 0
+        return load < _MAX_LOAD * (os.cpu_count() or 1)
+
+    def _has_room(self, size):
+        stat = os.statvfs(os.path.dirname(self._index_store.index_path))
+        return stat.f_bavail * stat.f_bsize > size + _MIN_FREE_BYTES
+
+    def _check_cb(self):
+        generation = self._index_store.generation
+        written = generation != self._generation
+        self._generation = generation
+        if written or self._pool is not None or \
+                not self._index_store.is_compactable() or \
+                not self._is_idle() or not self._needs_compaction():
+            return True
+
+        size = _get_size(self._index_store.index_path)
+        if not self._has_room(size):
+            logger.warning('Not enough disk space to compact the index')
+            return True
+
+        self._start(size)
+        return True
+
+    def _measure_latency(self):
+        """Return the best time, in seconds, of a query for the most
+           recent entries.
+
+        """
+        latency = None
+        for i_ in range(_LATENCY_RUNS):
+            start = time.monotonic()
+            self._index_store.find({'limit': 20})
+            elapsed = time.monotonic() - start
+            if latency is None or elapsed < latency:
+                latency = elapsed
+        return latency
+
+    def _start(self, size):
+        logger.info('Compacting the index (%d bytes)', size)
+        self._report = {'size_before': size,
+                        'latency_before': self._measure_latency(),
+                        'start': time.monotonic()}
+        self._index_store.begin_compaction()
+
+        self._pool = workerpool.new_pool()
+        future = self._pool.submit(compact_database,
+                                   self._index_store.index_path,
+                                   self._index_store.get_compaction_path())
+        future.add_done_callback(
+            lambda future: GLib.idle_add(self._compacted_cb, future))
+
+    def _compacted_cb(self, future):
+        self._pool.shutdown(wait=False)
+        self._pool = None
+
+        if not self._index_store.compacting:
+            # the index was closed or rebuilt meanwhile
+            compact_path = self._index_store.get_compaction_path()
+            if os.path.exists(compact_path):
+                shutil.rmtree(compact_path)
+            return False
+
+        try:
+            future.result()
+            self._index_store.finish_compaction()
+        except Exception:
+            logger.exception('Error compacting the index')
+            self._index_store.abort_compaction()
+            return False
+
+        open(self._stamp_path, 'w').close()
+        report = self._report
+        report['size_after'] = _get_size(self._index_store.index_path)
+        report['latency_after'] = self._measure_latency()
+        report['duration'] = time.monotonic() - report.pop('start')
+        self.last_report = report
+        logger.info('Compacted the index from %d to %d bytes in %.1f s, '
+                    'query latency from %.1f to %.1f ms',
+                    report['size_before'], report['size_after'],
+                    report['duration'], report['latency_before'] * 1000,
+                    report['latency_after'] * 1000)
+        return False
+
+    def stop(self):
+        GLib.source_remove(self._check_id)
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        if self._index_store.compacting:
+            self._index_store.abort_compaction()
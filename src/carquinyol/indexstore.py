@@ -14,23 +14,30 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import calendar
 import logging
 import os
+import re
+import shutil
 import sys
+import time
 
 from gi.repository import GLib
 import xapian
 from xapian import WritableDatabase, Document, Enquire, Query
 
 from carquinyol import layoutmanager
+from carquinyol.contentextractor import read_extracted
+from carquinyol.indexcompactor import compact_database
 from carquinyol.layoutmanager import MAX_QUERY_LIMIT
+from carquinyol import schema
+from carquinyol.schema import Schema, fold_text
+from carquinyol import workerpool
 
+# the other value slots are assigned by the schema
 _VALUE_UID = 0
-_VALUE_TIMESTAMP = 1
-_VALUE_TITLE = 2
-# 3 reserved for version support
-_VALUE_FILESIZE = 4
-_VALUE_CREATION_TIME = 5
+# the version tree of an entry, to collapse on
+_VALUE_TREE_ID = 3
 
 _PREFIX_NONE = 'N'
 _PREFIX_FULL_VALUE = 'F'
@@ -40,6 +47,29 @@ _PREFIX_ACTIVITY_ID = 'I'
 _PREFIX_MIME_TYPE = 'M'
 _PREFIX_KEEP = 'K'
 _PREFIX_PROJECT_ID = 'P'
+_PREFIX_TREE_ID = 'T'
+_PREFIX_VERSION_ID = 'V'
+# beginnings of the words of _EDGE_NGRAM_PROPERTIES, for suggest()
+_PREFIX_EDGE_NGRAM = 'E'
+# text extracted from the data
+_PREFIX_CONTENT = 'C'
+
+# Index the first 1 to _n_ characters of each word for suggest()
+_EDGE_NGRAM_MAX = 16
+
+_EDGE_NGRAM_PROPERTIES = ['title', 'tags', 'description']
+
+_WORD_RE = re.compile(r'\w+')
+
+# Indexes of an older format are rebuilt
+_INDEX_FORMAT = '3'
+
+# Seconds per bucket of the fixed intervals of date histograms
+_HISTOGRAM_INTERVALS = {
+    'hour': 3600,
+    'day': 24 * 3600,
+    'week': 7 * 24 * 3600,
+}
 
 # Force a flush every _n_ changes to the db
 _FLUSH_THRESHOLD = 20
@@ -51,6 +81,16 @@ _PROPERTIES_NOT_TO_INDEX = ['timestamp', 'preview', 'launch-times']
 
 _MAX_RESULTS = int(2 ** 31 - 1)
 
+# Months per index shard for the values of the index_shards option
+_SHARD_PERIODS = {
+    'month': 1,
+    'quarter': 3,
+    'year': 12,
+}
+
+# Shards are named after the first month of their period
+_SHARD_NAME_RE = re.compile(r'^[0-9]{4}-[0-9]{2}$')
+
 _QUERY_TERM_MAP = {
     'uid': _PREFIX_UID,
     'activity': _PREFIX_ACTIVITY,
@@ -58,48 +98,126 @@ _QUERY_TERM_MAP = {
     'mime_type': _PREFIX_MIME_TYPE,
     'keep': _PREFIX_KEEP,
     'project_id': _PREFIX_PROJECT_ID,
-}
-
-_QUERY_VALUE_MAP = {
-    'timestamp': {'number': _VALUE_TIMESTAMP, 'type': float},
-    'filesize': {'number': _VALUE_FILESIZE, 'type': int},
-    'creation_time': {'number': _VALUE_CREATION_TIME, 'type': float},
+    'tree_id': _PREFIX_TREE_ID,
+    'version_id': _PREFIX_VERSION_ID,
 }
 
 logger = logging.getLogger('indexstore')
 
 
+def _get_words(text):
+    return _WORD_RE.findall(fold_text(text))
+
+
+def _mark_format(database):
+    """Record the format of an empty database, to tell outdated indexes.
+
+    """
+    if not database.get_doccount():
+        database.set_metadata('format', _INDEX_FORMAT)
+
+
+def _check_format(database):
+    if database.get_doccount() and \
+            database.get_metadata('format').decode() != _INDEX_FORMAT:
+        raise ValueError('Index format is outdated')
+
+
+def _get_bucket_function(interval):
+    """Return a function giving the start of the date histogram bucket of
+       a time, in local time for calendar intervals.
+
+    """
+    if interval in ['month', 'year']:
+        def get_bucket(value):
+            tm = time.localtime(value)
+            month = tm.tm_mon if interval == 'month' else 1
+            return int(time.mktime((tm.tm_year, month, 1, 0, 0, 0, 0, 0,
+                                    -1)))
+        return get_bucket
+
+    if interval == 'day' or interval == 'week':
+        def get_bucket(value):
+            tm = time.localtime(value)
+            day = tm.tm_mday
+            if interval == 'week':
+                # weeks start on Monday
+                day -= tm.tm_wday
+            return int(time.mktime((tm.tm_year, tm.tm_mon, day, 0, 0, 0, 0,
+                                    0, -1)))
+        return get_bucket
+
+    seconds = int(_HISTOGRAM_INTERVALS.get(interval, interval))
+    if seconds <= 0:
+        raise ValueError('Invalid histogram interval %r' % interval)
+    return lambda value: int(value // seconds * seconds)
+
+
+class _AggregateSpy(xapian.MatchSpy):
+    """Count the matches, and sum a value of them, per value of a slot.
+
+    """
+
+    def __init__(self, group_slot, get_key, sum_slot=None):
+        xapian.MatchSpy.__init__(self)
+        self._group_slot = group_slot
+        self._get_key = get_key
+        self._sum_slot = sum_slot
+        # key -> [count, sum]
+        self.groups = {}
+
+    def __call__(self, document, weight):
+        value = document.get_value(self._group_slot)
+        if not value:
+            return
+        key = self._get_key(value)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = [0, 0]
+        group[0] += 1
+        if self._sum_slot is not None:
+            value = document.get_value(self._sum_slot)
+            if value:
+                group[1] += xapian.sortable_unserialise(value)
+
+
 class TermGenerator (xapian.TermGenerator):
 
-    def index_document(self, document, properties):
-        document.add_value(
-            _VALUE_TIMESTAMP,
-            xapian.sortable_serialise(
-                float(
-                    properties['timestamp'])))
-        document.add_value(_VALUE_TITLE, properties.get('title', '').strip())
-        if 'filesize' in properties:
-            try:
-                document.add_value(_VALUE_FILESIZE, xapian.sortable_serialise(
-                    int(properties['filesize'])))
-            except (ValueError, TypeError):
-                logger.debug('Invalid value for filesize property: %s',
-                              properties['filesize'])
-        if 'creation_time' in properties:
+    def __init__(self, schema=None):
+        xapian.TermGenerator.__init__(self)
+        self._schema = schema or Schema()
+
+    def index_document(self, document, properties, content=None):
+        if 'title' not in properties:
+            properties = dict(properties, title='')
+        for field in self._schema.get_fields():
+            if field.name not in properties:
+                continue
             try:
-                document.add_value(
-                    _VALUE_CREATION_TIME, xapian.sortable_serialise(
-                        float(properties['creation_time'])))
+                document.add_value(field.slot,
+                                   field.serialise(properties[field.name]))
             except (ValueError, TypeError):
-                logger.debug('Invalid value for creation_time property: %s',
-                              properties['creation_time'])
+                logger.debug('Invalid value for %s property: %s',
+                              field.name, properties[field.name])
 
         self.set_document(document)
 
+        self._index_edge_ngrams(document, properties)
+
         properties = dict(properties)
         self._index_known(document, properties)
         self._index_unknown(document, properties)
 
+        if content:
+            self.index_text(content, 1, _PREFIX_CONTENT)
+
+    def _index_edge_ngrams(self, document, properties):
+        for name in _EDGE_NGRAM_PROPERTIES:
+            for word in _get_words(properties.get(name) or ''):
+                for length in range(1, min(len(word), _EDGE_NGRAM_MAX) + 1):
+                    document.add_boolean_term(
+                        _PREFIX_EDGE_NGRAM + word[:length])
+
     def _index_known(self, document, properties):
         for name, prefix in list(_QUERY_TERM_MAP.items()):
             if (name not in properties):
@@ -134,16 +252,29 @@ class QueryParser (xapian.QueryParser):
     or a list (multiple exact matches joined with OR) as values.
     An empty dictionary matches everything. Queries from different keys
     (i.e. different metadata names) are joined with AND.
+
+    Dictionary queries only filter the matches of the query string: they
+    do not take part in relevance weighting, and ranges that any or no
+    document satisfies are left out or short-circuit the query.
     """
 
-    def __init__(self):
+    def __init__(self, schema=None):
         xapian.QueryParser.__init__(self)
+        self._schema = schema or Schema()
+        self._database = None
 
         for name, prefix in list(_QUERY_TERM_MAP.items()):
             self.add_prefix(name, prefix)
             self.add_prefix('', prefix)
 
         self.add_prefix('', _PREFIX_NONE)
+        self.add_prefix('content', _PREFIX_CONTENT)
+        self.add_prefix('', _PREFIX_CONTENT)
+
+    # pylint: disable=W0221
+    def set_database(self, database):
+        xapian.QueryParser.set_database(self, database)
+        self._database = database
 
     def _parse_query_term(self, name, prefix, value):
         if isinstance(value, list):
@@ -156,41 +287,46 @@ class QueryParser (xapian.QueryParser):
         else:
             return Query(_PREFIX_NONE + str(value))
 
-    def _parse_query_value_range(self, name, info, value):
+    def _parse_query_value_range(self, field, value):
         if len(value) != 2:
             raise TypeError(
                 'Only tuples of size 2 have a defined meaning. '
                 'Did you mean to pass a list instead?')
 
         start, end = value
-        return Query(
-            Query.OP_VALUE_RANGE, info['number'], self._convert_value(
-                info, start), self._convert_value(
-                info, end))
-
-    def _convert_value(self, info, value):
-        if info['type'] in (float, int):
-            return xapian.sortable_serialise(info['type'](value))
-
-        return str(info['type'](value))
-
-    def _parse_query_value(self, name, info, value):
+        start = field.serialise(start)
+        end = field.serialise(end)
+
+        database = self._database
+        if database is not None and database.get_doccount():
+            lower = database.get_value_lower_bound(field.slot)
+            upper = database.get_value_upper_bound(field.slot)
+            if start > upper or end < lower:
+                return Query.MatchNothing
+            if start <= lower and end >= upper and \
+                    database.get_value_freq(field.slot) == \
+                    database.get_doccount():
+                return Query.MatchAll
+
+        return Query(Query.OP_VALUE_RANGE, field.slot, start, end)
+
+    def _parse_query_value(self, field, value):
         if isinstance(value, list):
-            subqueries = [self._parse_query_value(name, info, word)
+            subqueries = [self._parse_query_value(field, word)
                           for word in value]
             return Query(Query.OP_OR, subqueries)
 
         elif isinstance(value, tuple):
-            return self._parse_query_value_range(name, info, value)
+            return self._parse_query_value_range(field, value)
 
         elif isinstance(value, dict):
             # compatibility option for timestamp: {'start': 0, 'end': 1}
             start = value.get('start', 0)
             end = value.get('end', sys.maxsize)
-            return self._parse_query_value_range(name, info, (start, end))
+            return self._parse_query_value_range(field, (start, end))
 
         else:
-            return self._parse_query_value_range(name, info, (value, value))
+            return self._parse_query_value_range(field, (value, value))
 
     def _parse_query_xapian(self, query_str):
         try:
@@ -209,50 +345,367 @@ class QueryParser (xapian.QueryParser):
     # pylint: disable=W0221
     def parse_query(self, query_dict, query_string):
         logger.debug('parse_query %r %r', query_dict, query_string)
-        queries = []
+        filters = []
         query_dict = dict(query_dict)
 
-        if query_string is not None:
-            queries.append(self._parse_query_xapian(str(query_string)))
-
         for name, value in list(query_dict.items()):
+            field = self._schema.get_field(name)
             if name in _QUERY_TERM_MAP:
-                queries.append(
-                    self._parse_query_term(
-                        name, _QUERY_TERM_MAP[name], value))
-            elif name in _QUERY_VALUE_MAP:
-                queries.append(
-                    self._parse_query_value(
-                        name, _QUERY_VALUE_MAP[name], value))
+                prefix = _QUERY_TERM_MAP[name]
+                filters.append(self._parse_query_term(name, prefix, value))
+            elif field is not None and field.is_range_queryable():
+                filters.append(self._parse_query_value(field, value))
             else:
                 logger.warning('Unknown term: %r=%r', name, value)
 
-        if not queries:
-            queries.append(Query(''))
+        filter_query = None
+        if filters:
+            filter_query = Query(Query.OP_AND, filters)
+
+        if query_string is not None:
+            query = self._parse_query_xapian(str(query_string))
+            if filter_query is not None:
+                query = Query(Query.OP_FILTER, query, filter_query)
+        elif filter_query is not None:
+            # weighting filters is wasted work
+            query = Query(Query.OP_SCALE_WEIGHT, filter_query, 0)
+        else:
+            query = Query('')
+
+        logger.debug('query: %s', query)
+        return query
+
+
+def _get_shard_name(months, timestamp):
+    tm = time.gmtime(timestamp)
+    month = (tm.tm_mon - 1) // months * months + 1
+    return '%04d-%02d' % (tm.tm_year, month)
+
+
+def _get_shard_range(months, name):
+    """Return the start and end, exclusive, of the period of a shard."""
+    year, month = [int(part) for part in name.split('-')]
+    start = calendar.timegm((year, month, 1, 0, 0, 0))
+    month += months
+    if month > 12:
+        year += 1
+        month -= 12
+    return start, calendar.timegm((year, month, 1, 0, 0, 0))
+
+
+def _get_upper_bound(value):
+    """Return the highest time matched by the value of a timestamp or
+       creation_time query, None if it can't be told.
+
+    """
+    try:
+        if isinstance(value, list):
+            return max(_get_upper_bound(item) for item in value)
+        elif isinstance(value, tuple):
+            return float(value[1])
+        elif isinstance(value, dict):
+            return float(value.get('end', sys.maxsize))
+        return float(value)
+    except (ValueError, TypeError, IndexError):
+        return None
+
+
+class ShardSet(object):
+    """Keep the index as one Xapian database per period of time.
+
+    Entries go to the shard of the earliest of their creation_time and
+    timestamp, which usually never changes, so only the shards of the
+    current and the previous period are written to. Older shards are
+    opened read-only and compacted. Queries go through a database
+    combining the shards that can match; as entries are modified after
+    they are created, shards starting after the end of a timestamp or
+    creation_time range are skipped. A damaged shard is recreated empty
+    and listed in damaged, for its entries to be indexed again.
+
+    Shards are compacted by a worker process into a sibling directory,
+    which then replaces the shard through two renames; open() undoes
+    compactions interrupted by a crash.
+
+    With read_only, every shard is opened read-only, for searching an
+    index written by another process. changed_cb is called whenever a
+    shard is swapped for its compacted copy.
+    """
+
+    def __init__(self, path, months, read_only=False, changed_cb=None):
+        self._path = path
+        self._months = months
+        self._read_only = read_only
+        self._changed_cb = changed_cb
+        # shard name -> database
+        self._databases = {}
+        # names of the shards opened for writing
+        self._writable = set()
+        self.damaged = []
+        self._pool = None
+        # shards that could not be compacted, left alone until next start
+        self._not_compactable = set()
+
+    def open(self):
+        if self._read_only:
+            for name in sorted(os.listdir(self._path)):
+                if _SHARD_NAME_RE.match(name):
+                    self._databases[name] = xapian.Database(
+                        self._get_shard_path(name))
+            return
+
+        if not os.path.exists(self._path):
+            os.makedirs(self._path)
+
+        marker_path = os.path.join(self._path, 'shards')
+        if os.path.exists(marker_path):
+            if int(open(marker_path, 'r').read()) != self._months:
+                raise ValueError('Index shards span other periods')
+        elif os.listdir(self._path):
+            raise ValueError('Index is not sharded')
+        else:
+            open(marker_path, 'w').write(str(self._months))
+
+        self._recover_compactions()
+        for name in sorted(os.listdir(self._path)):
+            if _SHARD_NAME_RE.match(name):
+                self._open_shard(name)
+
+        GLib.idle_add(self._compact_cb, priority=GLib.PRIORITY_LOW)
+
+    def _recover_compactions(self):
+        """Clean up after compactions interrupted by a crash, putting back
+           a shard that was moved aside if its compacted copy did not take
+           its place yet.
 
-        logger.debug('queries: %r', [str(q) for q in queries])
-        return Query(Query.OP_AND, queries)
+        """
+        for file_name in sorted(os.listdir(self._path)):
+            path = os.path.join(self._path, file_name)
+            name, ext = os.path.splitext(file_name)
+            if not _SHARD_NAME_RE.match(name):
+                continue
+            if ext == '.old':
+                if os.path.exists(self._get_shard_path(name)):
+                    shutil.rmtree(path)
+                else:
+                    logger.warning('Restoring index shard %s', name)
+                    os.rename(path, self._get_shard_path(name))
+            elif ext == '.compact':
+                shutil.rmtree(path)
+
+    def _is_recent(self, name):
+        current = _get_shard_name(self._months, time.time())
+        start = _get_shard_range(self._months, current)[0]
+        return name >= _get_shard_name(self._months, start - 1)
+
+    def _get_shard_path(self, name):
+        return os.path.join(self._path, name)
+
+    def _get_compacted_path(self, name):
+        return os.path.join(self._path, name + '.compacted')
+
+    def _open_shard(self, name):
+        shard_path = self._get_shard_path(name)
+        try:
+            if self._is_recent(name):
+                database = WritableDatabase(shard_path,
+                                            xapian.DB_CREATE_OR_OPEN)
+                self._writable.add(name)
+            else:
+                database = xapian.Database(shard_path)
+        except xapian.DatabaseError:
+            logger.exception('Index shard %s is damaged, recreating it', name)
+            shutil.rmtree(shard_path)
+            if os.path.exists(self._get_compacted_path(name)):
+                os.remove(self._get_compacted_path(name))
+            database = WritableDatabase(shard_path, xapian.DB_CREATE_OR_OPEN)
+            self._writable.add(name)
+            self.damaged.append(name)
+        self._databases[name] = database
+
+    def _get_writable(self, name):
+        if name in self._writable:
+            return self._databases[name]
+
+        if name in self._databases:
+            self._databases[name].close()
+        if os.path.exists(self._get_compacted_path(name)):
+            os.remove(self._get_compacted_path(name))
+        database = WritableDatabase(self._get_shard_path(name),
+                                    xapian.DB_CREATE_OR_OPEN)
+        self._databases[name] = database
+        self._writable.add(name)
+        return database
+
+    def find_shard(self, uid):
+        term = _PREFIX_FULL_VALUE + _PREFIX_UID + uid
+        for name, database in self._databases.items():
+            if database.term_exists(term):
+                return name
+        return None
+
+    def store(self, uid, properties, document):
+        times = []
+        for name in ['creation_time', 'timestamp']:
+            try:
+                times.append(float(properties[name]))
+            except (KeyError, ValueError, TypeError):
+                pass
+        name = _get_shard_name(self._months, min(times or [time.time()]))
+
+        term = _PREFIX_FULL_VALUE + _PREFIX_UID + uid
+        current = self.find_shard(uid)
+        if current is not None and current != name:
+            self._get_writable(current).delete_document(term)
+        database = self._get_writable(name)
+        _mark_format(database)
+        database.replace_document(term, document)
+
+    def delete(self, uid):
+        name = self.find_shard(uid)
+        if name is not None:
+            self._get_writable(name).delete_document(
+                _PREFIX_FULL_VALUE + _PREFIX_UID + uid)
+
+    def _may_match(self, name, query):
+        start = _get_shard_range(self._months, name)[0]
+        for key in ['timestamp', 'creation_time']:
+            if key not in query:
+                continue
+            upper_bound = _get_upper_bound(query[key])
+            if upper_bound is not None and start > upper_bound:
+                return False
+        return True
+
+    def get_database(self, query=None):
+        """Return a database combining the shards that may hold entries
+           matching query.
+
+        """
+        database = xapian.Database()
+        for name in sorted(self._databases):
+            if query is None or self._may_match(name, query):
+                database.add_database(self._databases[name])
+        return database
+
+    def get_databases(self):
+        return list(self._databases.values())
+
+    def flush(self):
+        for name in self._writable:
+            self._databases[name].flush()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        for database in self._databases.values():
+            database.close()
+        self._databases = {}
+        self._writable = set()
+
+    def _compact_cb(self):
+        """Start compacting the next old shard, if any.
+
+        """
+        for name in sorted(self._databases):
+            if name in self._writable or name in self._not_compactable or \
+                    os.path.exists(self._get_compacted_path(name)):
+                continue
+
+            logger.debug('Compacting index shard %s', name)
+            if self._pool is None:
+                self._pool = workerpool.new_pool()
+            shard_path = self._get_shard_path(name)
+            future = self._pool.submit(compact_database, shard_path,
+                                       shard_path + '.compact')
+            future.add_done_callback(
+                lambda future, name=name:
+                GLib.idle_add(self._compacted_cb, name, future))
+            return False
+
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+        return False
+
+    def _compacted_cb(self, name, future):
+        shard_path = self._get_shard_path(name)
+        temp_path = shard_path + '.compact'
+        if self._pool is None:
+            # closed meanwhile
+            if os.path.exists(temp_path):
+                shutil.rmtree(temp_path)
+            return False
+
+        try:
+            future.result()
+        except Exception:
+            logger.exception('Error compacting index shard %s', name)
+            if os.path.exists(temp_path):
+                shutil.rmtree(temp_path)
+            self._not_compactable.add(name)
+            GLib.idle_add(self._compact_cb, priority=GLib.PRIORITY_LOW)
+            return False
+
+        if name in self._writable:
+            # written to meanwhile, compacted again once old enough
+            shutil.rmtree(temp_path)
+        else:
+            self._databases[name].close()
+            os.rename(shard_path, shard_path + '.old')
+            os.rename(temp_path, shard_path)
+            shutil.rmtree(shard_path + '.old')
+            open(self._get_compacted_path(name), 'w').close()
+            self._databases[name] = xapian.Database(shard_path)
+            if self._changed_cb is not None:
+                self._changed_cb()
+
+        GLib.idle_add(self._compact_cb, priority=GLib.PRIORITY_LOW)
+        return False
 
 
 class IndexStore(object):
     """Index metadata and provide rich query facilities on it.
     """
 
-    def __init__(self):
+    def __init__(self, layout_manager=None):
         self._database = None
         self._flush_timeout = None
         self._pending_writes = 0
-        root_path = layoutmanager.get_instance().get_root_path()
+        layout_manager = layout_manager or layoutmanager.get_instance()
+        self._layout_manager = layout_manager
+        root_path = layout_manager.get_root_path()
         self._index_updated_path = os.path.join(root_path,
                                                 'index_updated')
-        self._std_index_path = layoutmanager.get_instance().get_index_path()
+        self._std_index_path = layout_manager.get_index_path()
+        self._read_only = layout_manager.read_only
         self._index_path = self._std_index_path
-
-    def open_index(self, temp_path=False):
+        # counts the changes committed to the database
+        self.generation = 0
+        # uids written while the index is being compacted
+        self._compaction_log = None
+        # parser reused until the databases it reads change
+        self._query_parser = None
+        self._query_parser_databases = None
+        self._shard_months = _SHARD_PERIODS.get(
+            layout_manager.get_option('index_shards'))
+        # a mounted data store has its index rebuilt every time
+        schema_path = None
+        if not self._read_only:
+            schema_path = os.path.join(root_path, 'schema')
+        self.schema = Schema(schema_path,
+                             layout_manager.get_option('sort_properties'))
+        self._shards = None
+
+    def open_index(self, temp_path=False, read_only=False):
         # callers to open_index must be able to
         # handle an exception -- usually caused by
         # IO errors such as ENOSPC and retry putting
         # the index on a temp_path
+        #
+        # read_only opens the index for searching only, e.g. while
+        # another process writes to it
+        self._read_only = self._read_only or read_only
         if temp_path:
             try:
                 # mark the on-disk index stale
@@ -262,18 +715,164 @@ class IndexStore(object):
             self._index_path = temp_path
         else:
             self._index_path = self._std_index_path
+            if not read_only:
+                self._recover_compaction()
         try:
-            self._database = WritableDatabase(self._index_path,
-                                              xapian.DB_CREATE_OR_OPEN)
+            if self._shard_months is not None:
+                self._shards = ShardSet(self._index_path, self._shard_months,
+                                        read_only, self._shards_changed_cb)
+                self._shards.open()
+            elif os.path.exists(os.path.join(self._index_path, 'shards')):
+                raise ValueError('Index is sharded')
+            elif read_only:
+                self._database = xapian.Database(self._index_path)
+            else:
+                self._database = WritableDatabase(self._index_path,
+                                                  xapian.DB_CREATE_OR_OPEN)
+                _mark_format(self._database)
+
+            if not read_only:
+                if self._shards is not None:
+                    databases = self._shards.get_databases()
+                else:
+                    databases = [self._database]
+                for database in databases:
+                    _check_format(database)
         except BaseException:
             logger.error('Exception opening database')
+            if self._shards is not None:
+                self._shards.close()
+            self._shards = None
+            self._database = None
             raise
+        self.generation += 1
+
+    def _recover_compaction(self):
+        """Clean up after a compaction interrupted by a crash.
+
+        """
+        old_path = self._index_path + '.old'
+        if os.path.exists(old_path):
+            if not os.path.exists(self._index_path):
+                # interrupted between moving the old and the new index
+                os.rename(old_path, self._index_path)
+            else:
+                shutil.rmtree(old_path)
+        compact_path = self.get_compaction_path()
+        if os.path.exists(compact_path):
+            shutil.rmtree(compact_path)
+
+    def _shards_changed_cb(self):
+        self.generation += 1
+
+    def reopen_index(self):
+        """Catch up with the changes committed by the writer of an index
+           opened read-only.
+
+        """
+        if self._shards is not None:
+            # shards may have been added or swapped for compacted ones
+            self._shards.close()
+            self._shards.open()
+        else:
+            self._database.reopen()
+        self.generation += 1
+
+    def get_index_path(self):
+        return self._index_path
+
+    index_path = property(get_index_path)
+
+    def get_compaction_path(self):
+        return self._index_path + '.compact'
+
+    def is_compactable(self):
+        """Whether the index can be compacted with begin_compaction().
+
+        Sharded indexes compact their older shards on their own.
+        """
+        return self._database is not None and self._shards is None and \
+            not self._read_only and \
+            self._index_path == self._std_index_path
+
+    def begin_compaction(self):
+        """Start recording the entries written from now on, for replaying
+           them on the compacted copy of the index.
+
+        """
+        self._flush(True)
+        self._compaction_log = set()
+
+    def get_compacting(self):
+        return self._compaction_log is not None
+
+    compacting = property(get_compacting)
+
+    def abort_compaction(self):
+        self._compaction_log = None
+        compact_path = self.get_compaction_path()
+        if os.path.exists(compact_path):
+            shutil.rmtree(compact_path)
+
+    def finish_compaction(self):
+        """Replay the writes made during the compaction on the compacted
+           copy of the index and swap it in.
+
+        """
+        compact_path = self.get_compaction_path()
+        self._flush(True)
+
+        compacted = WritableDatabase(compact_path, xapian.DB_OPEN)
+        for uid in self._compaction_log:
+            term = _PREFIX_FULL_VALUE + _PREFIX_UID + uid
+            postings = list(self._database.postlist(term))
+            if postings:
+                compacted.replace_document(
+                    term, self._database.get_document(postings[0].docid))
+            else:
+                compacted.delete_document(term)
+        logger.debug('Replayed %d writes on the compacted index',
+                     len(self._compaction_log))
+        self._compaction_log = None
+        compacted.commit()
+        compacted.close()
+
+        self._database.close()
+        self._database = None
+        old_path = self._index_path + '.old'
+        os.rename(self._index_path, old_path)
+        os.rename(compact_path, self._index_path)
+        self._database = WritableDatabase(self._index_path,
+                                          xapian.DB_CREATE_OR_OPEN)
+        shutil.rmtree(old_path)
+        self.generation += 1
+
+    def get_damaged_shards(self):
+        if self._shards is None:
+            return []
+        return self._shards.damaged
+
+    damaged_shards = property(get_damaged_shards)
+
+    def _get_database(self, query=None):
+        if self._shards is not None:
+            return self._shards.get_database(query)
+        return self._database
 
     def close_index(self):
         """Close index database if it is open."""
+        self._query_parser = None
+        if self._shards is not None:
+            self._flush(True)
+            self._shards.close()
+            self._shards = None
+            return
+
         if not self._database:
             return
 
+        if self._compaction_log is not None:
+            self.abort_compaction()
         self._flush(True)
         try:
             # does Xapian write in its destructors?
@@ -286,9 +885,17 @@ class IndexStore(object):
         if not os.path.exists(self._index_path):
             return
         for f in os.listdir(self._index_path):
-            os.remove(os.path.join(self._index_path, f))
+            path = os.path.join(self._index_path, f)
+            if os.path.isdir(path):
+                # index shards
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
 
     def contains(self, uid):
+        if self._shards is not None:
+            return self._shards.find_shard(uid) is not None
+
         postings = self._database.postlist(_PREFIX_FULL_VALUE +
                                            _PREFIX_UID + uid)
         try:
@@ -297,30 +904,58 @@ class IndexStore(object):
             return False
         return True
 
-    def store(self, uid, properties):
+    def store(self, uid, properties, flush=True):
+        """Index an entry. Without flush, the change is only committed by
+           the next flush().
+
+        """
+        # entries not saved as a version of another are the first of
+        # their own tree
+        if not properties.get('tree_id'):
+            properties = dict(properties, tree_id=uid)
+
         document = Document()
         document.add_value(_VALUE_UID, uid)
-        term_generator = TermGenerator()
-        term_generator.index_document(document, properties)
-
-        if not self.contains(uid):
+        document.add_value(_VALUE_TREE_ID, str(properties['tree_id']))
+        term_generator = TermGenerator(self.schema)
+        checksum_, content = read_extracted(
+            self._layout_manager.get_extracted_path(uid))
+        term_generator.index_document(document, properties, content)
+
+        if self._compaction_log is not None:
+            self._compaction_log.add(uid)
+        if self._shards is not None:
+            self._shards.store(uid, properties, document)
+        elif not self.contains(uid):
             self._database.add_document(document)
         else:
             self._database.replace_document(_PREFIX_FULL_VALUE +
                                             _PREFIX_UID + uid, document)
 
-        self._flush(True)
+        if flush:
+            self._flush(True)
+
+    def find(self, query, sort_values=False):
+        """Return the uids of the entries matching a query and the number
+           of matches.
 
-    def find(self, query):
+        With sort_values, (uid, sort value) pairs are returned instead of
+        uids, for merging results of several indexes. With
+        collapse_versions set in query, only the first entry of each
+        version tree in sort order is returned, e.g. the latest version
+        when sorting by '+timestamp'.
+        """
         offset = query.pop('offset', 0)
         limit = query.pop('limit', MAX_QUERY_LIMIT)
         order_by = query.pop('order_by', [])
         query_string = query.pop('query', None)
+        collapse_versions = query.pop('collapse_versions', False)
 
-        query_parser = QueryParser()
-        query_parser.set_database(self._database)
-        enquire = Enquire(self._database)
+        query_parser = self._get_query_parser()
+        enquire = Enquire(self._get_database(query))
         enquire.set_query(query_parser.parse_query(query, query_string))
+        if collapse_versions:
+            enquire.set_collapse_key(_VALUE_TREE_ID)
 
         # This will assure that the results count is exact.
         check_at_least = offset + limit + 1
@@ -330,22 +965,14 @@ class IndexStore(object):
         else:
             order_by = order_by[0]
 
-        if order_by == '+timestamp':
-            enquire.set_sort_by_value(_VALUE_TIMESTAMP, True)
-        elif order_by == '-timestamp':
-            enquire.set_sort_by_value(_VALUE_TIMESTAMP, False)
-        elif order_by == '+title':
-            enquire.set_sort_by_value(_VALUE_TITLE, True)
-        elif order_by == '-title':
-            enquire.set_sort_by_value(_VALUE_TITLE, False)
-        elif order_by == '+filesize':
-            enquire.set_sort_by_value(_VALUE_FILESIZE, True)
-        elif order_by == '-filesize':
-            enquire.set_sort_by_value(_VALUE_FILESIZE, False)
-        elif order_by == '+creation_time':
-            enquire.set_sort_by_value(_VALUE_CREATION_TIME, True)
-        elif order_by == '-creation_time':
-            enquire.set_sort_by_value(_VALUE_CREATION_TIME, False)
+        sort_value = None
+        field = self.schema.get_field(order_by[1:])
+        if field is not None:
+            sort_value = field.slot
+        if order_by[:1] in ['+', '-'] and sort_value is not None:
+            enquire.set_sort_by_value(sort_value, order_by[0] == '+')
+            # relevance does not matter when sorting by value
+            enquire.set_weighting_scheme(xapian.BoolWeight())
         else:
             logger.warning('Unsupported property for sorting: %s', order_by)
 
@@ -354,18 +981,115 @@ class IndexStore(object):
 
         uids = []
         for hit in query_result:
-            uids.append(hit.document.get_value(_VALUE_UID))
+            uid = hit.document.get_value(_VALUE_UID)
+            if sort_values:
+                uid = (uid, hit.document.get_value(sort_value)
+                       if sort_value is not None else b'')
+            uids.append(uid)
 
         return (uids, total_count)
 
+    def _get_query_parser(self):
+        # the parser reads its databases live, writes don't outdate it but
+        # opening, swapping or adding a database does
+        if self._shards is not None:
+            databases = self._shards.get_databases()
+        else:
+            databases = [self._database]
+        if self._query_parser is None or \
+                len(databases) != len(self._query_parser_databases) or \
+                any(database is not previous for database, previous
+                    in zip(databases, self._query_parser_databases)):
+            self._query_parser = QueryParser(self.schema)
+            self._query_parser.set_database(self._get_database())
+            self._query_parser_databases = databases
+        return self._query_parser
+
+    def suggest(self, prefix, limit):
+        """Return the uids of the most recent entries with words in their
+           title, tags or description starting with the words of prefix.
+
+        """
+        terms = [_PREFIX_EDGE_NGRAM + word[:_EDGE_NGRAM_MAX]
+                 for word in _get_words(prefix)]
+        if not terms:
+            return []
+
+        enquire = Enquire(self._get_database())
+        enquire.set_query(Query(Query.OP_AND, [Query(term)
+                                               for term in terms]))
+        enquire.set_weighting_scheme(xapian.BoolWeight())
+        enquire.set_sort_by_value(self.schema.get_field('timestamp').slot,
+                                  True)
+        return [hit.document.get_value(_VALUE_UID)
+                for hit in enquire.get_mset(0, limit)]
+
     def delete(self, uid):
-        self._database.delete_document(_PREFIX_FULL_VALUE + _PREFIX_UID + uid)
+        if self._compaction_log is not None:
+            self._compaction_log.add(uid)
+        if self._shards is not None:
+            self._shards.delete(uid)
+        else:
+            self._database.delete_document(_PREFIX_FULL_VALUE + _PREFIX_UID +
+                                           uid)
         self._flush(True)
 
+    def aggregate(self, query, spec):
+        """Return the number of entries matching a query per value of a
+           property, in one pass over the matches.
+
+        spec holds group_by, the name of a property with a value slot,
+        and optionally sum, the name of a number or date property to sum
+        per group. Dates are grouped by an interval: 'hour', 'day',
+        'week', 'month', 'year' or a number of seconds ('day' by default).
+        Returns a list of (key, count, sum) sorted by key, where dates
+        are keyed by the start of their interval. Entries without a value
+        to group by are left out.
+        """
+        query = dict(query)
+        query_string = query.pop('query', None)
+        for name in ['offset', 'limit', 'order_by', 'collapse_versions']:
+            query.pop(name, None)
+
+        group_field = self.schema.get_field(spec.get('group_by'))
+        if group_field is None:
+            raise ValueError('Can not group by %r' % spec.get('group_by'))
+        if group_field.type == schema.DATE:
+            get_bucket = _get_bucket_function(spec.get('interval', 'day'))
+
+            def get_key(value):
+                return get_bucket(xapian.sortable_unserialise(value))
+        elif group_field.type == schema.NUMBER:
+            get_key = xapian.sortable_unserialise
+        else:
+            def get_key(value):
+                return value.decode('utf-8', 'replace')
+
+        sum_slot = None
+        if spec.get('sum'):
+            sum_field = self.schema.get_field(spec['sum'])
+            if sum_field is None or \
+                    sum_field.type not in [schema.NUMBER, schema.DATE]:
+                raise ValueError('Can not sum %r' % spec['sum'])
+            sum_slot = sum_field.slot
+
+        database = self._get_database(query)
+        enquire = Enquire(database)
+        enquire.set_query(
+            self._get_query_parser().parse_query(query, query_string))
+        enquire.set_weighting_scheme(xapian.BoolWeight())
+        spy = _AggregateSpy(group_field.slot, get_key, sum_slot)
+        enquire.add_matchspy(spy)
+        # the spy sees every match checked, so check them all
+        enquire.get_mset(0, 0, database.get_doccount())
+
+        return [(key, count, total)
+                for key, (count, total) in sorted(spy.groups.items())]
+
     def get_activities(self):
         activities = []
         prefix = _PREFIX_FULL_VALUE + _PREFIX_ACTIVITY
-        for term in self._database.allterms(prefix):
+        for term in self._get_database().allterms(prefix):
             activities.append(term.term[len(prefix):])
         return activities
 
@@ -378,8 +1102,8 @@ class IndexStore(object):
     index_updated = property(get_index_updated)
 
     def _set_index_updated(self, index_updated):
-        if self._std_index_path != self._index_path:
-            # operating from tmpfs
+        if self._std_index_path != self._index_path or self._read_only:
+            # operating from tmpfs or on a mounted data store
             return True
         if index_updated != self.index_updated:
             if index_updated:
@@ -410,8 +1134,12 @@ class IndexStore(object):
         if force or self._pending_writes > _FLUSH_THRESHOLD:
             try:
                 logger.debug("Start database flush")
-                self._database.flush()
+                if self._shards is not None:
+                    self._shards.flush()
+                else:
+                    self._database.flush()
                 logger.debug("Completed database flush")
+                self.generation += 1
             except Exception as e:
                 logger.exception(e)
                 logger.error("Exception during database.flush()")
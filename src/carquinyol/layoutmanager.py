@@ -15,12 +15,26 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
+import json
 import logging
+import string
 
 from sugar3 import env
 
 MAX_QUERY_LIMIT = 40960
-CURRENT_LAYOUT_VERSION = 6
+CURRENT_LAYOUT_VERSION = 7
+
+# Entries are stored under DEFAULT_FANOUT_DEPTH levels of directories named
+# after the next DEFAULT_FANOUT_WIDTH characters of their uid
+DEFAULT_FANOUT_DEPTH = 1
+DEFAULT_FANOUT_WIDTH = 2
+# Bucket names must stay within the first, hexadecimal, group of uids
+_MAX_FANOUT_CHARS = 8
+
+# Rewrite the uid manifest once it holds _n_ times more records than uids
+_MANIFEST_COMPACT_RATIO = 2
+# ... but never for fewer than _n_ records
+_MANIFEST_COMPACT_MIN_RECORDS = 1024
 
 
 class LayoutManager(object):
@@ -28,14 +42,28 @@ class LayoutManager(object):
     directory
     """
 
-    def __init__(self):
-        self._root_path = os.path.join(env.get_profile_path(), 'datastore')
+    def __init__(self, root_path=None):
+        self._options = None
+        self._manifest = None
+        self._read_only = root_path is not None
+
+        self._fanout = (DEFAULT_FANOUT_DEPTH, DEFAULT_FANOUT_WIDTH)
+        # fan-out entries are being migrated from, if any
+        self._previous_fanout = None
+
+        if root_path is not None:
+            # a mounted data store, which is only read
+            self._root_path = root_path
+            self._load_layout()
+            return
 
+        self._root_path = os.path.join(env.get_profile_path(), 'datastore')
         if not os.path.exists(self._root_path):
             os.makedirs(self._root_path)
 
+        self._load_layout()
+
         self._create_if_needed(self.get_checksums_dir())
-        self._create_if_needed(self.get_queue_path())
 
     def _create_if_needed(self, path):
         if not os.path.exists(path):
@@ -57,36 +85,228 @@ class LayoutManager(object):
         version_path = os.path.join(self._root_path, 'version')
         open(version_path, 'w').write(str(version))
 
+    def get_option(self, name, default=None):
+        """Return a setting from the options file in the datastore root.
+
+        The file holds a JSON object; missing or unreadable files leave
+        every option at its default.
+        """
+        if self._options is None:
+            self._options = {}
+            options_path = os.path.join(self._root_path, 'options')
+            if os.path.exists(options_path):
+                try:
+                    self._options = json.load(open(options_path, 'r'))
+                except ValueError:
+                    logging.exception('Can not read datastore options')
+
+        return self._options.get(name, default)
+
+    def _get_layout_path(self):
+        return os.path.join(self._root_path, 'layout')
+
+    def _load_layout(self):
+        layout_path = self._get_layout_path()
+        if not os.path.exists(layout_path):
+            return
+        try:
+            layout = json.load(open(layout_path, 'r'))
+            self._fanout = (layout['depth'], layout['width'])
+            if layout.get('previous'):
+                self._previous_fanout = tuple(layout['previous'])
+        except (ValueError, KeyError, TypeError):
+            logging.exception('Can not read layout, using the default one')
+
+    def _save_layout(self):
+        layout = {'depth': self._fanout[0], 'width': self._fanout[1],
+                  'previous': self._previous_fanout}
+        layout_path = self._get_layout_path()
+        f = open(layout_path + '.tmp', 'w')
+        try:
+            json.dump(layout, f)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(layout_path + '.tmp', layout_path)
+
+    def get_fanout(self):
+        return self._fanout
+
+    def get_configured_fanout(self):
+        """Return the fan-out asked for in the options file.
+
+        """
+        depth = self.get_option('fanout_depth', DEFAULT_FANOUT_DEPTH)
+        width = self.get_option('fanout_width', DEFAULT_FANOUT_WIDTH)
+        if depth < 1 or width < 1 or depth * width > _MAX_FANOUT_CHARS:
+            logging.error('Unsupported fan-out of %d levels of %d '
+                          'characters, using the default one', depth, width)
+            return (DEFAULT_FANOUT_DEPTH, DEFAULT_FANOUT_WIDTH)
+        return (depth, width)
+
+    def set_fanout(self, depth, width):
+        """Store new entries under a different fan-out.
+
+        Unless the data store is empty, existing entries need to be moved
+        with migration.FanoutMigration; entries are looked up in both
+        fan-outs until finish_fanout_migration() is called.
+        """
+        if (depth, width) == self._fanout:
+            return
+        if self._previous_fanout is not None:
+            raise ValueError('A fan-out migration is still in progress')
+        if not self.is_empty():
+            self._previous_fanout = self._fanout
+        self._fanout = (depth, width)
+        self._save_layout()
+
+    def save_fanout(self):
+        """Record the fan-out in use in the layout file.
+
+        """
+        self._save_layout()
+
+    def get_previous_fanout(self):
+        return self._previous_fanout
+
+    def finish_fanout_migration(self):
+        self._previous_fanout = None
+        self._save_layout()
+
+    def get_bucket(self, uid, fanout=None):
+        depth, width = fanout or self._fanout
+        if depth == 1:
+            return uid[:width]
+        return '/'.join([uid[i * width:(i + 1) * width]
+                         for i in range(depth)])
+
     def get_entry_path(self, uid):
         # os.path.join() is just too slow
-        return '%s/%s/%s' % (self._root_path, uid[:2], uid)
+        entry_path = '%s/%s/%s' % (self._root_path, self.get_bucket(uid),
+                                   uid)
+        if self._previous_fanout is not None and \
+                not os.path.exists(entry_path):
+            # not migrated yet
+            previous_path = self.get_previous_entry_path(uid)
+            if os.path.exists(previous_path):
+                return previous_path
+        return entry_path
+
+    def get_previous_entry_path(self, uid):
+        return '%s/%s/%s' % (self._root_path,
+                             self.get_bucket(uid, self._previous_fanout), uid)
 
     def get_data_path(self, uid):
-        return '%s/%s/%s/data' % (self._root_path, uid[:2], uid)
+        return self.get_entry_path(uid) + '/data'
 
     def get_metadata_path(self, uid):
-        return '%s/%s/%s/metadata' % (self._root_path, uid[:2], uid)
+        return self.get_entry_path(uid) + '/metadata'
+
+    def get_extracted_path(self, uid):
+        return self.get_entry_path(uid) + '/extracted'
+
+    def list_buckets(self, fanout=None):
+        """Return a dict of the bucket directories of a fan-out, the
+           current one by default, with their modification times.
+
+        """
+        depth, width = fanout or self._fanout
+        level = {'': None}
+        for depth_ in range(depth):
+            next_level = {}
+            for parent in level:
+                parent_path = os.path.join(self._root_path, parent)
+                try:
+                    entries = list(os.scandir(parent_path))
+                except OSError:
+                    continue
+                for entry in entries:
+                    if len(entry.name) == width and \
+                            all(c in string.hexdigits for c in entry.name) \
+                            and entry.is_dir():
+                        next_level[os.path.join(parent, entry.name)] = \
+                            entry.stat().st_mtime_ns
+            level = next_level
+        return level
+
+    def _list_all_buckets(self):
+        buckets = self.list_buckets()
+        if self._previous_fanout is not None:
+            buckets.update(self.list_buckets(self._previous_fanout))
+        return buckets
 
     def get_root_path(self):
         return self._root_path
 
+    def get_read_only(self):
+        return self._read_only
+
+    read_only = property(get_read_only)
+
     def get_index_path(self):
         return os.path.join(self._root_path, 'index')
 
+    def get_exports_path(self):
+        return os.path.join(self._root_path, 'exports')
+
+    def get_blobs_dir(self):
+        return os.path.join(self._root_path, 'blobs')
+
+    def get_blob_path(self, digest):
+        # digests may be tagged with the algorithm, as in 'blake2b:<hex>'
+        bucket = digest[digest.find(':') + 1:][:2]
+        return '%s/blobs/%s/%s' % (self._root_path, bucket, digest)
+
+    def get_chunks_dir(self):
+        return os.path.join(self._root_path, 'chunks')
+
+    def get_chunk_path(self, digest):
+        return '%s/chunks/%s/%s' % (self._root_path, digest[:2], digest)
+
     def get_checksums_dir(self):
         return os.path.join(self._root_path, 'checksums')
 
     def get_queue_path(self):
-        return os.path.join(self.get_checksums_dir(), 'queue')
+        return os.path.join(self.get_checksums_dir(), 'queue.log')
+
+    def get_extraction_queue_path(self):
+        return os.path.join(self._root_path, 'extraction.log')
+
+    def get_manifest_path(self):
+        return os.path.join(self._root_path, 'manifest')
+
+    def _get_manifest(self):
+        if self._manifest is None:
+            manifest_path = None
+            if not self._read_only:
+                manifest_path = self.get_manifest_path()
+            self._manifest = UidManifest(manifest_path, self._root_path,
+                                         self._list_all_buckets)
+        return self._manifest
+
+    def add_entry(self, uid):
+        """Create the directory of a new entry and add it to the manifest.
+
+        """
+        entry_path = self.get_entry_path(uid)
+        if not os.path.exists(entry_path):
+            os.makedirs(entry_path)
+        self._get_manifest().add(uid, self.get_bucket(uid))
+
+    def remove_entry(self, uid, entry_path):
+        """Remove an entry, whose directory at entry_path was removed, from
+           the manifest.
+
+        """
+        bucket = os.path.relpath(os.path.dirname(entry_path),
+                                 self._root_path)
+        self._get_manifest().remove(uid, bucket)
 
     def find_all(self):
-        uids = []
-        for f in os.listdir(self._root_path):
-            if os.path.isdir(os.path.join(self._root_path, f)) and len(f) == 2:
-                for g in os.listdir(os.path.join(self._root_path, f)):
-                    if len(g) == 36:
-                        uids.append(g)
-        return uids
+        manifest = self._get_manifest()
+        manifest.validate()
+        return manifest.get_uids()
 
     def is_empty(self):
         """Check if there is any existing entry.
@@ -97,12 +317,156 @@ class LayoutManager(object):
             # unmigrated 0.82 data store
             return False
 
-        for f in os.listdir(self._root_path):
-            if os.path.isdir(os.path.join(self._root_path, f)) and len(f) == 2:
-                for g in os.listdir(os.path.join(self._root_path, f)):
-                    if len(g) == 36:
-                        return False
-        return True
+        manifest = self._get_manifest()
+        if manifest.has_uids():
+            return False
+        manifest.validate()
+        return not manifest.has_uids()
+
+
+class UidManifest(object):
+    """Keep the list of entries in an append-only file.
+
+    Every entry created or deleted is recorded as a '+uid mtime bucket' or
+    '-uid mtime bucket' line, with the modification time of the entry's
+    bucket directory after the change. Buckets whose modification time differs
+    from the last one recorded were changed behind our back, e.g. by a
+    migration or a crash, and are listed again. Compacting the file keeps
+    the modification time of empty buckets in '- mtime bucket' lines.
+    Without a path, for mounted data stores, the manifest is only kept in
+    memory.
+    """
+
+    def __init__(self, path, root_path, list_buckets):
+        self._path = path
+        self._root_path = root_path
+        self._list_buckets = list_buckets
+        # bucket -> set of uids
+        self._buckets = {}
+        # bucket -> modification time in ns, as last recorded
+        self._mtimes = {}
+        self._records = 0
+        self._fd = None
+
+        if self._path is not None and os.path.exists(self._path):
+            self._load()
+
+    def _load(self):
+        lines = open(self._path, 'r').read().split('\n')
+        # a partial last record was being written when the process died
+        for line in lines[:-1]:
+            try:
+                uid, mtime, bucket = line[1:].split(' ')
+                mtime = int(mtime)
+            except ValueError:
+                logging.warning('Ignoring bad manifest record %r', line)
+                continue
+            uids = self._buckets.setdefault(bucket, set())
+            if line.startswith('+'):
+                uids.add(uid)
+            else:
+                uids.discard(uid)
+            self._mtimes[bucket] = mtime
+            self._records += 1
+
+    def _get_bucket_mtime(self, bucket):
+        try:
+            return os.stat(os.path.join(self._root_path, bucket)).st_mtime_ns
+        except OSError:
+            return 0
+
+    def _write(self, record):
+        if self._path is None:
+            return
+        if self._fd is None:
+            self._fd = os.open(self._path,
+                               os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.write(self._fd, (record + '\n').encode('utf-8'))
+        self._records += 1
+
+    def _compact(self):
+        """Rewrite the file once it holds too many records, which has to
+           be done after updating the entries in memory.
+
+        """
+        if self._records > _MANIFEST_COMPACT_MIN_RECORDS and \
+                self._records > \
+                len(self.get_uids()) * _MANIFEST_COMPACT_RATIO:
+            self._rewrite()
+
+    def add(self, uid, bucket):
+        mtime = self._get_bucket_mtime(bucket)
+        self._buckets.setdefault(bucket, set()).add(uid)
+        self._mtimes[bucket] = mtime
+        self._write('+%s %d %s' % (uid, mtime, bucket))
+        self._compact()
+
+    def remove(self, uid, bucket):
+        mtime = self._get_bucket_mtime(bucket)
+        self._buckets.setdefault(bucket, set()).discard(uid)
+        self._mtimes[bucket] = mtime
+        self._write('-%s %d %s' % (uid, mtime, bucket))
+        self._compact()
+
+    def has_uids(self):
+        for uids in self._buckets.values():
+            if uids:
+                return True
+        return False
+
+    def get_uids(self):
+        uids = []
+        for bucket_uids in self._buckets.values():
+            uids.extend(bucket_uids)
+        return uids
+
+    def validate(self):
+        """List again the buckets changed since they were last recorded.
+
+        """
+        buckets = self._list_buckets()
+        changed = [bucket for bucket in set(buckets) | set(self._buckets)
+                   if buckets.get(bucket, 0) != self._mtimes.get(bucket)]
+        if not changed:
+            return
+
+        logging.debug('Listing %d changed buckets', len(changed))
+        modified = False
+        for bucket in changed:
+            old_uids = self._buckets.pop(bucket, set())
+            self._mtimes.pop(bucket, None)
+            if bucket in buckets:
+                bucket_path = os.path.join(self._root_path, bucket)
+                self._buckets[bucket] = set(
+                    entry.name for entry in os.scandir(bucket_path)
+                    if len(entry.name) == 36)
+                self._mtimes[bucket] = buckets[bucket]
+            if self._buckets.get(bucket, set()) != old_uids:
+                modified = True
+
+        if modified:
+            self._rewrite()
+
+    def _rewrite(self):
+        if self._path is None:
+            return
+        temp_path = self._path + '.tmp'
+        f = open(temp_path, 'w')
+        try:
+            for bucket, uids in self._buckets.items():
+                for uid in uids:
+                    f.write('+%s %d %s\n' % (uid, self._mtimes[bucket],
+                                              bucket))
+                if not uids:
+                    f.write('- %d %s\n' % (self._mtimes[bucket], bucket))
+        finally:
+            f.close()
+        os.rename(temp_path, self._path)
+        self._records = len(self.get_uids())
+
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
 
 
 _instance = None
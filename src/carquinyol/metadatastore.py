@@ -1,5 +1,11 @@
 import os
+import errno
+import hashlib
+import logging
+from collections import OrderedDict
+
 import dbus
+from gi.repository import GLib
 
 from carquinyol import layoutmanager
 from carquinyol import metadatareader
@@ -7,22 +13,75 @@ from carquinyol import metadatareader
 MAX_SIZE = 256
 _INTERNAL_KEYS = ['checksum']
 
+# Merge writes to the same entry arriving within _n_ milliseconds
+_COALESCE_TIMEOUT = 500
+
+# Retry writes that failed after _n_ milliseconds
+_RETRY_TIMEOUT = 10 * 1000
+
+# Keep the fingerprints of at most _n_ entries in memory
+_MAX_FINGERPRINTS = 1024
+
+logger = logging.getLogger('metadatastore')
+
+
+def _normalize_key(key):
+    # Hack to support activities that still pass properties named as
+    # for example title:text.
+    if ':' in key:
+        key = key.split(':', 1)[0]
+    return key
+
+
+def _encode_value(value):
+    if isinstance(value, int):  # int or dbus.Int32
+        return str(value).encode()
+    elif isinstance(value, str):  # str or dbus.String
+        return value.encode()
+    return value
+
+
+def _fingerprint(value):
+    return hashlib.blake2b(value, digest_size=16).digest()
+
 
 class MetadataStore(object):
+    """Store metadata as one file per property.
+
+    Writes are coalesced: incoming properties are compared against a
+    cached fingerprint of what is on disk, unchanged properties are
+    skipped and the remaining ones are written out in one batch per entry
+    after _COALESCE_TIMEOUT, followed by a single directory sync. Reads
+    of an entry with pending writes flush that entry first. Writes that
+    fail are kept pending and retried after _RETRY_TIMEOUT.
+    """
+
+    def __init__(self, layout_manager=None):
+        self._layout_manager = layout_manager or layoutmanager.get_instance()
+        # uid -> {key: fingerprint} of the properties stored on disk
+        self._fingerprints = OrderedDict()
+        # uid -> {key: encoded value, or None for removal}
+        self._pending = {}
+        self._flush_timeout = None
+        self._flushed_callbacks = []
 
     def store(self, uid, metadata):
-        metadata_path = layoutmanager.get_instance().get_metadata_path(uid)
-        if not os.path.exists(metadata_path):
-            os.makedirs(metadata_path)
-        else:
-            received_keys = list(metadata.keys())
-            for key in os.listdir(metadata_path):
-                if key not in _INTERNAL_KEYS and key not in received_keys:
-                    os.remove(os.path.join(metadata_path, key))
+        metadata_path = self._layout_manager.get_metadata_path(uid)
+        fingerprint = self._get_fingerprint(uid, metadata_path)
 
         metadata['uid'] = uid
+        received_keys = set()
         for key, value in list(metadata.items()):
-            self._set_property(uid, key, value, md_path=metadata_path)
+            key = _normalize_key(key)
+            received_keys.add(key)
+            self._queue_write(uid, fingerprint, key, _encode_value(value))
+
+        known_keys = set(fingerprint) | set(self._pending.get(uid, {}))
+        for key in known_keys:
+            if key not in _INTERNAL_KEYS and key not in received_keys:
+                self._queue_write(uid, fingerprint, key, None)
+
+        self._schedule_flush()
 
     def _set_property(self, uid, key, value, md_path=False):
         """Set a property in metadata store
@@ -36,33 +95,156 @@ class MetadataStore(object):
         * "checksum" of str.
         """
         if not md_path:
-            md_path = layoutmanager.get_instance().get_metadata_path(uid)
-        # Hack to support activities that still pass properties named as
-            # for example title:text.
-        if ':' in key:
-            key = key.split(':', 1)[0]
-
-        changed = True
-        fpath = os.path.join(md_path, key)
-        tpath = os.path.join(md_path, '.' + key)
-
-        if isinstance(value, int):  # int or dbus.Int32
-            value = str(value).encode()
-        elif isinstance(value, str):  # str or dbus.String
-            value = value.encode()
-
-        # avoid pointless writes; replace atomically
-        if os.path.exists(fpath):
-            f = open(fpath, 'rb')
-            stored_val = f.read()
-            f.close()
-            if stored_val == value:
-                changed = False
-        if changed:
+            md_path = self._layout_manager.get_metadata_path(uid)
+        fingerprint = self._get_fingerprint(uid, md_path)
+        self._queue_write(uid, fingerprint, _normalize_key(key),
+                          _encode_value(value))
+        self._schedule_flush()
+
+    def _get_fingerprint(self, uid, metadata_path):
+        """Return the fingerprints of the properties stored for an entry,
+           reading them from disk only if they are not cached.
+
+        """
+        if uid in self._fingerprints:
+            self._fingerprints.move_to_end(uid)
+            return self._fingerprints[uid]
+
+        fingerprint = {}
+        if not os.path.exists(metadata_path):
+            os.makedirs(metadata_path)
+        else:
+            for key in os.listdir(metadata_path):
+                if key.startswith('.'):
+                    continue
+                f = open(os.path.join(metadata_path, key), 'rb')
+                try:
+                    fingerprint[key] = _fingerprint(f.read())
+                finally:
+                    f.close()
+
+        self._fingerprints[uid] = fingerprint
+        self._evict_fingerprints()
+        return fingerprint
+
+    def _evict_fingerprints(self):
+        for uid in list(self._fingerprints.keys()):
+            if len(self._fingerprints) <= _MAX_FINGERPRINTS:
+                break
+            if uid not in self._pending:
+                del self._fingerprints[uid]
+
+    def _queue_write(self, uid, fingerprint, key, value):
+        pending = self._pending.setdefault(uid, {})
+        if value is None:
+            if key in fingerprint:
+                pending[key] = None
+            else:
+                pending.pop(key, None)
+        elif fingerprint.get(key) == _fingerprint(value):
+            # avoid pointless writes
+            pending.pop(key, None)
+        else:
+            pending[key] = value
+
+        if not pending:
+            del self._pending[uid]
+
+    def _schedule_flush(self):
+        if self._flush_timeout is None and self._pending:
+            self._flush_timeout = GLib.timeout_add(_COALESCE_TIMEOUT,
+                                                   self._flush_timeout_cb)
+        elif not self._pending:
+            self._run_flushed_callbacks()
+
+    def _flush_timeout_cb(self):
+        self._flush_timeout = None
+        self.flush()
+        return False
+
+    def _flush_entry(self, uid):
+        # only dropped once written, to be retried if writing fails
+        pending = self._pending.get(uid)
+        if not pending:
+            return
+
+        md_path = self._layout_manager.get_metadata_path(uid)
+        fingerprint = self._fingerprints.get(uid, {})
+        logger.debug('flushing %d properties of %r', len(pending), uid)
+        if not os.path.exists(md_path):
+            os.makedirs(md_path)
+
+        # replace atomically
+        for key, value in pending.items():
+            fpath = os.path.join(md_path, key)
+            if value is None:
+                try:
+                    os.remove(fpath)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                fingerprint.pop(key, None)
+                continue
+
+            tpath = os.path.join(md_path, '.' + key)
             f = open(tpath, 'wb')
             f.write(value)
             f.close()
             os.rename(tpath, fpath)
+            fingerprint[key] = _fingerprint(value)
+
+        dir_fd = os.open(md_path, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        del self._pending[uid]
+
+    def flush_entry(self, uid):
+        """Write out the pending changes of a given entry."""
+        try:
+            self._flush_entry(uid)
+        except Exception:
+            # kept pending, read back what made it to disk on the next store
+            self._fingerprints.pop(uid, None)
+            raise
+
+    def flush(self):
+        """Write out all pending changes."""
+        if self._flush_timeout is not None:
+            GLib.source_remove(self._flush_timeout)
+            self._flush_timeout = None
+
+        for uid in list(self._pending.keys()):
+            try:
+                self._flush_entry(uid)
+            except Exception:
+                logger.exception('Error writing metadata of %r', uid)
+                self._fingerprints.pop(uid, None)
+
+        self._evict_fingerprints()
+        if self._pending:
+            self._flush_timeout = GLib.timeout_add(_RETRY_TIMEOUT,
+                                                   self._flush_timeout_cb)
+        else:
+            self._run_flushed_callbacks()
+
+    def call_when_flushed(self, callback):
+        """Call callback once there are no pending writes left."""
+        self._flushed_callbacks.append(callback)
+        if not self._pending:
+            self._run_flushed_callbacks()
+
+    def cancel_when_flushed(self, callback):
+        """Forget a callback passed to call_when_flushed()."""
+        while callback in self._flushed_callbacks:
+            self._flushed_callbacks.remove(callback)
+
+    def _run_flushed_callbacks(self):
+        callbacks = self._flushed_callbacks
+        self._flushed_callbacks = []
+        for callback in callbacks:
+            callback()
 
     def retrieve(self, uid, properties=None):
         """Retrieve metadata for an object from the store.
@@ -70,7 +252,8 @@ class MetadataStore(object):
         Values are read as dbus.ByteArray, then converted to expected
         types.
         """
-        metadata_path = layoutmanager.get_instance().get_metadata_path(uid)
+        self._flush_entry(uid)
+        metadata_path = self._layout_manager.get_metadata_path(uid)
 
         if properties is not None:
             properties = [x.encode('utf-8') if isinstance(x, str)
@@ -90,13 +273,20 @@ class MetadataStore(object):
         return metadata
 
     def delete(self, uid):
-        metadata_path = layoutmanager.get_instance().get_metadata_path(uid)
+        self._pending.pop(uid, None)
+        self._fingerprints.pop(uid, None)
+        metadata_path = self._layout_manager.get_metadata_path(uid)
         for key in os.listdir(metadata_path):
             os.remove(os.path.join(metadata_path, key))
         os.rmdir(metadata_path)
 
     def get_property(self, uid, key):
-        metadata_path = layoutmanager.get_instance().get_metadata_path(uid)
+        pending = self._pending.get(uid, {})
+        if key in pending:
+            value = pending[key]
+            return value.decode() if value is not None else None
+
+        metadata_path = self._layout_manager.get_metadata_path(uid)
         property_path = os.path.join(metadata_path, key)
         if os.path.exists(property_path):
             return open(property_path, 'r').read()
@@ -26,6 +26,14 @@ import json
 from carquinyol import layoutmanager
 
 DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+# Move up to _n_ entries to a new fan-out per main loop iteration
+_FANOUT_BATCH = 50
+# Go over the entries left behind again after _n_ seconds, doubling the
+# delay after each pass up to _FANOUT_MAX_RETRY_DELAY seconds
+_FANOUT_RETRY_DELAY = 5
+_FANOUT_MAX_RETRY_DELAY = 10 * 60
+# Give up on moving an entry after _n_ errors
+_FANOUT_MAX_ERRORS = 5
 logger = logging.getLogger('migration')
 
 
@@ -101,3 +109,135 @@ def _migrate_preview(root_path, old_root_path, uid):
     metadata_path = layoutmanager.get_instance().get_metadata_path(uid)
     os.rename(os.path.join(old_root_path, 'preview', uid),
               os.path.join(metadata_path, 'preview'))
+
+
+def migrate_from_6():
+    """Record the fan-out of version 6 data stores in the layout file.
+
+    Entries stay where they are, so the index remains valid.
+    """
+    logger.info('Migrating datastore from version 6 to version 7')
+    layoutmanager.get_instance().save_fanout()
+
+
+class FanoutMigration(object):
+    """Move entries from the previous fan-out of the layout manager to the
+       current one, a few at a time, while the data store is in use.
+
+    Each entry is moved with a single rename, so the migration can stop at
+    any point and carries on at the next start. Entries being written to,
+    as told by is_busy, or that could not be moved are left for another
+    pass, after retry_delay seconds. Entries that keep failing are given
+    up on until the next start, the migration staying unfinished. Only
+    paths change, so the index does not need to be rebuilt.
+    """
+
+    def __init__(self, is_busy=None):
+        self._is_busy = is_busy
+        self._buckets = None
+        self._bucket = None
+        self._uids = []
+        self._skipped = 0
+        self._moved = 0
+        self._passes = 0
+        # uid -> errors moving it
+        self._errors = {}
+        self._given_up = set()
+        self.retry_delay = None
+
+    def step(self):
+        """Move up to _FANOUT_BATCH entries. Return False once done, or to
+           be called again after retry_delay seconds if it is not None.
+
+        """
+        layout_manager = layoutmanager.get_instance()
+        if self._buckets is None:
+            self._buckets = sorted(layout_manager.list_buckets(
+                layout_manager.get_previous_fanout()))
+            self._skipped = 0
+
+        moved = 0
+        while moved < _FANOUT_BATCH:
+            if not self._uids:
+                if self._bucket is not None:
+                    self._remove_bucket(self._bucket)
+                    self._bucket = None
+                if not self._buckets:
+                    break
+                self._bucket = self._buckets.pop()
+                bucket_path = os.path.join(layout_manager.get_root_path(),
+                                           self._bucket)
+                self._uids = [entry.name
+                              for entry in os.scandir(bucket_path)
+                              if len(entry.name) == 36]
+                continue
+
+            uid = self._uids.pop()
+            if uid in self._given_up:
+                continue
+            if self._is_busy is not None and self._is_busy(uid):
+                self._skipped += 1
+                continue
+            try:
+                self._move(uid)
+            except OSError:
+                logger.exception('Error moving entry %r', uid)
+                self._errors[uid] = self._errors.get(uid, 0) + 1
+                if self._errors[uid] < _FANOUT_MAX_ERRORS:
+                    self._skipped += 1
+                else:
+                    logger.error('Giving up on moving entry %r', uid)
+                    self._given_up.add(uid)
+                continue
+            moved += 1
+
+        self._moved += moved
+        if not self._uids and self._bucket is not None:
+            self._remove_bucket(self._bucket)
+            self._bucket = None
+        if self._buckets or self._uids:
+            return True
+        if self._skipped:
+            # go over the entries left behind again later
+            self._buckets = None
+            self.retry_delay = min(
+                _FANOUT_RETRY_DELAY * 2 ** self._passes,
+                _FANOUT_MAX_RETRY_DELAY)
+            self._passes += 1
+            return False
+
+        self.retry_delay = None
+        if self._given_up:
+            logger.error('Moved %d entries to the new fan-out, but not %r, '
+                         'trying again at the next start', self._moved,
+                         sorted(self._given_up))
+            return False
+
+        logger.info('Moved %d entries to the new fan-out', self._moved)
+        layout_manager.finish_fanout_migration()
+        return False
+
+    def _move(self, uid):
+        layout_manager = layoutmanager.get_instance()
+        old_path = layout_manager.get_previous_entry_path(uid)
+        new_path = os.path.join(layout_manager.get_root_path(),
+                                layout_manager.get_bucket(uid), uid)
+        if os.path.exists(new_path):
+            logger.warning('Entry %r exists in both fan-outs, keeping the '
+                           'new one', uid)
+            shutil.rmtree(old_path)
+            return
+
+        new_dir = os.path.dirname(new_path)
+        if not os.path.exists(new_dir):
+            os.makedirs(new_dir)
+        os.rename(old_path, new_path)
+
+    def _remove_bucket(self, bucket):
+        bucket_path = os.path.join(
+            layoutmanager.get_instance().get_root_path(), bucket)
+        try:
+            # along with the parents left empty
+            os.removedirs(bucket_path)
+        except OSError:
+            pass
@@ -0,0 +1,121 @@
+import os
+import logging
+import shutil
+import tempfile
+
+from gi.repository import GLib
+
+from carquinyol.layoutmanager import LayoutManager
+from carquinyol.metadatastore import MetadataStore
+from carquinyol.indexstore import IndexStore
+
+# Index up to _n_ entries per main loop iteration
+_INDEX_BATCH = 50
+
+logger = logging.getLogger('mountedstore')
+
+
+class MountedStore(object):
+    """A data store at another root, e.g. on a USB stick or a shared
+       folder, searched along with the main one.
+
+    Mounted data stores are only read. Their index is built in a temporary
+    directory, a batch of entries per main loop iteration, and removed on
+    unmount; they can only be searched once it is ready. Only entries
+    whose data is stored as a plain file can be retrieved.
+    """
+
+    def __init__(self, mount_id, root_path):
+        if not os.path.isdir(root_path):
+            raise ValueError('No data store at %s' % root_path)
+
+        self.mount_id = mount_id
+        self.root_path = root_path
+        self._layout_manager = LayoutManager(root_path)
+        self._metadata_store = MetadataStore(self._layout_manager)
+        # the index once built, and while being built
+        self._index_store = None
+        self._new_index_store = None
+        self._index_path = None
+        self._uids = None
+        self._index_id = GLib.idle_add(self._index_cb,
+                                       priority=GLib.PRIORITY_LOW)
+
+    def get_descriptor(self):
+        return {'id': self.mount_id,
+                'uri': self.root_path,
+                'title': os.path.basename(self.root_path.rstrip('/'))}
+
+    def _index_cb(self):
+        if self._new_index_store is None:
+            self._index_path = tempfile.mkdtemp(
+                prefix='sugar-datastore-mount-')
+            self._new_index_store = IndexStore(self._layout_manager)
+            self._new_index_store.open_index(temp_path=self._index_path)
+            self._uids = self._layout_manager.find_all()
+            logger.debug('Indexing %d entries of %s', len(self._uids),
+                          self.root_path)
+
+        for uid in self._uids[-_INDEX_BATCH:]:
+            try:
+                self._new_index_store.store(
+                    uid, self._metadata_store.retrieve(uid), flush=False)
+            except Exception:
+                logger.exception('Error indexing %r in %s', uid,
+                                 self.root_path)
+        del self._uids[-_INDEX_BATCH:]
+        if self._uids:
+            return True
+
+        self._new_index_store.flush()
+        self._index_store = self._new_index_store
+        self._new_index_store = None
+        self._index_id = None
+        logger.debug('Indexed %s', self.root_path)
+        return False
+
+    def get_ready(self):
+        return self._index_store is not None
+
+    ready = property(get_ready)
+
+    def find(self, query, sort_values=False):
+        return self._index_store.find(query, sort_values)
+
+    def has_entry(self, uid):
+        return os.path.exists(self._layout_manager.get_entry_path(uid))
+
+    def retrieve(self, uid, properties=None):
+        metadata = self._metadata_store.retrieve(uid, properties)
+        if not properties or 'uid' in properties:
+            metadata['uid'] = uid
+        if not properties or 'filesize' in properties:
+            metadata['filesize'] = str(self.get_file_size(uid))
+        if not properties or 'mountpoint' in properties:
+            metadata['mountpoint'] = self.mount_id
+        return metadata
+
+    def get_file_path(self, uid):
+        file_path = self._layout_manager.get_data_path(uid)
+        if not os.path.exists(file_path):
+            return ''
+        return file_path
+
+    def get_file_size(self, uid):
+        file_path = self.get_file_path(uid)
+        if not file_path:
+            return 0
+        return os.stat(file_path).st_size
+
+    def close(self):
+        if self._index_id is not None:
+            GLib.source_remove(self._index_id)
+            self._index_id = None
+        for index_store in [self._index_store, self._new_index_store]:
+            if index_store is not None:
+                index_store.close_index()
+        self._index_store = None
+        self._new_index_store = None
+        if self._index_path is not None:
+            shutil.rmtree(self._index_path, ignore_errors=True)
+            self._index_path = None
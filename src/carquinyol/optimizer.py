@@ -15,17 +15,127 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
-import errno
+import json
 import logging
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 from gi.repository import GLib
 
+from carquinyol import hashing
 from carquinyol import layoutmanager
+from carquinyol.checksumindex import ChecksumIndex
+from carquinyol.persistentqueue import PersistentQueue
+
+# Hash up to _n_ entries at the same time
+_HASH_WORKERS = min(4, os.cpu_count() or 1)
 
 logger = logging.getLogger('optimizer')
 
 
+def _find_duplicates(path, candidates):
+    """Hash an entry's file as far as needed to tell whether it has the same
+       content as any of the candidates, files of the same size.
+
+    candidates is a list of (uid, path, partial checksum or None, checksum
+    or None). Returns the partial checksum and, if some candidate's partial
+    checksum matches, the checksum of the file, together with a dict of the
+    (partial checksum, checksum) calculated for candidates.
+    """
+    partial = hashing.hash_file_ends(path)
+    calculated = {}
+    matches = []
+    for uid, candidate_path, candidate_partial, checksum in candidates:
+        if candidate_partial is None:
+            candidate_partial = hashing.hash_file_ends(candidate_path)
+            calculated[uid] = (candidate_partial, None)
+        if candidate_partial == partial:
+            matches.append((uid, candidate_path, checksum))
+
+    if not matches:
+        return partial, None, calculated
+
+    checksum = hashing.hash_file(path)
+    for uid, candidate_path, candidate_checksum in matches:
+        if candidate_checksum is None:
+            calculated[uid] = (partial, hashing.hash_file(candidate_path))
+    return partial, checksum, calculated
+
+
+class SizeIndex(object):
+    """Remember the data size and partial checksum of optimized entries.
+
+    Only entries of the same size can be duplicates, so an entry with a
+    unique size does not need to be hashed at all.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        # uid -> [size, partial checksum or None]
+        self._entries = {}
+        # size -> set of uids
+        self._by_size = {}
+        self._save_id = None
+
+        if os.path.exists(self._path):
+            try:
+                for uid, (size, partial) in \
+                        json.load(open(self._path, 'r')).items():
+                    self.add(uid, size, partial, save=False)
+            except (IOError, ValueError):
+                logger.exception('Can not read size index, starting afresh')
+
+    def add(self, uid, size, partial=None, save=True):
+        self.remove(uid, save=False)
+        self._entries[uid] = [size, partial]
+        self._by_size.setdefault(size, set()).add(uid)
+        if save:
+            self._schedule_save()
+
+    def remove(self, uid, save=True):
+        if uid not in self._entries:
+            return
+        size, partial_ = self._entries.pop(uid)
+        self._by_size[size].discard(uid)
+        if not self._by_size[size]:
+            del self._by_size[size]
+        if save:
+            self._schedule_save()
+
+    def set_partial(self, uid, partial):
+        if uid in self._entries:
+            self._entries[uid][1] = partial
+            self._schedule_save()
+
+    def get_partial(self, uid):
+        return self._entries[uid][1]
+
+    def __contains__(self, uid):
+        return uid in self._entries
+
+    def get_same_size(self, uid, size):
+        return [other for other in self._by_size.get(size, [])
+                if other != uid]
+
+    def _schedule_save(self):
+        if self._save_id is None:
+            self._save_id = GLib.idle_add(self._save_cb,
+                                          priority=GLib.PRIORITY_LOW)
+
+    def _save_cb(self):
+        self._save_id = None
+        temp_path = self._path + '.tmp'
+        try:
+            f = open(temp_path, 'w')
+            try:
+                json.dump(self._entries, f)
+            finally:
+                f.close()
+            os.rename(temp_path, self._path)
+        except (IOError, OSError):
+            logger.exception('Can not write size index')
+        return False
+
+
 class Optimizer(object):
     """Optimizes disk space usage by detecting duplicates and sharing storage.
     """
@@ -34,136 +144,207 @@ class Optimizer(object):
         self._file_store = file_store
         self._metadata_store = metadata_store
         self._enqueue_checksum_id = None
+        self._hashing = set()
+        self._executor = ThreadPoolExecutor(max_workers=_HASH_WORKERS)
 
-    def optimize(self, uid):
-        """Add an entry to a queue of entries to be checked for duplicates.
+        checksums_dir = layoutmanager.get_instance().get_checksums_dir()
+        self._queue = PersistentQueue(
+            layoutmanager.get_instance().get_queue_path())
+        self._migrate_queue_dir(os.path.join(checksums_dir, 'queue'))
+        self._checksums = ChecksumIndex(checksums_dir)
+
+        sizes_path = os.path.join(checksums_dir, 'sizes')
+        seed = not os.path.exists(sizes_path)
+        self._size_index = SizeIndex(sizes_path)
+        if seed:
+            self._seed_size_index()
+
+    def _migrate_queue_dir(self, queue_dir):
+        """Move the entries queued by earlier versions, as empty files in a
+           directory, to the queue.
 
         """
-        if not os.path.exists(self._file_store.get_file_path(uid)):
+        if not os.path.isdir(queue_dir):
             return
+        for uid in os.listdir(queue_dir):
+            self._queue.append(uid)
+        for uid in os.listdir(queue_dir):
+            os.remove(os.path.join(queue_dir, uid))
+        os.rmdir(queue_dir)
+        if self._queue:
+            self._schedule()
 
-        queue_path = layoutmanager.get_instance().get_queue_path()
-        open(os.path.join(queue_path, uid), 'w').close()
-        logger.debug('optimize %r', os.path.join(queue_path, uid))
+    def _seed_size_index(self):
+        """Add the entries optimized by earlier versions to the size index.
 
-        if self._enqueue_checksum_id is None:
-            self._enqueue_checksum_id = \
-                GLib.idle_add(self._process_entry_cb,
-                              priority=GLib.PRIORITY_LOW)
+        """
+        for uid in self._checksums.get_all_uids():
+            file_path = self._file_store.get_file_path(uid)
+            if os.path.exists(file_path):
+                self._size_index.add(uid, os.stat(file_path).st_size)
 
-    def remove(self, uid):
-        """Remove any structures left from space optimization
+    def optimize(self, uid):
+        """Add an entry to a queue of entries to be checked for duplicates.
 
         """
-        checksum = self._metadata_store.get_property(uid, 'checksum')
-        if checksum is None:
+        if self._file_store.content_addressed:
+            # duplicates already share storage as they are stored
             return
 
-        checksums_dir = layoutmanager.get_instance().get_checksums_dir()
-        checksum_path = os.path.join(checksums_dir, checksum)
-        checksum_entry_path = os.path.join(checksum_path, uid)
+        if not os.path.exists(self._file_store.get_file_path(uid)):
+            return
 
-        if os.path.exists(checksum_entry_path):
-            logger.debug('remove %r', checksum_entry_path)
-            os.remove(checksum_entry_path)
+        if self._queue.append(uid):
+            logger.debug('optimize %r', uid)
 
-        if os.path.exists(checksum_path):
-            try:
-                os.rmdir(checksum_path)
-                logger.debug('removed %r', checksum_path)
-            except OSError as e:
-                if e.errno != errno.ENOTEMPTY:
-                    raise
+        self._schedule()
 
-    def _identical_file_already_exists(self, checksum):
-        """Check if we already have files with this checksum.
+    def remove(self, uid):
+        """Remove any structures left from space optimization
 
         """
-        checksums_dir = layoutmanager.get_instance().get_checksums_dir()
-        checksum_path = os.path.join(checksums_dir, checksum)
-        return os.path.exists(checksum_path)
+        self._size_index.remove(uid)
 
-    def _get_uid_from_checksum(self, checksum):
-        """Get an existing entry which file matches checksum.
-
-        """
-        checksums_dir = layoutmanager.get_instance().get_checksums_dir()
-        checksum_path = os.path.join(checksums_dir, checksum)
-        first_uid = os.listdir(checksum_path)[0]
-        return first_uid
+        checksum = self._checksums.remove(uid)
+        if checksum is not None:
+            logger.debug('removed %r from checksum %r', uid, checksum)
 
-    def _create_checksum_dir(self, checksum):
-        """Create directory that tracks files with this same checksum.
+    def get_checksum(self, uid):
+        """Return the checksum of an entry's data as of its last check for
+           duplicates, None if it was not checked yet.
 
         """
-        checksums_dir = layoutmanager.get_instance().get_checksums_dir()
-        checksum_path = os.path.join(checksums_dir, checksum)
-        logger.debug('create dir %r', checksum_path)
-        os.mkdir(checksum_path)
+        return self._checksums.get_checksum(uid)
 
-    def _add_checksum_entry(self, uid, checksum):
-        """Create a file in the checksum dir with the uid of the entry
+    def add_checksum(self, uid, checksum, size=None):
+        """Record the checksum of an entry, sharing the file of an entry
+           with identical content if there is one.
 
         """
-        checksums_dir = layoutmanager.get_instance().get_checksums_dir()
-        checksum_path = os.path.join(checksums_dir, checksum)
+        if size is not None and uid not in self._size_index:
+            self._size_index.add(uid, size)
 
-        logger.debug('touch %r', os.path.join(checksum_path, uid))
-        open(os.path.join(checksum_path, uid), 'w').close()
+        self._metadata_store.set_property(uid, 'checksum', checksum)
 
-    def _already_linked(self, uid, checksum):
-        """Check if this entry's file is already a hard link to the checksums
-           dir.
+        if self._checksums.get_checksum(uid) == checksum:
+            # already sharing the file of the identical entries, if any
+            return
 
-        """
-        checksums_dir = layoutmanager.get_instance().get_checksums_dir()
-        checksum_path = os.path.join(checksums_dir, checksum)
-        return os.path.exists(os.path.join(checksum_path, uid))
+        identical = self._checksums.get_uids(checksum)
+        if identical:
+            existing_entry_uid = next(iter(identical))
+            self._file_store.hard_link_entry(uid, existing_entry_uid)
+        self._checksums.add(uid, checksum)
+
+    def _schedule(self):
+        if self._enqueue_checksum_id is None:
+            self._enqueue_checksum_id = \
+                GLib.idle_add(self._process_entry_cb,
+                              priority=GLib.PRIORITY_LOW)
 
     def _process_entry_cb(self):
-        """Process one item in the checksums queue by calculating its checksum,
-           checking if there exist already an identical file, and in that case
-           substituting its file with a hard link to that pre-existing file.
+        """Start looking for duplicates of queued entries, up to
+           _HASH_WORKERS at a time.
 
+        Entries with a size no other entry has are only added to the size
+        index. Otherwise the first and last blocks are hashed first and
+        whole files only when those match.
         """
-        queue_path = layoutmanager.get_instance().get_queue_path()
-        queue = os.listdir(queue_path)
-        if queue:
-            uid = queue[0]
-            logger.debug('_process_entry_cb processing %r', uid)
+        self._enqueue_checksum_id = None
+
+        for uid in self._queue:
+            if len(self._hashing) >= _HASH_WORKERS:
+                break
+            if uid in self._hashing:
+                continue
 
+            logger.debug('_process_entry_cb processing %r', uid)
             file_in_entry_path = self._file_store.get_file_path(uid)
             if not os.path.exists(file_in_entry_path):
                 logger.info('non-existent entry in queue: %r', uid)
-            else:
-                checksum = self._calculate_md5sum(file_in_entry_path)
-                self._metadata_store.set_property(uid, 'checksum', checksum)
-
-                if self._identical_file_already_exists(checksum):
-                    if not self._already_linked(uid, checksum):
-                        existing_entry_uid = \
-                            self._get_uid_from_checksum(checksum)
-
-                        self._file_store.hard_link_entry(uid,
-                                                         existing_entry_uid)
-
-                        self._add_checksum_entry(uid, checksum)
-                else:
-                    self._create_checksum_dir(checksum)
-                    self._add_checksum_entry(uid, checksum)
-
-            os.remove(os.path.join(queue_path, uid))
-
-        if len(queue) <= 1:
-            self._enqueue_checksum_id = None
+                self._queue.remove(uid)
+                continue
+
+            stat = os.stat(file_in_entry_path)
+            same_size = self._size_index.get_same_size(uid, stat.st_size)
+            if not same_size:
+                logger.debug('%r has a unique size', uid)
+                self._size_index.add(uid, stat.st_size)
+                self._queue.remove(uid)
+                continue
+
+            candidates = []
+            stats = {uid: stat}
+            for other in same_size:
+                other_path = self._file_store.get_file_path(other)
+                try:
+                    stats[other] = os.stat(other_path)
+                except OSError:
+                    continue
+                checksum = self._metadata_store.get_property(other,
+                                                             'checksum')
+                if checksum is not None and \
+                        hashing.get_algorithm(checksum) != \
+                        hashing.DEFAULT_ALGORITHM:
+                    checksum = None
+                candidates.append((other, other_path,
+                                   self._size_index.get_partial(other),
+                                   checksum))
+
+            self._hashing.add(uid)
+            future = self._executor.submit(_find_duplicates,
+                                           file_in_entry_path, candidates)
+            future.add_done_callback(
+                lambda future, uid=uid, stats=stats:
+                GLib.idle_add(self._hashed_cb, uid, stats, future))
+
+        return False
+
+    def _is_unchanged(self, uid, stat):
+        try:
+            current = os.stat(self._file_store.get_file_path(uid))
+        except OSError:
             return False
-        else:
-            return True
+        return (current.st_ino, current.st_size, current.st_mtime_ns) == \
+            (stat.st_ino, stat.st_size, stat.st_mtime_ns)
 
-    def _calculate_md5sum(self, path):
-        """Calculate the md5 checksum of a given file.
+    def _hashed_cb(self, uid, stats, future):
+        """Record what was learnt about a queued entry and the entries of
+           the same size; if there exist already an identical file,
+           substitute its file with a hard link to that pre-existing file.
 
         """
-        popen = subprocess.Popen(['md5sum', path], stdout=subprocess.PIPE)
-        stdout, __ = popen.communicate()
-        return stdout.split(b' ', 1)[0].decode()
+        self._hashing.discard(uid)
+
+        try:
+            partial, checksum, calculated = future.result()
+        except Exception:
+            logger.exception('Error calculating checksum of %r', uid)
+            partial = None
+
+        try:
+            if partial is None:
+                pass
+            elif not self._is_unchanged(uid, stats[uid]):
+                # replaced or removed while hashing, an update enqueues it
+                # again
+                logger.debug('%r changed while being hashed', uid)
+            else:
+                for other, (other_partial, other_checksum) in \
+                        calculated.items():
+                    if not self._is_unchanged(other, stats[other]):
+                        continue
+                    self._size_index.set_partial(other, other_partial)
+                    if other_checksum is not None:
+                        self.add_checksum(other, other_checksum)
+
+                self._size_index.add(uid, stats[uid].st_size, partial)
+                if checksum is not None:
+                    self.add_checksum(uid, checksum)
+        except Exception:
+            logger.exception('Error recording checksum of %r', uid)
+        finally:
+            # never stall the queue on one entry
+            self._queue.remove(uid)
+            self._schedule()
+        return False
@@ -0,0 +1,116 @@
+import os
+import collections
+import logging
+
+from gi.repository import GLib
+
+# Rewrite the log once it holds _n_ times more records than queued items
+_COMPACT_RATIO = 4
+# ... but never for fewer than _n_ records
+_COMPACT_MIN_RECORDS = 256
+
+logger = logging.getLogger('persistentqueue')
+
+
+class PersistentQueue(object):
+    """A FIFO queue of uids kept in memory and in an append-only log.
+
+    Every change is appended to the log as a '+uid' or '-uid' line before
+    it is made in memory, so a queue survives crashes the same way the
+    empty files of the former queue directory did. Queueing a uid that is
+    already queued does nothing. The log is rewritten with only the queued
+    uids once it is mostly made of stale records.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._queue = collections.deque()
+        self._queued = set()
+        self._records = 0
+        self._compact_id = None
+        self._fd = None
+
+        if os.path.exists(self._path):
+            self._load()
+        self._fd = os.open(self._path,
+                           os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _load(self):
+        data = open(self._path, 'r').read()
+        lines = data.split('\n')
+        # a partial last record was being written when the process died
+        for line in lines[:-1]:
+            uid = line[1:]
+            if line.startswith('+') and uid not in self._queued:
+                self._queue.append(uid)
+                self._queued.add(uid)
+            elif line.startswith('-') and uid in self._queued:
+                self._queue.remove(uid)
+                self._queued.discard(uid)
+            self._records += 1
+        if lines[-1]:
+            logger.warning('Ignoring partial record in %s', self._path)
+            self._rewrite()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __contains__(self, uid):
+        return uid in self._queued
+
+    def __iter__(self):
+        return iter(list(self._queue))
+
+    def append(self, uid):
+        """Add uid to the end of the queue, unless it is already queued.
+
+        """
+        if uid in self._queued:
+            return False
+        self._write('+' + uid)
+        self._queue.append(uid)
+        self._queued.add(uid)
+        return True
+
+    def remove(self, uid):
+        if uid not in self._queued:
+            return
+        self._write('-' + uid)
+        if self._queue[0] == uid:
+            self._queue.popleft()
+        else:
+            self._queue.remove(uid)
+        self._queued.discard(uid)
+
+    def _write(self, record):
+        os.write(self._fd, (record + '\n').encode('utf-8'))
+        self._records += 1
+        if self._records > _COMPACT_MIN_RECORDS and \
+                self._records > len(self._queue) * _COMPACT_RATIO and \
+                self._compact_id is None:
+            self._compact_id = GLib.idle_add(self._compact_cb,
+                                             priority=GLib.PRIORITY_LOW)
+
+    def _compact_cb(self):
+        self._compact_id = None
+        logger.debug('compacting %s from %d to %d records', self._path,
+                     self._records, len(self._queue))
+        self._rewrite()
+        return False
+
+    def _rewrite(self):
+        temp_path = self._path + '.tmp'
+        f = open(temp_path, 'w')
+        try:
+            for uid in self._queue:
+                f.write('+%s\n' % uid)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(temp_path, self._path)
+        self._records = len(self._queue)
+
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = os.open(self._path, os.O_WRONLY | os.O_APPEND)
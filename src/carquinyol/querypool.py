@@ -0,0 +1,137 @@
+import os
+import logging
+from concurrent.futures.process import BrokenProcessPool
+
+import dbus
+from gi.repository import GLib
+import xapian
+
+from carquinyol import workerpool
+from carquinyol.indexstore import IndexStore
+
+# Use at most _n_ query worker processes by default
+_MAX_WORKERS = 4
+
+logger = logging.getLogger('querypool')
+
+# In a worker process: the index searched, the inode of its directory
+# and the generation of the writer it last caught up with
+_index_store = None
+_index_path = None
+_index_inode = None
+_generation = None
+
+
+def get_worker_count(configured=None):
+    """Return the number of query worker processes to use, 0 or 1 meaning
+       none.
+
+    """
+    if configured is not None:
+        return int(configured)
+    return min(os.cpu_count() or 1, _MAX_WORKERS)
+
+
+def _unwrap(value):
+    """Turn D-Bus values into plain Python ones, to pass them to worker
+       processes.
+
+    """
+    if isinstance(value, dict):
+        return dict((_unwrap(key), _unwrap(item))
+                    for key, item in value.items())
+    elif isinstance(value, tuple):
+        return tuple(_unwrap(item) for item in value)
+    elif isinstance(value, list):
+        return [_unwrap(item) for item in value]
+    elif isinstance(value, dbus.Boolean):
+        return bool(value)
+    elif isinstance(value, bytes):
+        return bytes(value)
+    elif isinstance(value, str):
+        return str(value)
+    elif isinstance(value, int):
+        return int(value)
+    elif isinstance(value, float):
+        return float(value)
+    return value
+
+
+def _open(index_path, generation):
+    global _index_store, _index_path, _index_inode, _generation
+
+    # a compacted index replaces the directory of the index
+    inode = os.stat(index_path).st_ino
+    if _index_store is not None and _index_path == index_path and \
+            _index_inode == inode:
+        try:
+            _index_store.reopen_index()
+            _generation = generation
+            return
+        except xapian.DatabaseError:
+            logger.debug('Can not reopen %s, opening it again', index_path)
+
+    _index_store = IndexStore()
+    _index_store.open_index(temp_path=index_path, read_only=True)
+    _index_path = index_path
+    _index_inode = inode
+    _generation = generation
+
+
+def _find(index_path, generation, query):
+    if _index_store is None or _index_path != index_path or \
+            _generation != generation:
+        _open(index_path, generation)
+
+    try:
+        return _index_store.find(dict(query))
+    except xapian.DatabaseModifiedError:
+        # the writer committed again while we were reading
+        _open(index_path, generation)
+        return _index_store.find(dict(query))
+
+
+class QueryPool(object):
+    """Run index queries on worker processes.
+
+    Each worker holds the index opened read-only and catches up with the
+    changes committed by the writer, which stays the only one to modify
+    the index, whenever its generation changes. Queries therefore run in
+    parallel with each other and with the flushes of the main process.
+    """
+
+    def __init__(self, index_store, workers):
+        self._index_store = index_store
+        self._workers = workers
+        self._pool = None
+
+    def find(self, query, callback):
+        """Query the index, calling callback(result, exception) from the
+           main loop once done.
+
+        """
+        if self._pool is None:
+            self._pool = workerpool.new_pool(self._workers)
+
+        future = self._pool.submit(_find, self._index_store.index_path,
+                                   self._index_store.generation,
+                                   _unwrap(query))
+        future.add_done_callback(
+            lambda future: GLib.idle_add(self._found_cb, future, callback))
+
+    def _found_cb(self, future, callback):
+        try:
+            result = future.result()
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                logger.error('Query worker died, restarting the workers')
+                self.close()
+            callback(None, e)
+        else:
+            callback(result, None)
+        return False
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
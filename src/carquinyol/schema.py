@@ -0,0 +1,158 @@
+"""Value slots of the index.
+
+Properties with a value slot can be sorted on and queried by range. The
+built-in ones are always there; more can be added with the
+sort_properties option, a JSON object mapping property names to one of
+the types below. Slots are assigned to configured properties once and
+for all and recorded in the schema file of the data store, along with the
+properties every indexed entry has a value for.
+"""
+
+import os
+import json
+import logging
+import unicodedata
+
+import xapian
+
+NUMBER = 'number'
+DATE = 'date'
+STRING = 'string'
+# stored as is, only for built-in properties
+TEXT = 'text'
+
+TYPES = [NUMBER, DATE, STRING]
+
+# Slots below _n_ are left to built-in properties
+_FIRST_CUSTOM_SLOT = 16
+
+logger = logging.getLogger('schema')
+
+
+def fold_text(value):
+    """Return text in lower case and without accents, for comparisons
+       that unlike those of the locale do not change with the environment.
+
+    """
+    value = unicodedata.normalize('NFKD', str(value))
+    value = ''.join(char for char in value
+                    if not unicodedata.combining(char))
+    return value.casefold()
+
+
+class Field(object):
+    """A property indexed in a value slot.
+
+    """
+
+    def __init__(self, name, slot, value_type):
+        self.name = name
+        self.slot = slot
+        self.type = value_type
+
+    def is_range_queryable(self):
+        return self.type != TEXT
+
+    def serialise(self, value):
+        """Return the value to store in the slot, ordered as the values of
+           the property, raising ValueError or TypeError for invalid ones.
+
+        """
+        if self.type == NUMBER or self.type == DATE:
+            return xapian.sortable_serialise(float(value))
+        elif self.type == STRING:
+            # a collation key ignoring case and accents
+            return fold_text(str(value).strip()).encode('utf-8',
+                                                         'surrogatepass')
+        return str(value).strip()
+
+
+# The filesize of earlier versions was serialised as an integer, which
+# yields the same value
+_BUILTIN_FIELDS = [
+    Field('timestamp', 1, DATE),
+    Field('title', 2, TEXT),
+    # 3 holds the version tree of entries, see indexstore
+    Field('filesize', 4, NUMBER),
+    Field('creation_time', 5, DATE),
+    # for aggregate()
+    Field('activity', 6, TEXT),
+    Field('mime_type', 7, TEXT),
+]
+
+
+class Schema(object):
+    """Map property names to typed value slots.
+
+    Configured properties not yet in the index, or whose type changed, are
+    listed in pending until set_indexed() is called, once every entry
+    with the property has been indexed again.
+    """
+
+    def __init__(self, path=None, properties=None):
+        self._path = path
+        self._fields = dict((field.name, field) for field in _BUILTIN_FIELDS)
+        # name -> slot, of every property that ever had one
+        self._slots = {}
+        # names of the properties all entries are indexed with
+        self._indexed = {}
+        self.pending = []
+        changed = False
+
+        if path is not None and os.path.exists(path):
+            try:
+                state = json.load(open(path, 'r'))
+                self._slots = state['slots']
+                self._indexed = state['indexed']
+            except (IOError, ValueError, KeyError):
+                logger.exception('Can not read schema, indexing again')
+
+        for name, value_type in sorted((properties or {}).items()):
+            if name in self._fields or value_type not in TYPES:
+                logger.warning('Can not sort on %r as %r', name, value_type)
+                continue
+            if name not in self._slots:
+                self._slots[name] = max(
+                    [_FIRST_CUSTOM_SLOT - 1] + list(self._slots.values())) + 1
+                changed = True
+            self._fields[name] = Field(name, self._slots[name], value_type)
+            if self._indexed.get(name) != value_type:
+                self.pending.append(name)
+
+        # properties no longer configured are indexed again if added back
+        for name in list(self._indexed):
+            if name not in self._fields:
+                del self._indexed[name]
+                changed = True
+        if changed:
+            self._save()
+
+    def get_field(self, name):
+        return self._fields.get(name)
+
+    def get_fields(self):
+        return list(self._fields.values())
+
+    def set_indexed(self):
+        """Record that all entries are indexed with every configured
+           property.
+
+        """
+        for name in self.pending:
+            self._indexed[name] = self._fields[name].type
+        self.pending = []
+        self._save()
+
+    def _save(self):
+        if self._path is None:
+            return
+        temp_path = self._path + '.tmp'
+        try:
+            f = open(temp_path, 'w')
+            try:
+                json.dump({'slots': self._slots, 'indexed': self._indexed}, f)
+            finally:
+                f.close()
+            os.rename(temp_path, self._path)
+        except (IOError, OSError):
+            logger.exception('Can not save schema')
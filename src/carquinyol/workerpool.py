@@ -0,0 +1,21 @@
+"""Pools of worker processes, for work that would block the main loop.
+
+Workers are not forked from the service, which runs threads (file copies,
+compression, chunking) that may hold locks at the time of forking; they
+are forked from a single-threaded fork server instead. The fork server
+imports the main script of the service once for all workers, so the
+script must only start the service when run as __main__, and functions
+run by workers must be defined in carquinyol modules.
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+def new_pool(workers=1):
+    """Return a concurrent.futures executor running up to workers worker
+       processes.
+
+    """
+    context = multiprocessing.get_context('forkserver')
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context)
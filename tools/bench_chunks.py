@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+#
+# Measure what storing successive versions of a document as chunks costs:
+# the space taken by the chunks against that of plain copies, and the
+# throughput of splitting the data into chunks.
+#
+# Each version is the previous one with a few small edits, inserted,
+# replaced or deleted at random offsets, as when a journal entry is
+# saved again.
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'src'))
+
+from carquinyol import layoutmanager  # noqa
+from carquinyol.chunkstore import ChunkIngest  # noqa
+
+
+def build_argument_parser():
+
+    usage = "%(prog)s [-s SIZE] [-v VERSIONS] [-e EDITS] [-d DIRECTORY]"
+    parser = argparse.ArgumentParser(usage=usage)
+
+    parser.add_argument("-s", "--size", action="store", dest="size",
+                        type=int, metavar="SIZE", default=4,
+                        help="Start with a document of SIZE MiB "
+                             "(default: 4)")
+    parser.add_argument("-v", "--versions", action="store", dest="versions",
+                        type=int, metavar="VERSIONS", default=10,
+                        help="Store VERSIONS versions (default: 10)")
+    parser.add_argument("-e", "--edits", action="store", dest="edits",
+                        type=int, metavar="EDITS", default=5,
+                        help="Make EDITS edits per version (default: 5)")
+    parser.add_argument("-d", "--directory", action="store",
+                        dest="directory", metavar="DIRECTORY",
+                        default=None,
+                        help="Store the chunks in DIRECTORY (default: the "
+                             "temporary directory)")
+    return parser
+
+
+def edit(data, edits, rand):
+    data = bytearray(data)
+    for i_ in range(edits):
+        offset = rand.randrange(len(data))
+        length = rand.randrange(1, 4096)
+        kind = rand.choice(['insert', 'replace', 'delete'])
+        if kind == 'insert':
+            data[offset:offset] = rand.randbytes(length)
+        elif kind == 'replace':
+            data[offset:offset + length] = rand.randbytes(length)
+        else:
+            del data[offset:offset + length]
+    return bytes(data)
+
+
+def ingest(path):
+    """Return the ingest of a file once split, and the seconds it took."""
+    job = ChunkIngest(path, None)
+    job.src_fp = os.open(path, os.O_RDONLY)
+    try:
+        start = time.monotonic()
+        job._split()
+        elapsed = time.monotonic() - start
+    finally:
+        os.close(job.src_fp)
+    return job, elapsed
+
+
+def format_size(size):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024 or unit == 'GiB':
+            break
+        size /= 1024.0
+    return '%.1f %s' % (size, unit)
+
+
+if __name__ == "__main__":
+
+    args = build_argument_parser().parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_chunks', dir=args.directory)
+    layoutmanager._instance = layoutmanager.LayoutManager(work_dir)
+    rand = random.Random(0)
+    data = rand.randbytes(args.size * 1024 * 1024)
+    plain_bytes = 0
+    stored_bytes = 0
+    chunk_count = 0
+    seconds = 0.0
+    try:
+        version_path = os.path.join(work_dir, 'version')
+        for version in range(args.versions):
+            if version:
+                data = edit(data, args.edits, rand)
+            f = open(version_path, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+
+            job, elapsed = ingest(version_path)
+            plain_bytes += job.written
+            stored_bytes += job.stored
+            chunk_count += len(job.chunks)
+            seconds += elapsed
+            print('version %3d: %10s, %5d chunks, %10s new, %6.1f MiB/s' % (
+                version + 1, format_size(job.written), len(job.chunks),
+                format_size(job.stored),
+                job.written / 1024 / 1024 / max(elapsed, 1e-9)))
+
+        print('Plain copies:  %s' % format_size(plain_bytes))
+        print('Chunks:        %s (%.1f%%)' % (
+            format_size(stored_bytes), 100.0 * stored_bytes / plain_bytes))
+        print('Average chunk: %s' % format_size(plain_bytes / chunk_count))
+        print('Throughput:    %.1f MiB/s' % (
+            plain_bytes / 1024 / 1024 / max(seconds, 1e-9)))
+    finally:
+        shutil.rmtree(work_dir)
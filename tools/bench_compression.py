@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+#
+# Measure the compression ratio and speed of the codecs the file store
+# can compress entry data with, on given files or on the files of a
+# directory, such as the data of a data store.
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'src'))
+
+from carquinyol import compression  # noqa
+
+
+def build_argument_parser():
+
+    usage = "%(prog)s [-c CODEC] [-m SIZE] PATH..."
+    parser = argparse.ArgumentParser(usage=usage)
+
+    parser.add_argument("-c", "--codec", action="append", dest="codecs",
+                        choices=sorted(compression._CODECS),
+                        metavar="CODEC", default=None,
+                        help="Only measure CODEC, can be repeated "
+                             "(default: all of them)")
+    parser.add_argument("-m", "--min-size", action="store",
+                        dest="min_size", type=int, metavar="SIZE",
+                        default=4096,
+                        help="Count files smaller than SIZE bytes as not "
+                             "compressed, as the compression_min_size "
+                             "option does (default: 4096)")
+    parser.add_argument("paths", nargs="+", metavar="PATH",
+                        help="Files, or directories to take the files of")
+    return parser
+
+
+def find_files(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dir_path, dir_names_, file_names in os.walk(path):
+            for file_name in sorted(file_names):
+                file_path = os.path.join(dir_path, file_name)
+                if os.path.isfile(file_path) and \
+                        not os.path.islink(file_path):
+                    yield file_path
+
+
+def measure(codec, path, temp_path):
+    """Return the compressed size of a file and the seconds compressing
+       and decompressing it took.
+
+    """
+    ingest = compression.CompressIngest(path, temp_path, codec, None)
+    ingest.size = os.stat(path).st_size
+    start = time.monotonic()
+    ingest._compress()
+    compress_seconds = time.monotonic() - start
+
+    start = time.monotonic()
+    compression.decompress(temp_path, temp_path + '.plain')
+    decompress_seconds = time.monotonic() - start
+    os.unlink(temp_path + '.plain')
+    os.unlink(temp_path)
+    return ingest.compressed_size, compress_seconds, decompress_seconds
+
+
+def format_rate(size, seconds):
+    return '%.1f MiB/s' % (size / 1024.0 / 1024.0 / max(seconds, 1e-9))
+
+
+if __name__ == "__main__":
+
+    args = build_argument_parser().parse_args()
+    codecs = args.codecs or sorted(compression._CODECS)
+    files = list(find_files(args.paths))
+
+    fd, temp_path = tempfile.mkstemp(prefix='bench_compression')
+    os.close(fd)
+    try:
+        print('%-6s %8s %12s %12s %12s %5s' % (
+            'codec', 'files', 'ratio', 'compress', 'decompress', 'kept'))
+        for codec in codecs:
+            size = 0
+            compressed_size = 0
+            compress_seconds = 0.0
+            decompress_seconds = 0.0
+            kept = 0
+            for path in files:
+                file_size = os.stat(path).st_size
+                result = measure(codec, path, temp_path)
+                size += file_size
+                compressed_size += result[0]
+                compress_seconds += result[1]
+                decompress_seconds += result[2]
+                # as the file store decides whether to keep the result
+                if file_size >= args.min_size and \
+                        result[0] <= file_size * (
+                            1 - compression._MIN_SAVINGS):
+                    kept += 1
+            print('%-6s %8d %11.1f%% %12s %12s %5d' % (
+                codec, len(files), 100.0 * compressed_size / max(size, 1),
+                format_rate(size, compress_seconds),
+                format_rate(size, decompress_seconds), kept))
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
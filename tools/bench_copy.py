@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+#
+# Time the ways the file store can copy data into an entry: reflink,
+# copy_file_range, sendfile and copying in chunks. Run it on the
+# filesystem of the data store, reflinks are only available on some.
+#
+# The source file is read once beforehand, so the numbers are for data
+# in the page cache, as for a file an activity just wrote.
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'src'))
+
+from carquinyol.filestore import AsyncCopy, _UNSUPPORTED_ERRNOS  # noqa
+
+METHODS = [
+    ('reflink', '_copy_reflink'),
+    ('copy_file_range', '_copy_file_range'),
+    ('sendfile', '_copy_sendfile'),
+    ('chunks', '_copy_chunks'),
+]
+
+
+def build_argument_parser():
+
+    usage = "%(prog)s [-s SIZE] [-n RUNS] [-d DIRECTORY]"
+    parser = argparse.ArgumentParser(usage=usage)
+
+    parser.add_argument("-s", "--size", action="store", dest="size",
+                        type=int, metavar="SIZE", default=64,
+                        help="Copy a file of SIZE MiB (default: 64)")
+    parser.add_argument("-n", "--runs", action="store", dest="runs",
+                        type=int, metavar="RUNS", default=5,
+                        help="Keep the best of RUNS copies (default: 5)")
+    parser.add_argument("-d", "--directory", action="store",
+                        dest="directory", metavar="DIRECTORY",
+                        default=None,
+                        help="Copy within DIRECTORY (default: the "
+                             "temporary directory)")
+    return parser
+
+
+def make_source(path, size):
+    f = open(path, 'wb')
+    try:
+        for i_ in range(size):
+            f.write(os.urandom(1024 * 1024))
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    # warm the page cache
+    f = open(path, 'rb')
+    try:
+        while f.read(1024 * 1024):
+            pass
+    finally:
+        f.close()
+
+
+def time_copy(method, src_path, dest_path):
+    """Return the seconds a copy with method took, None if the method is
+       not available.
+
+    """
+    copy = AsyncCopy(src_path, dest_path, None)
+    copy.src_fp = os.open(src_path, os.O_RDONLY)
+    copy.dest_fp = os.open(dest_path, os.O_RDWR | os.O_TRUNC | os.O_CREAT,
+                           0o644)
+    copy.size = os.fstat(copy.src_fp).st_size
+    try:
+        start = time.monotonic()
+        try:
+            if not getattr(copy, method)():
+                return None
+        except OSError as e:
+            if e.errno in _UNSUPPORTED_ERRNOS:
+                return None
+            raise
+        os.fsync(copy.dest_fp)
+        elapsed = time.monotonic() - start
+    finally:
+        os.close(copy.src_fp)
+        os.close(copy.dest_fp)
+        os.unlink(dest_path)
+
+    if copy.written != copy.size:
+        raise RuntimeError('%s copied %d of %d bytes' % (
+            method, copy.written, copy.size))
+    return elapsed
+
+
+if __name__ == "__main__":
+
+    args = build_argument_parser().parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_copy', dir=args.directory)
+    src_path = os.path.join(work_dir, 'src')
+    dest_path = os.path.join(work_dir, 'data')
+    try:
+        make_source(src_path, args.size)
+        print('Copying %d MiB in %s, best of %d runs' % (
+            args.size, work_dir, args.runs))
+        for name, method in METHODS:
+            times = [time_copy(method, src_path, dest_path)
+                     for i_ in range(args.runs)]
+            if None in times:
+                print('%-16s not available' % name)
+                continue
+            best = min(times)
+            print('%-16s %8.1f ms %10.1f MiB/s' % (
+                name, best * 1000, args.size / max(best, 1e-9)))
+    finally:
+        for file_name in os.listdir(work_dir):
+            os.unlink(os.path.join(work_dir, file_name))
+        os.rmdir(work_dir)